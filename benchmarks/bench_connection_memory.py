@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+""" Measures memory per connection object and the cost of pruning closed connections from the server.
+
+    python -m benchmarks.bench_connection_memory [--connections N] [--closed N]
+"""
+
+import argparse
+import collections
+import logging
+import timeit
+import tracemalloc
+import types
+
+from stevesockets import socketconnection
+from stevesockets.server import SocketServer
+from stevesockets.socketconnection import SocketConnection, SocketBytesReader
+from stevesockets.websocket import server as websocket_server, websocket
+from stevesockets.websocket.server import WebSocketConnection
+from stevesockets.websocket.websocket import WebSocketFrameParser
+
+
+def unslotted(cls, bases, module_globals):
+    """ A copy of `cls` without __slots__, so its instances keep their attributes in a __dict__. Its functions look
+        up globals in `module_globals`, so the other classes they name (e.g. in `super(Class, self)` or to create
+        a connection's bytes reader) can be swapped for their copies too. """
+    namespace = {}
+    for name, value in vars(cls).items():
+        if name in ("__slots__", "__dict__", "__weakref__") or name in cls.__slots__:
+            continue
+        if isinstance(value, types.FunctionType):
+            value = types.FunctionType(value.__code__, module_globals, value.__name__, value.__defaults__,
+                                       value.__closure__)
+        namespace[name] = value
+    return type(cls.__name__, bases, namespace)
+
+
+def get_unslotted_classes():
+    """ Copies of the connection classes (and the reader and parser every connection has) laid out the way they were
+        before `__slots__`, but otherwise the same code """
+    copies = {}
+    module_globals = {module: dict(vars(module)) for module in (socketconnection, websocket_server, websocket)}
+    copies["SocketBytesReader"] = unslotted(SocketBytesReader, (), module_globals[socketconnection])
+    copies["SocketConnection"] = unslotted(SocketConnection, (), module_globals[socketconnection])
+    copies["WebSocketFrameParser"] = unslotted(WebSocketFrameParser, (), module_globals[websocket])
+    copies["WebSocketConnection"] = unslotted(WebSocketConnection, (copies["SocketConnection"],),
+                                              module_globals[websocket_server])
+    for copied_globals in module_globals.values():
+        copied_globals.update({name: copy for name, copy in copies.items() if name in copied_globals})
+    return copies["SocketConnection"], copies["WebSocketConnection"]
+
+
+UnslottedSocketConnection, UnslottedWebSocketConnection = get_unslotted_classes()
+
+
+class LegacySocketConnection(UnslottedSocketConnection):
+    """ A SocketConnection laid out the way it was before `__slots__`: a per-instance __dict__ and an eager
+        message deque """
+
+    def __init__(self, *args, **kwargs):
+        super(LegacySocketConnection, self).__init__(*args, **kwargs)
+        self.messages = collections.deque()
+
+
+class LegacyWebSocketConnection(UnslottedWebSocketConnection):
+    """ A WebSocketConnection laid out the way it was before `__slots__`, with its deques and channel set created
+        up front """
+
+    def __init__(self, *args, **kwargs):
+        super(LegacyWebSocketConnection, self).__init__(*args, **kwargs)
+        self.messages = collections.deque()
+        self.pending_frames = collections.deque()
+        self.channels = set()
+
+
+class FakeSocket:
+    """ Enough of a socket for the server's registry, without using up real file descriptors """
+
+    __slots__ = ("fd",)
+
+    def __init__(self, fd):
+        self.fd = fd
+
+    def fileno(self):
+        return self.fd
+
+    def close(self):
+        pass
+
+
+def bytes_per_connection(connection_cls, count, logger):
+    sockets = [FakeSocket(fd) for fd in range(count)]
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    connections = [connection_cls(sck, "127.0.0.1", 9000, logger=logger) for sck in sockets]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del connections
+    return (after - before) / count
+
+
+def legacy_prune(connections):
+    """ What SocketServer.prune_peer_connections used to do on every pass: check every connection in the list, and
+        list.remove each one that's closing """
+    for conn in list(connections):
+        if conn.is_to_be_closed() or conn.is_closed():
+            connections.remove(conn)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-c", "--connections", action="store", default=50000, type=int)
+    parser.add_argument("--closed", action="store", default=1000, type=int,
+                        help="how many connections to drop when timing the prune")
+    parser_args = parser.parse_args()
+    logger = logging.getLogger(__name__)
+    # the prune logs every connection it closes
+    logger.setLevel(logging.ERROR)
+    count = parser_args.connections
+
+    # legacy: __dict__ and eager containers, as before; __dict__: lazy containers only; slotted: both, as now
+    print(f"{'connection':>20} {'legacy (B)':>12} {'__dict__ (B)':>13} {'slotted (B)':>12} {'saved':>8} "
+          f"{'by slots':>9}")
+    for name, legacy_cls, unslotted_cls, cls in (
+            ("SocketConnection", LegacySocketConnection, UnslottedSocketConnection, SocketConnection),
+            ("WebSocketConnection", LegacyWebSocketConnection, UnslottedWebSocketConnection, WebSocketConnection)):
+        legacy = bytes_per_connection(legacy_cls, count, logger)
+        with_dict = bytes_per_connection(unslotted_cls, count, logger)
+        slotted = bytes_per_connection(cls, count, logger)
+        print(f"{name:>20} {legacy:>12.0f} {with_dict:>13.0f} {slotted:>12.0f} {1 - slotted / legacy:>8.0%} "
+              f"{1 - slotted / with_dict:>9.0%}")
+    print(f"at {count} connections")
+
+    connections = [SocketConnection(FakeSocket(fd), "127.0.0.1", 9000, logger=logger) for fd in range(count)]
+    closed = connections[::max(1, count // parser_args.closed)][:parser_args.closed]
+    server = SocketServer(logger=logger)
+    server.peer_connections = connections
+    # a loop pass with nothing to prune, as with idle clients
+    number = 10
+    legacy_seconds = timeit.timeit(lambda: legacy_prune(list(connections)), number=number) / number
+    prune_seconds = timeit.timeit(server.prune_peer_connections, number=number) / number
+    print(f"pruning {count} connections, none closing: list scan {legacy_seconds * 1000:.2f}ms, "
+          f"prune_peer_connections {prune_seconds * 1000:.3f}ms")
+    for conn in closed:
+        conn.mark_for_closing()
+    legacy_seconds = timeit.timeit(lambda: legacy_prune(list(connections)), number=1)
+    prune_seconds = timeit.timeit(server.prune_peer_connections, number=1)
+    assert len(server.connections) == count - len(closed)
+    print(f"pruning {count} connections, {len(closed)} closing: list scan {legacy_seconds * 1000:.1f}ms, "
+          f"prune_peer_connections {prune_seconds * 1000:.2f}ms")
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+""" Compares WebSocket payload masking strategies across payload sizes.
+
+    python -m benchmarks.bench_masking [--repeat N] [--legacy-max BYTES]
+"""
+
+import argparse
+import os
+import timeit
+
+from stevesockets.websocket import websocket
+from stevesockets.websocket.websocket import apply_mask, int_to_bytes
+
+SIZES = [125, 1024, 2 ** 16, 2 ** 20, 2 ** 24]
+
+
+def legacy_mask(data, mask):
+    """ The byte-at-a-time masking WebSocketFrame used before `apply_mask` """
+    masked = b''
+    for x, char in enumerate(data):
+        shift_distance = 8 * (x % 4)
+        mask_byte = (mask & (255 << shift_distance)) >> shift_distance
+        masked += int_to_bytes(char ^ mask_byte, 1)
+    return masked
+
+
+def int_mask(data, mask):
+    numpy, websocket.numpy = websocket.numpy, None
+    try:
+        return apply_mask(data, mask)
+    finally:
+        websocket.numpy = numpy
+
+
+def numpy_mask(data, mask):
+    return websocket._apply_mask_numpy(data, int_to_bytes(mask, 4))
+
+
+def format_size(size):
+    for unit in ("B", "KB", "MB"):
+        if size < 1024:
+            return f"{size}{unit}"
+        size //= 1024
+    return f"{size}GB"
+
+
+def time_call(fn, data, mask, repeat):
+    # run enough iterations that tiny payloads aren't lost in timer resolution, and keep the best run
+    number = max(1, 2 ** 20 // len(data))
+    return min(timeit.repeat(lambda: fn(data, mask), number=number, repeat=repeat)) / number
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-r", "--repeat", action="store", default=3, type=int)
+    parser.add_argument("--legacy-max", action="store", default=2 ** 16, type=int,
+                        help="largest payload to run the (quadratic) legacy masking on")
+    parser_args = parser.parse_args()
+
+    strategies = [("legacy", legacy_mask), ("int", int_mask)]
+    if websocket.numpy is not None:
+        strategies.append(("numpy", numpy_mask))
+    else:
+        print("numpy not installed, skipping the numpy strategy")
+
+    mask = websocket.WebSocketFrame.generate_mask()
+    print(f"{'size':>8} " + " ".join(f"{name + ' (MB/s)':>16}" for name, _ in strategies))
+    for size in SIZES:
+        data = os.urandom(size)
+        expected = int_mask(data, mask)
+        row = []
+        for name, fn in strategies:
+            if name == "legacy" and size > parser_args.legacy_max:
+                row.append(f"{'-':>16}")
+                continue
+            assert fn(data, mask) == expected, f"{name} masking produced a different payload"
+            seconds = time_call(fn, data, mask, parser_args.repeat)
+            row.append(f"{size / seconds / 2 ** 20:>16.1f}")
+        print(f"{format_size(size):>8} " + " ".join(row))
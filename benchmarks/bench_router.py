@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+""" Compares matching requests with the trie Router against scanning a list of compiled regexes, the way
+    listeners comparing paths themselves would, as the number of routes grows.
+
+    python -m benchmarks.bench_router [--repeat N]
+"""
+
+import argparse
+import re
+import timeit
+
+from stevesockets.http.router import Router, PARAMETER
+
+ROUTE_COUNTS = [10, 100, 1000]
+
+
+def get_patterns(count):
+    """ `count` patterns spread over a few resources, like a typical API """
+    patterns = []
+    for i in range(count):
+        resource = f"resource{i // 4}"
+        patterns.append((f"/api/{resource}", f"/api/{resource}/{{id}}", f"/api/{resource}/{{id}}/items/{{item}}",
+                         f"/api/{resource}/{{id}}/settings")[i % 4])
+    return patterns
+
+
+def compile_regexes(patterns):
+    def to_regex(pattern):
+        return re.compile(PARAMETER.sub(lambda match: f"(?P<{match.group('name')}>[^/]+)", pattern) + "$")
+    return [(to_regex(pattern), pattern) for pattern in patterns]
+
+
+def match_linear(regexes, path):
+    for regex, pattern in regexes:
+        match = regex.match(path)
+        if match:
+            return pattern, match.groupdict()
+    return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-r", "--repeat", action="store", default=3, type=int)
+    parser_args = parser.parse_args()
+
+    print(f"{'routes':>8} {'regex scan (us)':>16} {'trie (us)':>16}")
+    for count in ROUTE_COUNTS:
+        patterns = get_patterns(count)
+        router = Router()
+        for pattern in patterns:
+            router.add_route("GET", pattern, pattern)
+        regexes = compile_regexes(patterns)
+        # the last resource's routes, the worst case for the scan
+        paths = [pattern.replace("{id}", "42").replace("{item}", "7") for pattern in patterns[-4:]]
+        for path in paths:
+            handler, params = router.match("GET", path)
+            assert (handler, params) == match_linear(regexes, path), f"Different match for {path}"
+        number = 10000
+        linear = min(timeit.repeat(lambda: [match_linear(regexes, path) for path in paths], number=number,
+                                   repeat=parser_args.repeat)) / number / len(paths)
+        trie = min(timeit.repeat(lambda: [router.match("GET", path) for path in paths], number=number,
+                                 repeat=parser_args.repeat)) / number / len(paths)
+        print(f"{count:>8} {linear * 1e6:>16.2f} {trie * 1e6:>16.2f}")
@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+""" Drives a SocketServer, WebSocketServer or HttpServer over localhost with closed-loop clients (each sends a
+    message and waits for the reply before sending the next) and reports throughput, latency and memory.
+
+    python -m benchmarks.loadgen {socket,websocket,http} [-c CONCURRENCY] [-s SIZE [SIZE ...]] [-d SECONDS]
+                                 [--asyncio] [-o results.json] [--compare previous.json]
+
+    The server runs in a thread of the same process as the clients, so the numbers are for comparing runs on the
+    same machine rather than absolute capacity. Results are saved as JSON with `-o`, and `--compare` prints how a
+    run differs from a saved one.
+"""
+
+import argparse
+import asyncio
+import base64
+import datetime
+import json
+import logging
+import os
+import platform
+import resource
+import socket
+import subprocess
+import threading
+import time
+
+from stevesockets.http.server import HttpServer
+from stevesockets.asyncserver import AsyncSocketServer
+from stevesockets.listeners import WebFrameListener
+from stevesockets.messages import Listener, MessageTypes
+from stevesockets.server import SocketServer
+from stevesockets.websocket.asyncserver import AsyncWebSocketServer
+from stevesockets.websocket.server import WebSocketServer
+from stevesockets.websocket.websocket import WebSocketFrame, WebSocketFrameParser
+
+HOST = "127.0.0.1"
+READ_SIZE = 2 ** 16
+
+
+class EchoListener(Listener):
+
+    def observe(self, message, *args, connection=None, **kwargs):
+        connection.queue_message(message)
+
+
+class WebSocketEchoListener(WebFrameListener):
+
+    def observe(self, message, *args, connection=None, **kwargs):
+        connection.send_frame(WebSocketFrame.get_binary_frame(message.payload))
+
+
+class HttpBodyListener(Listener):
+    """ Answers every request with a body of `size` bytes, leaving the connection open for the next one """
+
+    def __init__(self, size):
+        super(HttpBodyListener, self).__init__()
+        self.response = (f"HTTP/1.1 200 OK\r\nContent-Type: application/octet-stream\r\n"
+                         f"Content-Length: {size}\r\n\r\n").encode() + b"x" * size
+
+    def observe(self, message, *args, connection=None, **kwargs):
+        connection.queue_message(self.response)
+
+
+class EchoClient:
+    """ Sends `size` bytes over a raw TCP connection and waits for all of them to come back """
+
+    def __init__(self, port, size):
+        self.port = port
+        self.payload = os.urandom(size)
+        self.reader = None
+        self.writer = None
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(HOST, self.port)
+
+    async def request(self):
+        self.writer.write(self.payload)
+        await self.reader.readexactly(len(self.payload))
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except ConnectionError:
+                pass
+            self.writer = None
+
+
+class WebSocketClient(EchoClient):
+    """ Sends the payload as a masked binary frame, the way a browser would, and waits for the echoed frame """
+
+    async def connect(self):
+        await super(WebSocketClient, self).connect()
+        key = base64.b64encode(os.urandom(16)).decode()
+        self.writer.write((f"GET / HTTP/1.1\r\nHost: {HOST}:{self.port}\r\nUpgrade: websocket\r\n"
+                           f"Connection: Upgrade\r\nSec-WebSocket-Key: {key}\r\nSec-WebSocket-Version: 13\r\n\r\n")
+                          .encode())
+        response = await self.reader.readuntil(b"\r\n\r\n")
+        if not response.startswith(b"HTTP/1.1 101"):
+            raise ConnectionError(f"Handshake refused: {response.splitlines()[0]}")
+        self.parser = WebSocketFrameParser()
+        self.frames = []
+
+    async def request(self):
+        frame = WebSocketFrame.get_binary_frame(self.payload)
+        frame.headers.mask_flag, frame.headers.mask = 1, WebSocketFrame.generate_mask()
+        self.writer.write(frame.to_bytes())
+        while not self.frames:
+            data = await self.reader.read(READ_SIZE)
+            if not data:
+                raise ConnectionError("Server closed the connection")
+            self.frames += self.parser.feed(data)
+        self.frames.pop(0)
+
+
+class HttpClient(EchoClient):
+    """ Requests a body of `size` bytes, reconnecting whenever the server closes the connection """
+
+    async def connect(self):
+        await super(HttpClient, self).connect()
+        self.request_bytes = f"GET / HTTP/1.1\r\nHost: {HOST}:{self.port}\r\n\r\n".encode()
+
+    async def request(self):
+        if self.writer is None:
+            await self.connect()
+        self.writer.write(self.request_bytes)
+        head = await self.reader.readuntil(b"\r\n\r\n")
+        headers = {}
+        for line in head.decode("latin-1").split("\r\n")[1:]:
+            if ": " in line:
+                name, value = line.split(": ", 1)
+                headers[name.lower()] = value
+        if "content-length" in headers:
+            await self.reader.readexactly(int(headers["content-length"]))
+        else:
+            await self.reader.read()
+        if headers.get("connection", "").lower() == "close" or "content-length" not in headers:
+            await self.close()
+
+
+SERVERS = {
+    # name -> (server class, asyncio server class, client class)
+    "socket": (SocketServer, AsyncSocketServer, EchoClient),
+    "websocket": (WebSocketServer, AsyncWebSocketServer, WebSocketClient),
+    "http": (HttpServer, None, HttpClient),
+}
+
+
+def get_free_port():
+    with socket.socket() as sck:
+        sck.bind((HOST, 0))
+        return sck.getsockname()[1]
+
+
+def start_server(name, port, size, use_asyncio=False):
+    server_cls, async_server_cls, _ = SERVERS[name]
+    if use_asyncio:
+        if async_server_cls is None:
+            raise ValueError(f"There's no asyncio {name} server")
+        server_cls = async_server_cls
+    logger = logging.getLogger(__name__)
+    # clients coming and going would otherwise be logged as warnings
+    logger.setLevel(logging.ERROR)
+    server = server_cls(address=(HOST, port), logger=logger)
+    if name == "socket":
+        server.register_listener(EchoListener)
+    elif name == "websocket":
+        server.register_listener(WebSocketEchoListener, message_type=MessageTypes.BINARY)
+    else:
+        server.message_manager.listen_for_message(HttpBodyListener(size))
+    thread = threading.Thread(target=server.listen, daemon=True)
+    thread.start()
+    # wait until the server accepts connections
+    for _ in range(100):
+        try:
+            socket.create_connection((HOST, port), timeout=1).close()
+            break
+        except ConnectionRefusedError:
+            time.sleep(.05)
+    return server, thread
+
+
+def percentile(ordered, fraction):
+    """ Nearest-rank percentile of an already sorted list """
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, max(0, int(round(fraction * len(ordered))) - 1))]
+
+
+def get_rss_mb():
+    """ The process' current resident set size, falling back to its peak where /proc isn't available """
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize() / 2 ** 20
+    except OSError:
+        return get_max_rss_mb()
+
+
+def get_max_rss_mb():
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return max_rss / 2 ** 20 if platform.system() == "Darwin" else max_rss / 2 ** 10
+
+
+async def drive(client_cls, port, concurrency, size, duration, warmup):
+    """ Runs `concurrency` clients for `warmup` + `duration` seconds, returning the latencies (in seconds) of the
+        requests completed after the warmup """
+    clients = [client_cls(port, size) for _ in range(concurrency)]
+    await asyncio.gather(*(client.connect() for client in clients))
+    loop = asyncio.get_running_loop()
+    measure_from = loop.time() + warmup
+    end = measure_from + duration
+    latencies = []
+
+    async def run_client(client):
+        while True:
+            start = time.perf_counter()
+            await client.request()
+            now = loop.time()
+            if now >= end:
+                return
+            if now >= measure_from:
+                latencies.append(time.perf_counter() - start)
+
+    try:
+        await asyncio.gather(*(run_client(client) for client in clients))
+    finally:
+        await asyncio.gather(*(client.close() for client in clients), return_exceptions=True)
+    return latencies
+
+
+def run(name, concurrency, size, duration, warmup=1.0, use_asyncio=False) -> dict:
+    port = get_free_port()
+    server, thread = start_server(name, port, size, use_asyncio=use_asyncio)
+    try:
+        latencies = asyncio.run(drive(SERVERS[name][2], port, concurrency, size, duration, warmup))
+        rss = get_rss_mb()
+    finally:
+        server.stop_listening()
+        thread.join(timeout=5)
+    latencies.sort()
+    return {
+        "server": name,
+        "asyncio": use_asyncio,
+        "concurrency": concurrency,
+        "message_size": size,
+        "duration": duration,
+        "messages": len(latencies),
+        "msgs_per_sec": len(latencies) / duration,
+        "latency_ms": {
+            "mean": sum(latencies) / len(latencies) * 1000 if latencies else 0.0,
+            "p50": percentile(latencies, .5) * 1000,
+            "p99": percentile(latencies, .99) * 1000,
+            "p999": percentile(latencies, .999) * 1000,
+            "max": latencies[-1] * 1000 if latencies else 0.0,
+        },
+        "rss_mb": rss,
+        "max_rss_mb": get_max_rss_mb(),
+    }
+
+
+def get_environment() -> dict:
+    try:
+        revision = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                  check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+    return {
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "revision": revision,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def run_key(result):
+    return result["server"], result["asyncio"], result["concurrency"], result["message_size"]
+
+
+def print_result(result, previous=None):
+    latency = result["latency_ms"]
+    line = (f"{result['server']:>9}{' (asyncio)' if result['asyncio'] else '':>10} c={result['concurrency']:<5}"
+            f"{result['message_size']:>8}B {result['msgs_per_sec']:>10.0f} msg/s  p50 {latency['p50']:7.2f}ms  "
+            f"p99 {latency['p99']:7.2f}ms  p999 {latency['p999']:7.2f}ms  rss {result['rss_mb']:6.1f}MB")
+    if previous:
+        def change(new, old):
+            return f"{(new - old) / old:+.1%}" if old else "n/a"
+        line += (f"\n{'':>34}vs previous: {change(result['msgs_per_sec'], previous['msgs_per_sec'])} msg/s, "
+                 f"p99 {change(latency['p99'], previous['latency_ms']['p99'])}, "
+                 f"rss {change(result['rss_mb'], previous['rss_mb'])}")
+    print(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("server", choices=sorted(SERVERS))
+    parser.add_argument("-c", "--concurrency", action="store", default=[10], type=int, nargs="+")
+    parser.add_argument("-s", "--size", action="store", default=[128], type=int, nargs="+",
+                        help="message (or HTTP response body) sizes in bytes")
+    parser.add_argument("-d", "--duration", action="store", default=5.0, type=float)
+    parser.add_argument("-w", "--warmup", action="store", default=1.0, type=float)
+    parser.add_argument("--asyncio", action="store_true", help="Run the asyncio version of the server")
+    parser.add_argument("-o", "--output", action="store", help="save the results to this JSON file")
+    parser.add_argument("--compare", action="store", help="a JSON file saved by an earlier run to compare with")
+    parser_args = parser.parse_args()
+
+    previous = {}
+    if parser_args.compare:
+        with open(parser_args.compare) as compare_file:
+            previous = {run_key(result): result for result in json.load(compare_file)["results"]}
+
+    results = []
+    for concurrency in parser_args.concurrency:
+        for size in parser_args.size:
+            result = run(parser_args.server, concurrency, size, parser_args.duration, warmup=parser_args.warmup,
+                         use_asyncio=parser_args.asyncio)
+            print_result(result, previous.get(run_key(result)))
+            results.append(result)
+
+    if parser_args.output:
+        with open(parser_args.output, "w") as output_file:
+            json.dump({"environment": get_environment(), "results": results}, output_file, indent=2)
+        print(f"Results saved to {parser_args.output}")
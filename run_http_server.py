@@ -1,22 +1,34 @@
 #!/usr/bin/env python3
 
+import html
 import sys
 from stevesockets.http.server import HttpServer
 import logging
 import argparse
-from stevesockets.socketconnection import SocketConnection
 from stevesockets.http import LOGGER_NAME
-from stevesockets.messages import MessageTypes
-from stevesockets.listeners import TextListener
+from stevesockets.http.request import HttpRequest
+from stevesockets.http.response import HttpResponse
+from stevesockets.http.static import StaticFiles
 
 
-class CustomListener(TextListener):
+def html_response(body: str) -> HttpResponse:
+    return HttpResponse(f"<!doctype html><html><body>{body}</body></html>", content_type="text/html")
 
-    def observe(self, message: bytes, *args, connection: SocketConnection = None, server=None, **kwargs):
-        print(f"Observing incoming HTTP message {message.decode('utf-8')}")
-        content = bytes("HTTP/1.1 200 OK\r\n\r\n<!doctype html><html><body><h1>Hello world</h1></body></html>", "utf-8")
-        connection.queue_message(content)
-        connection.mark_for_closing()
+
+def hello_world(request: HttpRequest, connection=None, server=None):
+    print(f"Observing incoming HTTP request {request.method} {request.target}, headers: {request.headers.items()}")
+    return html_response("<h1>Hello world</h1>")
+
+
+def hello(request: HttpRequest, connection=None, server=None):
+    return html_response(f"<h1>Hello {html.escape(request.params['name'])}</h1>")
+
+
+def count(request: HttpRequest, connection=None, server=None):
+    # streamed chunked, each line produced only once the client has read the ones before it
+    n = request.params["n"]
+    n = int(n) if n.isascii() and n.isdigit() else 0
+    return HttpResponse((f"{i}\n" for i in range(n)), content_type="text/plain")
 
 
 if __name__ == "__main__":
@@ -30,10 +42,15 @@ if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
     parser.add_argument("-p", "--port", action="store", default=9000, type=int)
+    parser.add_argument("--static", action="store", help="serve the files in this directory under /static/")
     parser_args = parser.parse_args()
 
     s = HttpServer(logger=logger)
-    s.register_listener(CustomListener, message_type=MessageTypes.DEFAULT)
+    s.route("/")(hello_world)
+    s.route("/hello/{name}")(hello)
+    s.route("/count/{n}", methods=("GET", "HEAD"))(count)
+    if parser_args.static:
+        s.route("/static/{path:path}", methods=("GET", "HEAD"))(StaticFiles(parser_args.static))
 
     print(f"Listening at http://127.0.0.1:{parser_args.port}")
 
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+
+import sys
+import logging
+import argparse
+import tempfile
+from stevesockets.websocket import LOGGER_NAME
+from stevesockets.messages import MessageTypes
+from stevesockets.listeners import MessageSynchronizer
+from stevesockets.backplane import UnixDatagramBackplane
+from stevesockets.prefork import PreforkSupervisor
+from stevesockets.websocket.server import WebSocketServer
+from stevesockets.websocket.asyncserver import AsyncWebSocketServer
+from run_websocket_server import CustomListener
+
+
+if __name__ == "__main__":
+    logger = logging.getLogger(LOGGER_NAME)
+    logger.setLevel(logging.INFO)
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setLevel(logging.INFO)
+    formatter = logging.Formatter('%(asctime)s [%(process)d %(filename)s:%(lineno)5s] - %(levelname)s - %(message)s')
+    handler.setFormatter(formatter)
+    logger.addHandler(handler)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-p", "--port", action="store", default=9000, type=int)
+    parser.add_argument("-w", "--workers", action="store", default=None, type=int,
+                        help="Number of worker processes, defaults to the number of CPUs")
+    parser.add_argument("--asyncio", action="store_true", help="Run each worker on an asyncio event loop")
+    parser.add_argument("--chat", action="store_true",
+                        help="Relay every message to all other clients, whichever worker they're connected to")
+    parser_args = parser.parse_args()
+
+    server_cls = AsyncWebSocketServer if parser_args.asyncio else WebSocketServer
+
+    with tempfile.TemporaryDirectory(prefix="stevesockets-") as backplane_directory:
+        def build_server():
+            # each worker binds its own backplane socket in the shared directory once it starts listening
+            server = server_cls(address=("127.0.0.1", parser_args.port), logger=logger, reuse_port=True,
+                                backplane=UnixDatagramBackplane(backplane_directory, logger=logger))
+            server.register_listener(CustomListener, message_type=MessageTypes.TEXT)
+            if parser_args.chat:
+                server.register_listener(MessageSynchronizer, message_type=MessageTypes.TEXT)
+            return server
+
+        PreforkSupervisor(build_server, workers=parser_args.workers, logger=logger).run()
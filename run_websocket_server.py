@@ -7,7 +7,9 @@ from stevesockets.websocket import LOGGER_NAME
 from stevesockets.messages import MessageTypes
 from stevesockets.listeners import TextListener
 from stevesockets.websocket.websocket import WebSocketFrame
+from stevesockets.websocket.deflate import PerMessageDeflate
 from stevesockets.websocket.server import WebSocketServer, WebSocketConnection
+from stevesockets.websocket.asyncserver import AsyncWebSocketServer
 
 
 class CustomListener(TextListener):
@@ -20,7 +22,7 @@ class CustomListener(TextListener):
                 **kwargs):
         print(f"Observing incoming message {message}")
         message = f"SteveSockets WebSocketServer has received your message of '{message.message}'!"
-        connection.queue_message(WebSocketFrame.get_text_frame(message).to_bytes())
+        connection.send_frame(WebSocketFrame.get_text_frame(message))
 
 
 if __name__ == "__main__":
@@ -34,9 +36,12 @@ if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
     parser.add_argument("-p", "--port", action="store", default=9000, type=int)
+    parser.add_argument("--asyncio", action="store_true", help="Run the server on an asyncio event loop")
+    parser.add_argument("--compress", action="store_true", help="Offer clients permessage-deflate compression")
     parser_args = parser.parse_args()
 
-    s = WebSocketServer(logger=logger)
+    server_cls = AsyncWebSocketServer if parser_args.asyncio else WebSocketServer
+    s = server_cls(logger=logger, compression=PerMessageDeflate() if parser_args.compress else None)
     s.register_listener(CustomListener, message_type=MessageTypes.TEXT)
 
     s.listen()
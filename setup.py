@@ -18,8 +18,8 @@ setup(
         'Programming Language :: Python :: 3.7'
     ],
     keywords="socket sockets websocket steve",
-    packages=find_packages(exclude=["tests"]),
+    packages=find_packages(exclude=["tests", "tests.*", "benchmarks", "benchmarks.*"]),
     install_requires=[],
-    extras_require={},
+    extras_require={"numpy": ["numpy"]},
     package_data={},
 )
@@ -0,0 +1,240 @@
+from __future__ import annotations
+
+import asyncio
+from stevesockets.server import SocketServer
+from stevesockets.socketconnection import SocketConnection, SocketBytesReader, SlowConsumerPolicy, FileRegion
+
+
+class AsyncConnectionMixin:
+    """ Swaps a connection's socket I/O for an asyncio stream pair. Flushing hands the queued messages to the
+        transport, which buffers whatever the socket can't take yet and counts towards the slow consumer policy. """
+
+    __slots__ = ()
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, address, port, logger=None,
+                 **kwargs):
+        super(AsyncConnectionMixin, self).__init__(writer.get_extra_info("socket"), address, port, logger=logger,
+                                                   **kwargs)
+        self.reader = reader
+        self.writer = writer
+        writer.transport.set_write_buffer_limits(high=self.write_buffer_high, low=self.write_buffer_low)
+
+    def flush_messages(self):
+        if self.messages and not self.writer.is_closing():
+            # the transport can't sendfile from between buffered writes, file regions are read into memory
+            self.writer.writelines(message.read() if type(message) is FileRegion else message
+                                   for message in self.messages)
+        if self.messages:
+            self.messages.clear()
+        if self.producer is not None:
+            # the transport doesn't say when it's drained without awaiting it, so streams are written out in one go
+            if not self.writer.is_closing():
+                self.writer.writelines(self.producer)
+            self.producer = None
+        self.pending_bytes = self.writer.transport.get_write_buffer_size()
+        self._update_reading_paused()
+        return self
+
+    def close(self):
+        self.logger.debug("Closing connection at {addr}:{port}".format(addr=self.address, port=self.port))
+        self.writer.close()
+        self.closed = True
+        if self.on_closing:
+            self.on_closing(self)
+
+
+class AsyncSocketConnection(AsyncConnectionMixin, SocketConnection):
+    __slots__ = ("reader", "writer")
+
+
+class AsyncSocketServer(SocketServer):
+    """ Runs the server on an asyncio event loop instead of a select loop, with a task per client. Listeners whose
+        `observe` is a coroutine are awaited, so they can wait on I/O without holding up other clients, while
+        each client's messages are still dispatched one at a time in the order they arrived. """
+
+    connection_cls = AsyncSocketConnection
+    RECV_SIZE = SocketBytesReader.RECV_SIZE
+
+    def __init__(self, *args, **kwargs):
+        super(AsyncSocketServer, self).__init__(*args, **kwargs)
+        self.loop = None
+        self.async_server = None
+        self.client_tasks = set()
+        self._stopped = None
+        self._timer_task = None
+
+    def listen(self):
+        """ Runs `serve` on a new event loop until `stop_listening` is called """
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            self.logger.warning("Manually interrupting server")
+
+    async def start(self) -> bool:
+        """ Binds the server and starts accepting clients on the running loop, returns whether it could bind. The
+            address is updated with the one actually bound, so port 0 can be used to pick a free port. """
+        self.loop = asyncio.get_running_loop()
+        self._stopped = asyncio.Event()
+        self.logger.debug("Creating socket @ {addr}:{port}".format(addr=self.address[0], port=self.address[1]))
+        try:
+            self.async_server = await asyncio.start_server(self._handle_client, host=self.address[0],
+                                                           port=self.address[1], reuse_address=True,
+                                                           reuse_port=self.reuse_port or None,
+                                                           backlog=self.LISTEN_BACKLOG)
+        except OSError as err:
+            self.logger.error("Couldn't bind to socket: '{msg}'".format(msg=err.args))
+            return False
+        self.address = self.async_server.sockets[0].getsockname()[:2]
+        if self.backplane:
+            self.backplane.start()
+            self.loop.add_reader(self.backplane.fileno(), self._process_backplane)
+        self._timer_task = self.loop.create_task(self._run_timers())
+        self.listening = True
+        self.logger.debug("Listening on socket @ {addr}:{port}".format(addr=self.address[0], port=self.address[1]))
+        return True
+
+    async def serve(self):
+        """ Starts the server (if `start` wasn't already awaited) and serves clients until `stop_listening` """
+        if self.async_server is None and not await self.start():
+            self.logger.warning("Socket not successfully initialized, check logs for details. Aborting serve()")
+            return
+        if self.stop_requested:
+            self._stopped.set()
+        await self._stopped.wait()
+        await self.shutdown()
+
+    async def shutdown(self):
+        """ Stops accepting clients and closes every connection """
+        self.listening = False
+        self.logger.debug("Closing {n} connections".format(n=len(self.connections)))
+        self.async_server.close()
+        self.worker_pool.shutdown()
+        self._timer_task.cancel()
+        tasks = list(self.client_tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await self.async_server.wait_closed()
+        self.async_server = None
+        self.stop_requested = False
+        if self.backplane:
+            self.loop.remove_reader(self.backplane.fileno())
+            self.backplane.close()
+        self.logger.debug("Server done listening")
+
+    def stop_listening(self):
+        """ Same as `SocketServer.stop_listening`, safe to call from any thread """
+        super(AsyncSocketServer, self).stop_listening()
+        if self.loop and self._stopped:
+            try:
+                self.loop.call_soon_threadsafe(self._stopped.set)
+            except RuntimeError:
+                # the loop has already finished
+                pass
+
+    def _create_worker_wakeup(self):
+        # results are handed to the event loop with call_soon_threadsafe instead
+        pass
+
+    def _wake_for_worker_results(self):
+        if self.loop:
+            try:
+                self.loop.call_soon_threadsafe(self._process_worker_results)
+            except RuntimeError:
+                # the loop has already finished
+                pass
+
+    def _process_worker_results(self):
+        self.worker_pool.process_results()
+        self.flush_dirty_connections()
+
+    async def _run_timers(self):
+        while True:
+            # wake up every tick while there are timers waiting to fire
+            await asyncio.sleep(self.timers.tick if self.timers else self.SELECT_TIMEOUT)
+            if self.timers.advance():
+                self.flush_dirty_connections()
+
+    def close_timed_out(self, connection, reason):
+        super(AsyncSocketServer, self).close_timed_out(connection, reason)
+        if not connection.is_closed():
+            # closing the transport sends what's queued first, and ends the connection's pending read
+            connection.flush_messages()
+            connection.close()
+
+    async def setup_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """ Returns the connection for a newly accepted client, or None if it shouldn't be served """
+        address, port = writer.get_extra_info("peername")[:2]
+        connection = self.connection_cls(reader, writer, address, port, logger=self.logger,
+                                         write_buffer_high=self.write_buffer_high,
+                                         write_buffer_low=self.write_buffer_low,
+                                         slow_consumer_policy=self.slow_consumer_policy)
+        connection.on_dirty = self._mark_dirty
+        self._start_idle_timer(connection)
+        self.logger.debug(
+            "New connection created at {addr}:{port}".format(addr=connection.address, port=connection.port))
+        return connection
+
+    async def _handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.client_tasks.add(asyncio.current_task())
+        connection = None
+        try:
+            connection = await self.setup_connection(reader, writer)
+            if connection is None:
+                writer.close()
+                return
+            self.add_connection(connection)
+            self.logger.debug("Total connections: {n}".format(n=len(self.connections)))
+            await self.serve_connection(connection)
+        except asyncio.CancelledError:
+            # the server is shutting down, ending the task normally keeps asyncio from logging every open client
+            pass
+        except (ConnectionError, asyncio.IncompleteReadError) as err:
+            self.logger.warning("Socket error '{err}'".format(err=err))
+        except Exception as err:
+            self.logger.error(f"General error encountered, closing connection. Error: {err}")
+        finally:
+            self.client_tasks.discard(asyncio.current_task())
+            if connection is not None:
+                self.remove_connection(connection)
+                self._connection_removed(connection)
+                if not connection.is_closed():
+                    self._close_connection(connection)
+
+    async def serve_connection(self, connection: SocketConnection):
+        """ Reads from the client and dispatches its messages until either side closes the connection """
+        while self.listening and not connection.is_to_be_closed() and not connection.is_closed():
+            data = await connection.reader.read(self.RECV_SIZE)
+            connection.last_activity = self.timers.clock()
+            if not data:
+                self.logger.warning("Read no data from socket, marking for closing")
+                connection.mark_for_closing()
+                break
+            self.logger.debug(f"Data found @ {connection.address}:{connection.port}")
+            for message in self.messages_from_data(connection, data):
+                await self.on_message_async(connection, message)
+                if connection.is_closed():
+                    return
+            self.flush_dirty_connections()
+            if connection.slow_consumer_policy == SlowConsumerPolicy.PAUSE:
+                # stop reading from a client that isn't keeping up with what's sent to it
+                await connection.writer.drain()
+        if not connection.is_closed():
+            # let whatever was queued before closing (e.g. a response or CLOSE frame) finish sending first
+            connection.flush_messages()
+            await connection.writer.drain()
+
+    def messages_from_data(self, connection: SocketConnection, data: bytes) -> list:
+        """ Returns the messages to dispatch from data just read off a connection, the asyncio counterpart of
+            `read_messages`. By default everything read at once is a single message. """
+        return [data]
+
+    async def on_message_async(self, connection, message):
+        self.logger.debug("Handling message {r}".format(r=message))
+        await self.message_manager.dispatch_message_async(
+            message,
+            message_type=self.get_message_type(message),
+            connection=connection,
+            server=self
+        )
+        self.flush_dirty_connections()
@@ -0,0 +1,147 @@
+from __future__ import annotations
+
+import logging
+import os
+import socket
+import struct
+import time
+
+
+class Backplane:
+    """ Relays broadcasts between server processes serving the same clients (e.g. prefork workers) so a broadcast
+        in one process also reaches the clients connected to the others. A server publishes the already encoded
+        bytes it broadcast and delivers whatever `receive` returns to its own clients without relaying it again.
+
+        Implementations are polled by the server's event loop: `fileno` has to become readable when there are
+        messages to `receive`. """
+
+    def start(self):
+        """ Called by the server once it starts listening """
+        pass
+
+    def fileno(self) -> int:
+        raise NotImplementedError
+
+    def publish(self, channel: str | None, data: bytes):
+        """ Sends `data` to every other process, `channel` None meaning a broadcast to every client """
+        raise NotImplementedError
+
+    def receive(self) -> list:
+        """ Returns the (channel, data) messages other processes published since the last call """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class UnixDatagramBackplane(Backplane):
+    """ Backplane between processes on the same machine: each binds a Unix datagram socket in the shared `directory`
+        and publishing sends a datagram to every other socket found there. Delivery is best effort, a message is
+        dropped for a peer whose receive buffer is full or if it's bigger than the system allows a datagram to be
+        (usually a couple hundred KB). """
+
+    # how long the list of peers found in the directory is reused before it's listed again
+    PEER_REFRESH_INTERVAL = 1
+    SOCKET_SUFFIX = ".sock"
+    RECV_SIZE = 2 ** 20
+
+    # a message is a flag byte, then for channel messages the channel's (utf-8) length and the channel itself,
+    # followed by the encoded data
+    BROADCAST = b"\x00"
+    CHANNEL = b"\x01"
+    CHANNEL_LENGTH = struct.Struct("!H")
+
+    def __init__(self, directory, name=None, logger=None):
+        self.directory = directory
+        self.name = name
+        self.logger = logger if logger else logging.getLogger()
+        self.path = None
+        self.socket = None
+        self.peers = []
+        self.peers_listed = 0
+
+    def start(self):
+        # named after the process by default, so each prefork worker gets its own socket once it's forked
+        name = self.name if self.name else str(os.getpid())
+        self.path = os.path.join(self.directory, name + self.SOCKET_SUFFIX)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.socket.bind(self.path)
+        self.socket.setblocking(False)
+        self.peers_listed = 0
+
+    def fileno(self) -> int:
+        return self.socket.fileno()
+
+    def _get_peers(self) -> list:
+        if time.monotonic() - self.peers_listed > self.PEER_REFRESH_INTERVAL:
+            self.peers = [
+                os.path.join(self.directory, entry) for entry in os.listdir(self.directory)
+                if entry.endswith(self.SOCKET_SUFFIX) and os.path.join(self.directory, entry) != self.path
+            ]
+            self.peers_listed = time.monotonic()
+        return self.peers
+
+    @classmethod
+    def encode(cls, channel, data) -> list:
+        if channel is None:
+            return [cls.BROADCAST, data]
+        channel = channel.encode()
+        return [cls.CHANNEL + cls.CHANNEL_LENGTH.pack(len(channel)) + channel, data]
+
+    @classmethod
+    def decode(cls, message: bytes) -> tuple:
+        if message[:1] == cls.BROADCAST:
+            return None, message[1:]
+        length, = cls.CHANNEL_LENGTH.unpack_from(message, 1)
+        start = 1 + cls.CHANNEL_LENGTH.size
+        return message[start:start + length].decode(), message[start + length:]
+
+    def publish(self, channel, data):
+        buffers = self.encode(channel, data)
+        # a copy, peers that are gone are removed from the list while it's walked
+        for peer in list(self._get_peers()):
+            try:
+                self.socket.sendmsg(buffers, [], 0, peer)
+            except FileNotFoundError:
+                # the peer process closed its socket, stop sending to it until the directory is listed again
+                self.peers.remove(peer)
+            except ConnectionRefusedError:
+                # nothing is bound to the socket file any more, a process that was killed before it could remove it
+                self.peers.remove(peer)
+                self._remove_stale_peer(peer)
+            except BlockingIOError:
+                self.logger.warning("Backplane peer {peer} isn't keeping up, dropping message".format(peer=peer))
+            except OSError as err:
+                self.logger.error("Couldn't relay message to {peer}: '{err}'".format(peer=peer, err=err))
+
+    def _remove_stale_peer(self, peer):
+        self.logger.debug("Removing stale backplane socket {peer}".format(peer=peer))
+        try:
+            os.unlink(peer)
+        except FileNotFoundError:
+            # another process got to it first
+            pass
+        except OSError as err:
+            self.logger.warning("Couldn't remove stale backplane socket {peer}: '{err}'".format(peer=peer, err=err))
+
+    def receive(self) -> list:
+        messages = []
+        while True:
+            try:
+                message = self.socket.recv(self.RECV_SIZE)
+            except (BlockingIOError, InterruptedError):
+                break
+            try:
+                messages.append(self.decode(message))
+            except (struct.error, UnicodeDecodeError):
+                self.logger.warning("Dropping malformed backplane message")
+        return messages
+
+    def close(self):
+        if self.socket:
+            self.socket.close()
+            self.socket = None
+        if self.path and os.path.exists(self.path):
+            os.unlink(self.path)
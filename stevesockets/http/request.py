@@ -0,0 +1,310 @@
+from __future__ import annotations
+import re
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from stevesockets.websocket.websocket import SocketException
+
+# characters allowed in methods and header names (RFC 9110 tokens)
+TOKEN = re.compile(r"[!#$%&'*+\-.^_`|~0-9A-Za-z]+")
+HEX = re.compile(rb"[0-9A-Fa-f]+")
+HTTP_VERSIONS = ("HTTP/1.1", "HTTP/1.0")
+HEAD_END = b"\r\n\r\n"
+CRLF = b"\r\n"
+
+
+class HttpParseError(SocketException):
+    """ A request that can't be parsed, answered with `status` before the connection is closed """
+
+    def __init__(self, message, status=400):
+        super(HttpParseError, self).__init__(message)
+        self.status = status
+
+
+class Headers:
+    """ Case-insensitive multidict of header fields. Repeated fields keep every value in the order they arrived,
+        indexing returns the first. """
+
+    __slots__ = ("fields", "index")
+
+    def __init__(self, fields=None):
+        # (name, value) pairs as they were received
+        self.fields = []
+        # lowercase name -> its values
+        self.index = {}
+        for name, value in fields or ():
+            self.add(name, value)
+
+    def add(self, name, value):
+        self.fields.append((name, value))
+        self.index.setdefault(name.lower(), []).append(value)
+
+    def get(self, name, default=None):
+        values = self.index.get(name.lower())
+        return values[0] if values else default
+
+    def get_all(self, name) -> list:
+        return list(self.index.get(name.lower(), ()))
+
+    def get_tokens(self, name) -> list:
+        """ The comma separated, lowercased tokens of every `name` field, e.g. of `Connection` """
+        return [token.strip().lower() for value in self.index.get(name.lower(), ()) for token in value.split(",")
+                if token.strip()]
+
+    def items(self) -> list:
+        return list(self.fields)
+
+    def __getitem__(self, name):
+        values = self.index.get(name.lower())
+        if not values:
+            raise KeyError(name)
+        return values[0]
+
+    def __contains__(self, name):
+        return name.lower() in self.index
+
+    def __iter__(self):
+        return iter(self.fields)
+
+    def __len__(self):
+        return len(self.fields)
+
+    def __repr__(self):
+        return f"Headers({self.fields!r})"
+
+
+class HttpRequest:
+    """ A parsed request. `path` is percent-decoded, `query` is the raw query string (see `args`), and header values
+        are decoded as latin-1. `params` holds the values matched by the route's pattern, see Router. """
+
+    __slots__ = ("method", "target", "path", "query", "version", "headers", "body", "params")
+
+    def __init__(self, method="GET", target="/", version="HTTP/1.1", headers=None, body=b""):
+        self.method = method
+        self.target = target
+        self.version = version
+        self.headers = headers if headers is not None else Headers()
+        self.body = body
+        self.params = {}
+        if target.startswith("/") or target == "*":
+            path, _, self.query = target.partition("?")
+        else:
+            # absolute-form, sent to proxies
+            split = urlsplit(target)
+            path, self.query = split.path or "/", split.query
+        self.path = unquote(path)
+
+    @property
+    def args(self) -> dict:
+        """ The query string's parameters, each mapped to the list of its values """
+        return parse_qs(self.query, keep_blank_values=True)
+
+    @property
+    def keep_alive(self) -> bool:
+        """ Whether the connection stays open after answering, going by the `Connection` header and the default for
+            the request's HTTP version """
+        tokens = self.headers.get_tokens("connection") if "connection" in self.headers.index else ()
+        if "close" in tokens:
+            return False
+        return self.version != "HTTP/1.0" or "keep-alive" in tokens
+
+    @property
+    def expects_continue(self) -> bool:
+        return self.headers.get("expect", "").lower() == "100-continue"
+
+    def __repr__(self):
+        return f"<HttpRequest {self.method} {self.target} {self.version}>"
+
+
+class HttpRequestParser:
+    """ Incrementally parses requests out of whatever bytes have arrived on a connection. `feed` never blocks; it
+        returns every request completed by the new data (pipelined requests included) and keeps a partial request
+        until more bytes are fed. Bodies are read by `Content-Length` or chunked transfer coding.
+
+        Raises HttpParseError for malformed requests, heads over `max_header_size` bytes (431) and bodies over
+        `max_body_size` bytes (413). Each byte is scanned once, so parsing stays linear however the request is split
+        across reads. """
+
+    __slots__ = ("buffer", "state", "request", "needed", "scanned", "body", "max_header_size", "max_body_size",
+                 "continue_sent")
+
+    READING_HEAD = "head"
+    READING_BODY = "body"
+    READING_CHUNK_SIZE = "chunk size"
+    READING_CHUNK = "chunk"
+    READING_CHUNK_END = "chunk end"
+    READING_TRAILERS = "trailers"
+
+    MAX_HEADER_SIZE = 2 ** 16
+    MAX_BODY_SIZE = 2 ** 24
+    # longest chunk size line accepted, chunk extensions included
+    MAX_CHUNK_LINE = 1024
+
+    def __init__(self, max_header_size=None, max_body_size=None):
+        self.buffer = bytearray()
+        self.max_header_size = max_header_size if max_header_size else self.MAX_HEADER_SIZE
+        self.max_body_size = max_body_size if max_body_size else self.MAX_BODY_SIZE
+        self.reset()
+
+    def reset(self):
+        """ Gets ready to read the head of the next request """
+        self.state = HttpRequestParser.READING_HEAD
+        # the request whose body is being read
+        self.request = None
+        self.needed = 0
+        # where to resume looking for the end of the head (or of a line), as an offset into the buffer
+        self.scanned = 0
+        self.body = None
+        # whether the current request has been answered with `100 Continue`, see expecting_continue
+        self.continue_sent = False
+
+    def feed(self, data) -> list[HttpRequest]:
+        self.buffer += data
+        requests = []
+        position = 0
+        try:
+            while True:
+                consumed = self._consume(position)
+                if consumed is None:
+                    break
+                position = consumed
+                if self.state == self.READING_BODY and not self.needed:
+                    requests.append(self._finish())
+        finally:
+            del self.buffer[:position]
+            self.scanned = max(self.scanned - position, 0)
+        return requests
+
+    def _consume(self, position) -> int | None:
+        """ Handles what's buffered from `position` for the current state, returning the position it read up to, or
+            None if more bytes are needed """
+        buffer = self.buffer
+        if self.state == self.READING_HEAD:
+            # empty lines before a request line are ignored
+            while buffer.startswith(CRLF, position):
+                position += 2
+            end = buffer.find(HEAD_END, max(position, self.scanned))
+            if end == -1:
+                if len(buffer) - position > self.max_header_size:
+                    raise HttpParseError("Request head too large", status=431)
+                self.scanned = max(position, len(buffer) - len(HEAD_END) + 1)
+                return None
+            if end - position > self.max_header_size:
+                raise HttpParseError("Request head too large", status=431)
+            self.request = self.parse_head(bytes(buffer[position:end]))
+            self.scanned = 0
+            self._start_body()
+            return end + len(HEAD_END)
+
+        if self.state == self.READING_BODY or self.state == self.READING_CHUNK:
+            available = len(buffer) - position
+            if not available:
+                return None
+            count = min(available, self.needed)
+            with memoryview(buffer)[position:position + count] as chunk:
+                self.body += chunk
+            self.needed -= count
+            if self.state == self.READING_CHUNK and not self.needed:
+                self.state, self.needed = self.READING_CHUNK_END, 2
+            return position + count
+
+        if self.state == self.READING_CHUNK_END:
+            if len(buffer) - position < 2:
+                return None
+            if not buffer.startswith(CRLF, position):
+                raise HttpParseError("Chunk not followed by CRLF")
+            self.state, self.needed = self.READING_CHUNK_SIZE, 0
+            return position + 2
+
+        # chunk size and trailer lines
+        end = buffer.find(CRLF, max(position, self.scanned))
+        if end == -1:
+            limit = self.MAX_CHUNK_LINE if self.state == self.READING_CHUNK_SIZE else self.max_header_size
+            if len(buffer) - position > limit:
+                raise HttpParseError("Chunk size line too long")
+            self.scanned = max(position, len(buffer) - 1)
+            return None
+        self.scanned = 0
+        line = bytes(buffer[position:end])
+        if self.state == self.READING_CHUNK_SIZE:
+            self._start_chunk(line)
+        elif not line:
+            # the request is done once the trailer fields (read past, not kept) end with an empty line
+            self.state = self.READING_BODY
+        return end + len(CRLF)
+
+    def _start_body(self):
+        headers = self.request.headers
+        self.body = bytearray()
+        self.state = self.READING_BODY
+        if "transfer-encoding" not in headers.index and "content-length" not in headers.index:
+            # most requests have no body
+            return
+        transfer_encoding = headers.get_tokens("transfer-encoding")
+        if transfer_encoding:
+            if "content-length" in headers:
+                # a request framed both ways could be read differently by a proxy in front of the server
+                raise HttpParseError("Both Transfer-Encoding and Content-Length sent")
+            if transfer_encoding != ["chunked"]:
+                raise HttpParseError(f"Unsupported transfer coding '{', '.join(transfer_encoding)}'", status=501)
+            self.state = self.READING_CHUNK_SIZE
+            return
+        lengths = set(headers.get_tokens("content-length"))
+        # isdigit alone would let through non-ASCII digits such as '²', which int() rejects
+        if len(lengths) > 1 or not all(length.isascii() and length.isdigit() for length in lengths):
+            raise HttpParseError("Invalid Content-Length")
+        length = int(lengths.pop()) if lengths else 0
+        if length > self.max_body_size:
+            raise HttpParseError("Request body too large", status=413)
+        self.needed = length
+
+    def _start_chunk(self, line):
+        size = line.split(b";", 1)[0].strip(b" \t")
+        if not HEX.fullmatch(size):
+            raise HttpParseError("Invalid chunk size")
+        size = int(size, 16)
+        if len(self.body) + size > self.max_body_size:
+            raise HttpParseError("Request body too large", status=413)
+        if size:
+            self.state, self.needed = self.READING_CHUNK, size
+        else:
+            self.state = self.READING_TRAILERS
+
+    def _finish(self) -> HttpRequest:
+        request = self.request
+        request.body = bytes(self.body)
+        self.reset()
+        return request
+
+    @property
+    def expecting_continue(self) -> bool:
+        """ Whether an HTTP/1.1 request's head has arrived asking for `100 Continue` before its body is sent, and it
+            hasn't been sent yet (the caller sets `continue_sent` once it has). HTTP/1.0 clients mustn't be sent
+            one. """
+        return (self.request is not None and not self.continue_sent and self.request.version == "HTTP/1.1"
+                and self.request.expects_continue and not self.body
+                and (self.state != self.READING_BODY or bool(self.needed)))
+
+    @staticmethod
+    def parse_head(head: bytes) -> HttpRequest:
+        # latin-1 maps every byte to a character, so this can't fail and the checks below see the raw bytes
+        request_line, *lines = head.decode("latin-1").split("\r\n")
+        parts = request_line.split(" ")
+        if len(parts) != 3 or not TOKEN.fullmatch(parts[0]) or not parts[1]:
+            raise HttpParseError("Malformed request line")
+        method, target, version = parts
+        if version not in HTTP_VERSIONS:
+            if version.startswith("HTTP/"):
+                raise HttpParseError(f"Unsupported HTTP version '{version}'", status=505)
+            raise HttpParseError("Malformed request line")
+        headers = Headers()
+        for line in lines:
+            name, separator, value = line.partition(":")
+            # obsolete line folding starts with whitespace, which also fails the token check
+            if not separator or not TOKEN.fullmatch(name):
+                raise HttpParseError("Malformed header field")
+            headers.add(name, value.strip(" \t"))
+        try:
+            return HttpRequest(method, target, version, headers)
+        except ValueError:
+            # an absolute-form target urlsplit can't make sense of, e.g. an unclosed IPv6 host
+            raise HttpParseError("Malformed request target")
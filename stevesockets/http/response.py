@@ -0,0 +1,112 @@
+from __future__ import annotations
+from http import HTTPStatus
+
+from stevesockets.http.request import Headers, HttpRequest, TOKEN
+
+# status code -> encoded status line, filled in for every registered status up front and for others when first used
+STATUS_LINES = {status.value: f"HTTP/1.1 {status.value} {status.phrase}\r\n".encode() for status in HTTPStatus}
+CRLF = b"\r\n"
+LAST_CHUNK = b"0\r\n\r\n"
+
+
+def get_status_line(status) -> bytes:
+    line = STATUS_LINES.get(status)
+    if line is None:
+        if not 100 <= status <= 999:
+            raise ValueError(f"Invalid status code {status}")
+        line = STATUS_LINES[status] = f"HTTP/1.1 {status} \r\n".encode()
+    return line
+
+
+class HttpResponse:
+    """ A response to send with `send`. The body can be bytes, a str (encoded as UTF-8) or an iterable (e.g. a
+        generator) of bytes or str chunks. A bytes body is sent with a `Content-Length`, an iterable one is streamed
+        with `Transfer-Encoding: chunked`, each chunk taken from it only once the client has read what came before
+        (see SocketConnection.set_producer), so large bodies are never held in memory at once.
+
+        `headers` can be a dict, a list of (name, value) pairs or Headers. """
+
+    __slots__ = ("status", "headers", "body")
+
+    def __init__(self, body=b"", status=200, headers=None, content_type=None):
+        self.status = status
+        self.headers = headers if isinstance(headers, Headers) else Headers(
+            headers.items() if isinstance(headers, dict) else headers)
+        if content_type is not None:
+            self.headers.add("Content-Type", content_type)
+        self.body = body.encode() if isinstance(body, str) else body
+
+    def is_streamed(self) -> bool:
+        return not isinstance(self.body, (bytes, bytearray, memoryview))
+
+    def has_body(self) -> bool:
+        """ Whether the status allows a body (and so a Content-Length or Transfer-Encoding) """
+        return self.status >= 200 and self.status not in (204, 304)
+
+    def encode_head(self, framing=None) -> bytes:
+        """ The status line and headers, with the `framing` header (Content-Length or Transfer-Encoding) if given.
+            Raises ValueError for a header that can't be sent as is: a name that isn't a token, or a value with a line
+            break or characters outside latin-1. """
+        lines = [get_status_line(self.status)]
+        for name, value in self.headers:
+            value = str(value)
+            if not TOKEN.fullmatch(name):
+                raise ValueError(f"Invalid header name '{name}'")
+            if "\r" in value or "\n" in value:
+                raise ValueError(f"Line break in the value of header '{name}'")
+            try:
+                lines.append(f"{name}: {value}\r\n".encode("latin-1"))
+            except UnicodeEncodeError:
+                raise ValueError(f"Value of header '{name}' isn't latin-1")
+        if framing:
+            lines.append(framing)
+        lines.append(b"\r\n")
+        return b"".join(lines)
+
+    def to_bytes(self) -> bytes:
+        """ The whole response, for bodies that aren't streamed """
+        if not self.has_body():
+            return self.encode_head()
+        return self.encode_head(b"Content-Length: %d\r\n" % len(self.body)) + self.body
+
+    def send(self, connection, request: HttpRequest = None):
+        """ Queues the response on `connection`, answering `request` if given: a HEAD request gets only the head, and
+            an HTTP/1.0 client (which can't read chunked bodies) gets a streamed body as is and the connection
+            closed after it. A streamed body with a `Content-Length` header set is sent as is too. """
+        head_only = request is not None and request.method == "HEAD"
+        if not self.has_body():
+            connection.queue_message(self.encode_head())
+            return
+        if not self.is_streamed():
+            # queued separately so sendmsg gathers the body without it being copied onto the head
+            connection.queue_message(self.encode_head(b"Content-Length: %d\r\n" % len(self.body)))
+            if self.body and not head_only:
+                connection.queue_message(self.body)
+            return
+        if "content-length" in self.headers or (request is not None and request.version == "HTTP/1.0"):
+            # a body of known length is streamed as is, as is one to an HTTP/1.0 client
+            connection.queue_message(self.encode_head())
+            if not head_only:
+                connection.set_producer(chunk.encode() if isinstance(chunk, str) else chunk for chunk in self.body)
+            if "content-length" not in self.headers:
+                # the end of the body is the end of the connection
+                connection.mark_for_closing()
+            return
+        connection.queue_message(self.encode_head(b"Transfer-Encoding: chunked\r\n"))
+        if not head_only:
+            connection.set_producer(self.chunks())
+
+    def chunks(self):
+        """ The body in chunked transfer coding """
+        for chunk in self.body:
+            if isinstance(chunk, str):
+                chunk = chunk.encode()
+            if chunk:
+                # separate buffers, so the chunk itself isn't copied before it's sent
+                yield b"%x\r\n" % len(chunk)
+                yield chunk
+                yield CRLF
+        yield LAST_CHUNK
+
+    def __repr__(self):
+        return f"<HttpResponse {self.status}>"
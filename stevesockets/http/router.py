@@ -0,0 +1,139 @@
+from __future__ import annotations
+import re
+
+from stevesockets.http.request import HttpRequest
+from stevesockets.http.response import HttpResponse
+from stevesockets.messages import Listener
+
+# a path segment that's a parameter: {name}, or {name:path} to match the rest of the path, slashes included
+PARAMETER = re.compile(r"{(?P<name>[A-Za-z_][A-Za-z0-9_]*)(?::(?P<kind>path))?}")
+
+
+class RouteNode:
+    """ One path segment in the Router's trie """
+
+    __slots__ = ("children", "parameter", "routes", "rest_routes")
+
+    def __init__(self):
+        # literal segment -> node
+        self.children = {}
+        # node for a {name} segment, matching any one segment
+        self.parameter = None
+        # method -> (handler, parameter names) for routes ending at this node
+        self.routes = {}
+        # method -> (handler, parameter names) for routes ending in a {name:path} here
+        self.rest_routes = {}
+
+
+class Router(Listener):
+    """ Dispatches HTTP requests to handlers by method and path pattern, e.g. `/rooms/{id}/members`. Patterns are
+        stored in a trie of path segments as they're added, so finding a request's handler walks its path once,
+        however many routes there are. Literal segments are preferred over parameters.
+
+        Handlers are called with the request (its `params` holding the values matched by the pattern) and the
+        `connection` and `server` keywords; an HttpResponse they return is sent as the answer to the request, and
+        bytes are queued as they are. A handler that raises is answered with 500 and its connection closed.
+        Requests no route matches are answered with 404, or with 405 if the path matches but the method doesn't. """
+
+    def __init__(self):
+        super(Router, self).__init__()
+        self.root = RouteNode()
+
+    def add_route(self, method, pattern, handler):
+        if not pattern.startswith("/"):
+            raise ValueError(f"Route pattern '{pattern}' must start with '/'")
+        node, names = self.root, []
+        segments = pattern.split("/")[1:]
+        for i, segment in enumerate(segments):
+            parameter = PARAMETER.fullmatch(segment)
+            if parameter is None:
+                if "{" in segment or "}" in segment:
+                    raise ValueError(f"Invalid segment '{segment}' in route pattern '{pattern}'")
+                node = node.children.setdefault(segment, RouteNode())
+                continue
+            names.append(parameter.group("name"))
+            if parameter.group("kind") == "path":
+                if i != len(segments) - 1:
+                    raise ValueError(f"'{segment}' has to be the last segment of route pattern '{pattern}'")
+                self._add_handler(node.rest_routes, method, pattern, handler, names)
+                return
+            if node.parameter is None:
+                node.parameter = RouteNode()
+            node = node.parameter
+        self._add_handler(node.routes, method, pattern, handler, names)
+
+    @staticmethod
+    def _add_handler(routes, method, pattern, handler, names):
+        method = method.upper()
+        if method in routes:
+            raise ValueError(f"A {method} route for '{pattern}' is already registered")
+        routes[method] = (handler, tuple(names))
+
+    def route(self, pattern, methods=("GET",)):
+        """ Decorator registering a handler for `pattern` """
+        def decorator(handler):
+            for method in methods:
+                self.add_route(method, pattern, handler)
+            return handler
+        return decorator
+
+    def match(self, method, path) -> tuple[callable, dict] | None:
+        """ Returns the handler for a request and the values of its pattern's parameters, or None if no route
+            matches """
+        found = self._find(self.root, path.split("/")[1:], 0, [], method.upper())
+        if found is None:
+            return None
+        (handler, names), values = found
+        return handler, dict(zip(names, values))
+
+    def allowed_methods(self, path) -> list:
+        """ The methods routed for `path` """
+        found = self._find(self.root, path.split("/")[1:], 0, [], None)
+        return sorted(found[0]) if found else []
+
+    def _find(self, node, segments, i, values, method):
+        """ Walks the trie from `node` for `segments[i:]`, returning the route (or with no `method`, every route)
+            found and the parameter values on the way. Only backtracks when a literal segment leads to a dead end
+            that a parameter wouldn't. """
+        if i == len(segments):
+            routes = node.routes
+        else:
+            child = node.children.get(segments[i])
+            if child is not None:
+                found = self._find(child, segments, i + 1, values, method)
+                if found is not None:
+                    return found
+            if node.parameter is not None and segments[i]:
+                values.append(segments[i])
+                found = self._find(node.parameter, segments, i + 1, values, method)
+                if found is not None:
+                    return found
+                values.pop()
+            routes = node.rest_routes
+            if routes:
+                values = values + ["/".join(segments[i:])]
+        if method is None:
+            return (routes, values) if routes else None
+        return (routes[method], values) if method in routes else None
+
+    def observe(self, message: HttpRequest, *args, connection=None, server=None, **kwargs):
+        match = self.match(message.method, message.path)
+        if match is None:
+            allowed = self.allowed_methods(message.path)
+            if allowed:
+                server.send_response(connection, 405, headers={"Allow": ", ".join(allowed)})
+            else:
+                server.send_response(connection, 404)
+            return
+        handler, message.params = match
+        try:
+            response = handler(message, connection=connection, server=server)
+            if isinstance(response, HttpResponse):
+                # raises ValueError before queueing anything if the handler set a header that can't be sent
+                response.send(connection, message)
+            elif response is not None:
+                connection.queue_message(response)
+        except Exception as err:
+            # a bug in one handler fails its request, not the whole server
+            server.logger.error(f"Handler for {message.method} {message.path} failed: {err!r}")
+            server.send_error(connection, 500)
@@ -1,26 +1,164 @@
+import collections
+import selectors
+
+from stevesockets.http.request import HttpRequest, HttpRequestParser, HttpParseError
+from stevesockets.http.response import HttpResponse
+from stevesockets.http.router import Router
 from stevesockets.server import SocketServer
-from stevesockets.server import SocketBytesReader
+from stevesockets.socketconnection import SocketConnection
+
+
+class HttpConnection(SocketConnection):
+
+    __slots__ = ("request_parser", "pending_requests")
+
+    def __init__(self, sck, address="127.0.0.1", port=9000, logger=None, **kwargs):
+        super(HttpConnection, self).__init__(sck, address=address, port=port, logger=logger, **kwargs)
+        self.request_parser = HttpRequestParser()
+        # pipelined requests held back until the response streaming ahead of them is done, created when first needed
+        self.pending_requests = None
 
 
 class HttpServer(SocketServer):
-    def connection_handler(self, conn):
-        bytes_reader = SocketBytesReader(conn)
+    """ Serves HTTP/1.x over persistent connections, handing listeners parsed HttpRequests. HTTP/1.1 connections are
+        kept open unless a request says `Connection: close`, HTTP/1.0 ones only if it says `Connection: keep-alive`.
+        Pipelined requests that arrive together are dispatched in the order they were sent, so listeners answering
+        inline answer them in order, and ones arriving while a response is streamed (see HttpResponse) are held back
+        until it's done. Responses have to be framed (with `Content-Length` or chunked) for a client to reuse the
+        connection. """
+
+    connection_cls = HttpConnection
+    # seconds a persistent connection can wait for its next complete request before it's closed
+    KEEP_ALIVE_TIMEOUT = 5
+    # largest request head and body accepted, larger requests are answered with 431 and 413
+    MAX_HEADER_SIZE = HttpRequestParser.MAX_HEADER_SIZE
+    MAX_BODY_SIZE = HttpRequestParser.MAX_BODY_SIZE
+    CONTINUE_RESPONSE = b"HTTP/1.1 100 Continue\r\n\r\n"
+
+    def __init__(self, address=('127.0.0.1', 9000), logger=None, keep_alive_timeout=None, max_header_size=None,
+                 max_body_size=None, router=None, **kwargs):
+        super(HttpServer, self).__init__(address=address, logger=logger, **kwargs)
+        self.keep_alive_timeout = keep_alive_timeout if keep_alive_timeout else self.KEEP_ALIVE_TIMEOUT
+        self.max_header_size = max_header_size if max_header_size else self.MAX_HEADER_SIZE
+        self.max_body_size = max_body_size if max_body_size else self.MAX_BODY_SIZE
+        # dispatches requests to handlers by method and path, created by the first `route` if not given
+        self.router = None
+        if router is not None:
+            self.set_router(router)
+
+    def set_router(self, router: Router):
+        self.router = router
+        self.message_manager.listen_for_message(router)
+
+    def route(self, pattern, methods=("GET",)):
+        """ Decorator registering a handler with the server's Router, see Router.route """
+        if self.router is None:
+            self.set_router(Router())
+        return self.router.route(pattern, methods=methods)
+
+    def _get_client_connection(self):
+        conn = super(HttpServer, self)._get_client_connection()
+        conn.request_parser.max_header_size = self.max_header_size
+        conn.request_parser.max_body_size = self.max_body_size
+        return conn
+
+    def _register_connection(self, connection: SocketConnection):
+        super(HttpServer, self)._register_connection(connection)
+        if self.selector and not connection.is_closed():
+            # a client that connects and never sends a request is closed like an idle persistent connection
+            self._start_keep_alive_timer(connection)
 
+    def connection_handler(self, conn) -> list[HttpRequest]:
+        """ Reads what's arrived (at most once, so a client that stalls partway through a request never blocks the
+            server) and returns every request it completed, in the order they were sent """
         self.logger.debug("HTTP server handling incoming data")
         try:
-            bit = bytes_reader.get_next_bytes(2)
-            chunk = bit
-            # while we're getting data, or we're _not_ getting data but we don't have any to process
-            while chunk and not chunk.endswith(b'\r\n\r\n'):
-                bit = bytes_reader.get_next_bytes(16)
-                chunk += bit
-            http_in = chunk
+            data_in = conn.bytes_reader.read_available()
         except ConnectionResetError:
             self.logger.warning("Connection closed prematurely, marking for closing")
             conn.mark_for_closing()
-            return None
+            return []
 
-        if not http_in:
+        if data_in is None:
+            return []
+        if not data_in:
             self.logger.warning("Read no data from socket, marking for closing")
             conn.mark_for_closing()
-        return http_in
+            return []
+
+        try:
+            requests = conn.request_parser.feed(data_in)
+        except HttpParseError as err:
+            self.logger.warning(f"Malformed request received, closing connection: {err}")
+            self.send_error(conn, err.status)
+            return []
+        return requests
+
+    def read_messages(self, conn) -> list[HttpRequest]:
+        """ Returns every request completed by what's arrived. Requests pipelined after one that closes the connection
+            are dropped, the client can't expect an answer to them. """
+        requests = self.connection_handler(conn)
+        for i, request in enumerate(requests):
+            if not request.keep_alive:
+                return requests[:i + 1]
+        return requests
+
+    @staticmethod
+    def send_response(conn, status, headers=None, body=b""):
+        HttpResponse(body, status=status, headers=headers).send(conn)
+
+    def send_error(self, conn, status):
+        """ Answers a request that couldn't be handled and closes the connection once the answer is sent """
+        self.send_response(conn, status, headers={"Connection": "close"})
+        conn.mark_for_closing()
+
+    def on_message(self, connection, response):
+        if connection.producer is not None:
+            # a response is still streaming, this one's answer would end up in the middle of it
+            if connection.pending_requests is None:
+                connection.pending_requests = collections.deque()
+            connection.pending_requests.append(response)
+            return
+        super(HttpServer, self).on_message(connection, response)
+        if not response.keep_alive:
+            # closed once the response has been sent, see prune_peer_connections
+            connection.mark_for_closing()
+        elif not connection.is_to_be_closed():
+            self._start_keep_alive_timer(connection)
+
+    def _handle_connection_event(self, connection: SocketConnection, events=selectors.EVENT_READ):
+        super(HttpServer, self)._handle_connection_event(connection, events=events)
+        if events & selectors.EVENT_READ:
+            self._send_continue(connection)
+
+    def _flush_connection(self, connection: SocketConnection):
+        super(HttpServer, self)._flush_connection(connection)
+        while connection.pending_requests and connection.producer is None and not connection.is_closed():
+            # the stream ahead of them has been produced, their answers can be queued after it
+            self.on_message(connection, connection.pending_requests.popleft())
+        self._send_continue(connection)
+
+    def _send_continue(self, connection: SocketConnection):
+        """ Sends `100 Continue` to a client waiting for it before sending a request's body, once the answers to the
+            requests pipelined before that one have been queued (so it isn't while a response is streaming) """
+        if (connection.request_parser.expecting_continue and connection.producer is None
+                and not connection.pending_requests and not connection.is_to_be_closed()):
+            connection.queue_message(self.CONTINUE_RESPONSE)
+            connection.request_parser.continue_sent = True
+
+    def _start_keep_alive_timer(self, connection: SocketConnection):
+        self.schedule_connection_timer(connection, "keep_alive", self.keep_alive_timeout, self._keep_alive_expired)
+
+    def _keep_alive_expired(self, connection: SocketConnection):
+        if connection.is_to_be_closed() or connection.is_closed():
+            return
+        idle = self.timers.clock() - connection.last_activity
+        if connection.has_pending_output():
+            # still sending the last response, the connection isn't idle yet
+            self._start_keep_alive_timer(connection)
+        elif connection.request_parser.request is not None and idle < self.keep_alive_timeout:
+            # a request body is still arriving
+            self.schedule_connection_timer(connection, "keep_alive", self.keep_alive_timeout - idle,
+                                           self._keep_alive_expired)
+        else:
+            self.close_timed_out(connection, "Keep-alive connection idle")
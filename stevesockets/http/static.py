@@ -0,0 +1,191 @@
+from __future__ import annotations
+import collections
+import email.utils
+import mimetypes
+import os
+import re
+import stat
+import time
+
+from stevesockets.http.request import HttpRequest
+
+BYTE_RANGE = re.compile(r"bytes\s*=\s*(?P<first>\d*)\s*-\s*(?P<last>\d*)", re.IGNORECASE)
+
+
+class OpenFile:
+    """ A read-only file descriptor that's closed once nothing refers to it, so a file evicted from the cache stays
+        open until the responses still sending it are done """
+
+    __slots__ = ("fd",)
+
+    def __init__(self, path):
+        self.fd = os.open(path, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+
+    def fileno(self):
+        return self.fd
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def __del__(self):
+        self.close()
+
+
+class CachedFile:
+    """ An open file and the response heads worked out from one `stat` of it """
+
+    __slots__ = ("file", "size", "mtime", "identity", "etag", "headers", "ok_head", "not_modified", "checked_at")
+
+    def __init__(self, file: OpenFile, status: os.stat_result, content_type, cache_control=None):
+        self.file = file
+        self.size = status.st_size
+        self.mtime = int(status.st_mtime)
+        # a file replaced by one with the same size and mtime is still noticed by its inode
+        self.identity = (status.st_ino, status.st_mtime_ns, status.st_size)
+        self.etag = f'"{status.st_mtime_ns:x}-{status.st_size:x}"'
+        validators = f"ETag: {self.etag}\r\nLast-Modified: {email.utils.formatdate(status.st_mtime, usegmt=True)}\r\n"
+        if cache_control:
+            validators += f"Cache-Control: {cache_control}\r\n"
+        # the headers of every 200 or 206 response, then the whole head of a 200 and the whole 304 response
+        self.headers = f"Content-Type: {content_type}\r\nAccept-Ranges: bytes\r\n{validators}"
+        self.ok_head = f"HTTP/1.1 200 OK\r\n{self.headers}Content-Length: {self.size}\r\n\r\n".encode()
+        self.not_modified = f"HTTP/1.1 304 Not Modified\r\n{validators}\r\n".encode()
+        # when the file was last checked against the disk, see StaticFiles.revalidate_after
+        self.checked_at = 0.0
+
+
+class StaticFiles:
+    """ A route handler serving the files under `root`, e.g. `server.route("/static/{path:path}",
+        methods=("GET", "HEAD"))(StaticFiles("assets"))`. File bodies are sent with sendfile, straight from the page
+        cache. Supports conditional requests (`If-None-Match`, `If-Modified-Since`) and single byte ranges (`Range`,
+        `If-Range`).
+
+        Up to `max_open_files` files are kept open with their response headers worked out, least recently used ones
+        being evicted first. A cached file is checked against the disk again at most every `revalidate_after`
+        seconds, so a changed file is served fresh within that long. """
+
+    MAX_OPEN_FILES = 256
+    REVALIDATE_AFTER = 1.0
+    DEFAULT_CONTENT_TYPE = "application/octet-stream"
+
+    def __init__(self, root, param="path", max_open_files=None, revalidate_after=None, cache_control=None,
+                 clock=time.monotonic):
+        self.root = os.path.realpath(root)
+        # the route parameter holding the file's path relative to `root`
+        self.param = param
+        self.max_open_files = max_open_files if max_open_files else self.MAX_OPEN_FILES
+        self.revalidate_after = revalidate_after if revalidate_after is not None else self.REVALIDATE_AFTER
+        self.cache_control = cache_control
+        self.clock = clock
+        # relative path -> CachedFile, least recently used first
+        self.cache = collections.OrderedDict()
+
+    def __call__(self, request: HttpRequest, connection=None, server=None):
+        cached = self.get_file(request.params.get(self.param, ""))
+        if cached is None:
+            server.send_response(connection, 404)
+            return None
+        if self.is_not_modified(request, cached):
+            connection.queue_message(cached.not_modified)
+            return None
+
+        byte_range = self.get_range(request, cached)
+        if byte_range is None:
+            start, end = 0, cached.size
+            connection.queue_message(cached.ok_head)
+        elif byte_range:
+            start, end = byte_range
+            connection.queue_message(f"HTTP/1.1 206 Partial Content\r\n{cached.headers}Content-Range: bytes "
+                                     f"{start}-{end - 1}/{cached.size}\r\nContent-Length: {end - start}\r\n\r\n"
+                                     .encode())
+        else:
+            connection.queue_message(f"HTTP/1.1 416 Range Not Satisfiable\r\nContent-Range: bytes */{cached.size}\r\n"
+                                     f"Content-Length: 0\r\n\r\n".encode())
+            return None
+        if request.method != "HEAD" and end > start:
+            connection.queue_file(cached.file, start, end - start)
+        return None
+
+    def get_file(self, relative_path) -> CachedFile | None:
+        """ The cached file at `relative_path` under the root, opening (or reopening, if it changed) it as needed.
+            None if there's no such regular file. """
+        now = self.clock()
+        cached = self.cache.get(relative_path)
+        if cached is not None:
+            self.cache.move_to_end(relative_path)
+            if now - cached.checked_at < self.revalidate_after:
+                return cached
+        path = self.resolve(relative_path)
+        try:
+            status = os.stat(path) if path else None
+        except OSError:
+            status = None
+        if status is None or not stat.S_ISREG(status.st_mode):
+            self.cache.pop(relative_path, None)
+            return None
+        if cached is None or cached.identity != (status.st_ino, status.st_mtime_ns, status.st_size):
+            try:
+                file = OpenFile(path)
+            except OSError:
+                self.cache.pop(relative_path, None)
+                return None
+            content_type = mimetypes.guess_type(path)[0] or self.DEFAULT_CONTENT_TYPE
+            cached = CachedFile(file, status, content_type, cache_control=self.cache_control)
+            self.cache[relative_path] = cached
+            while len(self.cache) > self.max_open_files:
+                # responses still sending the evicted file keep it open until they're done, see OpenFile
+                self.cache.popitem(last=False)
+        cached.checked_at = now
+        return cached
+
+    def resolve(self, relative_path) -> str | None:
+        """ The real path of `relative_path` under the root, or None if it would be outside of it """
+        if "\0" in relative_path:
+            return None
+        path = os.path.realpath(os.path.join(self.root, relative_path.lstrip("/")))
+        if not path.startswith(self.root + os.sep):
+            return None
+        return path
+
+    @staticmethod
+    def is_not_modified(request: HttpRequest, cached: CachedFile) -> bool:
+        if "if-none-match" in request.headers:
+            tags = [tag.strip() for value in request.headers.get_all("if-none-match") for tag in value.split(",")]
+            # weak comparison, as a GET or HEAD has to use
+            return "*" in tags or any(tag.removeprefix("W/") == cached.etag for tag in tags)
+        since = StaticFiles.parse_date(request.headers.get("if-modified-since"))
+        return since is not None and cached.mtime <= since
+
+    @staticmethod
+    def get_range(request: HttpRequest, cached: CachedFile) -> tuple | None:
+        """ The (start, end) of the single byte range requested, () if it can't be satisfied, or None to send the
+            whole file. Multiple ranges aren't supported and get the whole file, as a server is allowed to. """
+        header = request.headers.get("range")
+        if not header:
+            return None
+        if_range = request.headers.get("if-range")
+        if if_range is not None and if_range != cached.etag and StaticFiles.parse_date(if_range) != cached.mtime:
+            # the client's partial copy is out of date
+            return None
+        match = BYTE_RANGE.fullmatch(header.strip())
+        if match is None or not (match.group("first") or match.group("last")):
+            return None
+        first, last = match.group("first"), match.group("last")
+        if not first:
+            # the last `last` bytes
+            suffix = min(int(last), cached.size)
+            return (cached.size - suffix, cached.size) if suffix else ()
+        start = int(first)
+        end = min(int(last) + 1, cached.size) if last else cached.size
+        return (start, end) if start < end else ()
+
+    @staticmethod
+    def parse_date(value) -> int | None:
+        if not value:
+            return None
+        try:
+            return int(email.utils.parsedate_to_datetime(value).timestamp())
+        except (TypeError, ValueError, IndexError):
+            return None
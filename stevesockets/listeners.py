@@ -19,17 +19,26 @@ class WebFrameListener(Listener):
         connection.close()
 
     def send_frame(self, connection, frame, flush_immediately=False):
-        frame_bytes = frame.to_bytes()
-        self.logger.debug(f'Sending bytes: {frame_bytes}')
-        connection.queue_message(frame_bytes)
+        self.logger.debug(f'Sending frame: {frame}')
+        connection.send_frame(frame)
         if flush_immediately:
             connection.flush_messages()
 
+    def respond(self, result, message, *args, connection=None, **kwargs):
+        """ Sends a frame (or text, as a text frame) returned by `handle` to the connection """
+        if isinstance(result, str):
+            result = WebSocketFrame.get_text_frame(result)
+        if isinstance(result, WebSocketFrame):
+            if connection is not None:
+                self.send_frame(connection, result)
+        else:
+            super(WebFrameListener, self).respond(result, message, *args, connection=connection, **kwargs)
+
 
 class CloseListener(WebFrameListener):
 
     def observe(self, message, *args, connection=None, **kwargs):
-        self.close_connection(connection, message=message.message)
+        self.close_connection(connection, message=message.payload)
 
 
 class PingListener(WebFrameListener):
@@ -49,11 +58,9 @@ class TextListener(Listener):
 class MessageSynchronizer(WebFrameListener):
 
     def observe(self, message, *args, connection=None, server=None, **kwargs):
-        headers = WebSocketFrameHeaders(payload_length=len(message.message))
-        server_message = WebSocketFrame(headers=headers, message=message.message)
-        for server_connection in server.peer_connections:
-            if server_connection != connection:
-                self.send_frame(server_connection, server_message)
+        headers = WebSocketFrameHeaders(opcode=message.headers.opcode)
+        server_message = WebSocketFrame(headers=headers, payload=message.payload)
+        server.broadcast(server_message, exclude=connection)
 
 
 class JSONListener(Listener):
@@ -62,5 +69,9 @@ class JSONListener(Listener):
         data = json.loads(message.message)
         self.handle_json(data, *args, connection=None, server=None, **kwargs)
 
+    def handle(self, message):
+        # used instead of `observe` when the listener runs on an executor, whatever `handle_json` returns is sent back
+        return self.handle_json(json.loads(message.message))
+
     def handle_json(self, data, *args, **kwargs):
         pass
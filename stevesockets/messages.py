@@ -1,4 +1,5 @@
 import enum
+import inspect
 
 
 class MessageTypes(enum.Enum):
@@ -11,12 +12,21 @@ class MessageTypes(enum.Enum):
 	PONG = 10
 
 
+class ListenerExecutor(enum.Enum):
+	""" Where a listener's work runs, see Listener.executor """
+	INLINE = "inline"  # `observe` is called on the server's I/O loop
+	THREAD = "thread"  # `handle` runs on a worker thread pool
+	PROCESS = "process"  # `handle` runs on a worker process pool, so the listener, message and result must pickle
+
+
 class MessageManager:
 
 	default_message_type = MessageTypes.DEFAULT
 
 	def __init__(self):
 		self.message_listeners = {}
+		# called instead of `observe` for listeners that don't run inline, set by the server that owns the manager
+		self.offload = None
 
 	def listen_for_message(self, listener, message_type: MessageTypes = MessageTypes.DEFAULT):
 		self.message_listeners.setdefault(message_type, [])
@@ -27,14 +37,45 @@ class MessageManager:
 			return
 
 		for listener in self.message_listeners[message_type]:
-			listener.observe(message, *args, **kwargs)
+			if listener.executor != ListenerExecutor.INLINE and self.offload:
+				self.offload(listener, message, *args, **kwargs)
+			else:
+				listener.observe(message, *args, **kwargs)
+
+	async def dispatch_message_async(self, message, *args, message_type: MessageTypes = MessageTypes.DEFAULT, **kwargs):
+		""" Same as `dispatch_message`, but awaits listeners whose `observe` is a coroutine """
+		if message_type not in self.message_listeners.keys():
+			return
+
+		for listener in self.message_listeners[message_type]:
+			if listener.executor != ListenerExecutor.INLINE and self.offload:
+				self.offload(listener, message, *args, **kwargs)
+				continue
+			result = listener.observe(message, *args, **kwargs)
+			if inspect.isawaitable(result):
+				await result
 
 
 class Listener:
 
+	# listeners doing slow work can run it off the I/O loop: instead of `observe`, `handle` is called with just the
+	# message on a worker pool and its result is handed to `respond` back on the loop. A listener gets the messages
+	# of any one connection in the order they arrived.
+	executor = ListenerExecutor.INLINE
+
 	def __init__(self, fn=None):
 		self.fn = fn
 
 	def observe(self, message, *args, **kwargs):
 		if self.fn:
-			self.fn(message, *args, **kwargs)
+			return self.fn(message, *args, **kwargs)
+
+	def handle(self, message):
+		""" The work done on a worker pool for listeners that don't run inline, returns the result to `respond` with """
+		if self.fn:
+			return self.fn(message)
+
+	def respond(self, result, message, *args, connection=None, **kwargs):
+		""" Called on the I/O loop with the result of `handle`, queues it for the connection by default """
+		if result is not None and connection is not None:
+			connection.queue_message(result)
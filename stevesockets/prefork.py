@@ -0,0 +1,135 @@
+from __future__ import annotations
+
+import logging
+import os
+import signal
+import time
+
+
+class PreforkSupervisor:
+    """ Forks `workers` processes that each build a server with `server_factory` and listen on the same address
+        with SO_REUSEPORT, so the kernel spreads clients across them and every core gets its own interpreter.
+        Workers that exit while the supervisor is running are restarted, and SIGTERM/SIGINT stop every worker
+        gracefully (each finishes its current pass and closes its connections). Needs `os.fork`, so POSIX only. """
+
+    # how often the supervisor checks on its workers
+    POLL_INTERVAL = .2
+    # a worker that exits sooner than this after starting is restarted only after RESTART_DELAY, so a worker that
+    # can't start doesn't have the supervisor forking in a tight loop
+    MIN_UPTIME = 1
+    RESTART_DELAY = 1
+    # how long workers get to exit after SIGTERM before they're killed
+    SHUTDOWN_TIMEOUT = 10
+
+    def __init__(self, server_factory: callable, workers=None, logger=None):
+        self.server_factory = server_factory
+        self.worker_count = workers if workers else os.cpu_count() or 1
+        self.logger = logger if logger else logging.getLogger()
+        # pid -> (worker slot, time started)
+        self.workers = {}
+        # worker slot -> earliest time it may be restarted
+        self.pending_restarts = {}
+        self.running = False
+
+    def run(self):
+        """ Starts the workers and supervises them until SIGTERM or SIGINT """
+        previous_handlers = {sig: signal.signal(sig, self._handle_stop_signal) for sig in (signal.SIGTERM,
+                                                                                         signal.SIGINT)}
+        try:
+            self.start()
+            while self.running:
+                self.check_workers()
+                time.sleep(self.POLL_INTERVAL)
+        finally:
+            self.stop()
+            for sig, handler in previous_handlers.items():
+                signal.signal(sig, handler)
+
+    def start(self):
+        self.running = True
+        self.logger.debug("Starting {n} workers".format(n=self.worker_count))
+        for slot in range(self.worker_count):
+            self._spawn_worker(slot)
+
+    def _handle_stop_signal(self, signum, frame):
+        self.logger.warning("Received signal {sig}, stopping workers".format(sig=signal.Signals(signum).name))
+        self.running = False
+
+    def _spawn_worker(self, slot):
+        pid = os.fork()
+        if pid == 0:
+            self._run_worker(slot)
+        self.workers[pid] = (slot, time.monotonic())
+        self.logger.debug("Started worker {slot} (pid {pid})".format(slot=slot, pid=pid))
+
+    def _run_worker(self, slot):
+        """ Runs in the forked process, never returns """
+        exit_code = 1
+        try:
+            server = self.server_factory()
+            server.reuse_port = True
+
+            def stop_server(signum, frame):
+                server.stop_listening()
+
+            signal.signal(signal.SIGTERM, stop_server)
+            signal.signal(signal.SIGINT, stop_server)
+            server.listen()
+            exit_code = 0
+        except BaseException as err:
+            self.logger.error("Worker {slot} failed: {err!r}".format(slot=slot, err=err))
+        finally:
+            # skip the parent's atexit handlers and buffered state, which belong to the supervisor
+            os._exit(exit_code)
+
+    def check_workers(self):
+        """ Reaps workers that have exited and restarts them (after RESTART_DELAY if they died young) """
+        for pid in list(self.workers):
+            try:
+                reaped, status = os.waitpid(pid, os.WNOHANG)
+            except ChildProcessError:
+                reaped, status = pid, 0
+            if reaped == 0:
+                continue
+            slot, started = self.workers.pop(pid)
+            message = "Worker {slot} (pid {pid}) exited with status {status}".format(
+                slot=slot, pid=pid, status=os.waitstatus_to_exitcode(status))
+            if not self.running:
+                self.logger.debug(message)
+                continue
+            self.logger.warning(message)
+            delay = self.RESTART_DELAY if time.monotonic() - started < self.MIN_UPTIME else 0
+            self.pending_restarts[slot] = time.monotonic() + delay
+
+        now = time.monotonic()
+        for slot, restart_at in list(self.pending_restarts.items()):
+            if self.running and restart_at <= now:
+                del self.pending_restarts[slot]
+                self._spawn_worker(slot)
+
+    def stop(self):
+        """ Asks every worker to stop, killing any still running after SHUTDOWN_TIMEOUT """
+        self.running = False
+        self.pending_restarts.clear()
+        self._signal_workers(signal.SIGTERM)
+        deadline = time.monotonic() + self.SHUTDOWN_TIMEOUT
+        while self.workers and time.monotonic() < deadline:
+            self.check_workers()
+            time.sleep(self.POLL_INTERVAL / 4)
+        if self.workers:
+            self.logger.warning("Killing {n} workers that didn't stop in time".format(n=len(self.workers)))
+            self._signal_workers(signal.SIGKILL)
+            for pid in list(self.workers):
+                try:
+                    os.waitpid(pid, 0)
+                except ChildProcessError:
+                    pass
+            self.workers.clear()
+        self.logger.debug("All workers stopped")
+
+    def _signal_workers(self, sig):
+        for pid in self.workers:
+            try:
+                os.kill(pid, sig)
+            except ProcessLookupError:
+                pass
@@ -1,39 +1,76 @@
 from __future__ import annotations
 
+import collections
 import logging
 import socket
-import select
+import selectors
 import threading
-from stevesockets.socketconnection import SocketConnection
-from stevesockets.messages import MessageTypes, MessageManager
-from stevesockets.listeners import Listener
+from stevesockets.socketconnection import SocketConnection, SocketBytesReader, SlowConsumerPolicy
+from stevesockets.messages import MessageTypes, MessageManager, Listener
+from stevesockets.workers import WorkerPool
+from stevesockets.timers import TimerWheel
 
 
-class SocketBytesReader:
-
-    def __init__(self, connection):
-        self.connection = connection
-
-    def get_next_bytes(self, n) -> bytes:
-        return self.connection.socket.recv(n)
+# how many connections a broadcast queued its message for, and how many it skipped because they were closing or
+# their slow consumer policy rejected the message
+BroadcastResult = collections.namedtuple("BroadcastResult", ["reached", "dropped"])
 
 
 class SocketServer:
     connection_cls = SocketConnection
-    peer_connections: list[SocketConnection]
+    selector_cls = selectors.DefaultSelector
+
+    # how long a single pass of the event loop waits for ready sockets before checking `listening` again
+    SELECT_TIMEOUT = .5
+    LISTEN_BACKLOG = 100
 
-    def __init__(self, address=('127.0.0.1', 9000), logger=None):
+    def __init__(self, address=('127.0.0.1', 9000), logger=None, write_buffer_high=None, write_buffer_low=None,
+                 slow_consumer_policy=SlowConsumerPolicy.PAUSE, max_worker_threads=None, max_worker_processes=None,
+                 reuse_port=False, backplane=None, idle_timeout=None):
         self.address = address
         self.listening = False
+        # set by stop_listening, so a stop requested while the server is still starting up isn't lost
+        self.stop_requested = False
         self.set_logger(logger if logger else logging.getLogger())
-        self.peer_connections = []
+        # every connection in the pool by file descriptor, see add_connection
+        self.connections = {}
         self.handle_message = None
+        # lets several processes bind the same address with SO_REUSEPORT, the kernel spreads clients between them
+        self.reuse_port = reuse_port
+        # relays broadcasts to other processes serving the same clients, see stevesockets.backplane
+        self.backplane = backplane
+        self.timers = TimerWheel()
+        # connection -> its timers by name, see schedule_connection_timer
+        self.connection_timers = {}
+        # seconds a connection can go without sending anything before it's closed, None to never time out
+        self.idle_timeout = idle_timeout
         self.message_manager = MessageManager()
+        self.selector = None
+        # connections that had messages queued since they were last flushed
+        self.dirty_connections = set()
+        # connections marked for closing or closed since they were last pruned, the only ones prune_peer_connections
+        # looks at
+        self.closing_connections = set()
+        # outgoing buffer limits given to every new connection, see SocketConnection.queue_message
+        self.write_buffer_high = write_buffer_high
+        self.write_buffer_low = write_buffer_low
+        self.slow_consumer_policy = slow_consumer_policy
+        # runs listeners that opted into an executor off the loop, see Listener.executor
+        self.worker_pool = WorkerPool(notify=self._wake_for_worker_results, logger=self.logger,
+                                      max_threads=max_worker_threads, max_processes=max_worker_processes)
+        self.message_manager.offload = self.offload_message
+        # (read, write) socket pair that wakes the select loop when worker results are ready, created when needed
+        self._worker_wakeup = None
 
     def _create_socket(self):
         self.logger.debug("Creating socket @ {addr}:{port}".format(addr=self.address[0], port=self.address[1]))
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            if hasattr(socket, "SO_REUSEPORT"):
+                self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            else:
+                self.logger.warning("SO_REUSEPORT isn't supported on this platform, binding without it")
         try:
             self.socket.bind(self.address)
         except OSError as err:
@@ -54,18 +91,59 @@ class SocketServer:
 
     def _get_client_connection(self) -> connection_cls:
         sck, addr = self.socket.accept()
+        # the listening socket is non-blocking, whether that's inherited by accepted sockets depends on the OS
+        sck.setblocking(True)
         self.logger.debug("{addr}".format(addr=addr))
-        connection = self.connection_cls(sck, addr[0], addr[1], logger=self.logger)
+        connection = self.connection_cls(sck, addr[0], addr[1], logger=self.logger,
+                                         write_buffer_high=self.write_buffer_high,
+                                         write_buffer_low=self.write_buffer_low,
+                                         slow_consumer_policy=self.slow_consumer_policy)
         self.logger.debug(
             "New connection created at {addr}:{port}".format(addr=connection.address, port=connection.port))
         return connection
 
+    @property
+    def peer_connections(self) -> list[SocketConnection]:
+        """ The connections in the pool as a list, kept for compatibility; iterate over `connections.values()`
+            instead to avoid the copy """
+        return list(self.connections.values())
+
+    @peer_connections.setter
+    def peer_connections(self, connections):
+        self.connections = {}
+        self.closing_connections = set()
+        for connection in connections:
+            self.add_connection(connection)
+
+    def add_connection(self, connection: SocketConnection):
+        """ Adds a connection to the pool, keyed by its file descriptor so it can be removed in O(1) """
+        connection.fd = connection.socket.fileno()
+        self.connections[connection.fd] = connection
+        connection.on_closing = self._mark_closing
+        if connection.is_to_be_closed() or connection.is_closed():
+            self._mark_closing(connection)
+
+    def remove_connection(self, connection: SocketConnection):
+        if self.connections.get(connection.fd) is connection:
+            del self.connections[connection.fd]
+            # closing it from here on has nothing left to prune
+            connection.on_closing = None
+        self.closing_connections.discard(connection)
+
+    def _mark_closing(self, connection: SocketConnection):
+        self.closing_connections.add(connection)
+
     def prune_peer_connections(self):
-        """ Removes connections from the pool that are closed or marked to be closed """
-        # this list will be the list of valid connections left (after creating new connections and closing old ones)
-        # after we've finished looping through all the currently active connections
-        new_connection_list = self.peer_connections[:]
-        for connection in self.peer_connections:
+        """ Removes connections from the pool that are closed or marked to be closed. Only the connections that were
+            marked or closed since the last prune are looked at, so idle connections cost nothing here. """
+        for connection in list(self.closing_connections):
+            if connection.is_to_be_closed() and not connection.is_closed() and connection.has_pending_output():
+                # let whatever was queued before closing (e.g. a response or CLOSE frame) finish sending first
+                self._flush_connection(connection)
+                if connection.has_pending_output():
+                    # looked at again by the next prune
+                    continue
+            self.closing_connections.discard(connection)
             if connection.is_to_be_closed():
                 self.logger.warning(
                     "Connection closure initiated by peer @ {addr}:{port}".format(
@@ -73,28 +151,161 @@ class SocketServer:
                         port=connection.port
                     )
                 )
-                new_connection_list.remove(connection)
+                self.remove_connection(connection)
+                self._connection_removed(connection)
                 self._close_connection(connection)
             elif connection.is_closed():  # this can happen in when running asynchronously
-                new_connection_list.remove(connection)
-            elif connection.socket.fileno() == -1:
-                self.logger.warning("Connection with invalid file descriptor not closed or marked for closure")
-                self._close_connection(connection)
-                new_connection_list.remove(connection)
-        self.peer_connections = new_connection_list
+                self.remove_connection(connection)
+                self._connection_removed(connection)
+                self._unregister_connection(connection)
+
+    def _connection_removed(self, connection: SocketConnection):
+        """ Called once a connection is being dropped from the pool, can be overridden to clean up anything kept
+            about it """
+        for timer in self.connection_timers.pop(connection, {}).values():
+            timer.cancel()
+
+    def schedule_connection_timer(self, connection: SocketConnection, name, delay, callback):
+        """ Calls `callback(connection)` after `delay` seconds, replacing the connection's timer called `name` if
+            it has one. A connection's timers are cancelled once it's removed from the pool. """
+        timers = self.connection_timers.setdefault(connection, {})
+        previous = timers.get(name)
+        if previous:
+            previous.cancel()
+        timers[name] = self.timers.schedule(delay, callback, connection)
+        return timers[name]
+
+    def cancel_connection_timer(self, connection: SocketConnection, name):
+        timer = self.connection_timers.get(connection, {}).pop(name, None)
+        if timer:
+            timer.cancel()
+
+    def _start_idle_timer(self, connection: SocketConnection):
+        if self.idle_timeout:
+            connection.last_activity = self.timers.clock()
+            self.schedule_connection_timer(connection, "idle", self.idle_timeout, self._check_idle)
+
+    def _check_idle(self, connection: SocketConnection):
+        """ Closes the connection if it hasn't sent anything for `idle_timeout`, otherwise checks again when it
+            could next have been idle that long, so staying active costs nothing but a timestamp """
+        if connection.is_to_be_closed() or connection.is_closed():
+            return
+        idle = self.timers.clock() - connection.last_activity
+        if idle >= self.idle_timeout:
+            self.close_timed_out(connection, "Idle for {idle:.0f} seconds".format(idle=idle))
+        else:
+            self.schedule_connection_timer(connection, "idle", self.idle_timeout - idle, self._check_idle)
+
+    def close_timed_out(self, connection: SocketConnection, reason):
+        """ Closes a connection that timed out, can be overridden to tell the client why first """
+        self.logger.warning("{reason} @ {addr}:{port}, closing connection".format(
+            reason=reason, addr=connection.address, port=connection.port))
+        connection.mark_for_closing()
 
     def _build_peer_connections(self):
-        conn, _, _ = select.select([self.socket], [], [], .1)
-        for c in conn:
-            connection = self._get_client_connection()
-            self.peer_connections.append(connection)
-            self.logger.debug("Total connections: {n}".format(n=len(self.peer_connections)))
+        """ Accepts a pending client on the listening socket and adds it to the pool """
+        connection = self._get_client_connection()
+        self.add_connection(connection)
+        self._register_connection(connection)
+        self.logger.debug("Total connections: {n}".format(n=len(self.connections)))
+
+    def _accept_connections(self):
+        """ Accepts every client waiting on the listening socket, up to the size of the listen backlog """
+        for _ in range(self.LISTEN_BACKLOG):
+            try:
+                self._build_peer_connections()
+            except BlockingIOError:
+                # nothing (left) to accept, or another process sharing the socket accepted the client first
+                break
+            except OSError as err:
+                self.logger.warning("Couldn't accept connection: '{err}'".format(err=err))
+                break
+
+    def _register_connection(self, connection: SocketConnection):
+        """ Starts watching a connection for incoming data, does nothing if the server isn't listening """
+        if self.selector and not connection.is_closed():
+            connection.socket.setblocking(False)
+            connection.on_dirty = self._mark_dirty
+            self.selector.register(connection.socket, self._get_interest(connection), data=connection)
+            self._start_idle_timer(connection)
+
+    @staticmethod
+    def _get_interest(connection: SocketConnection) -> int:
+        """ The selector events a connection should be woken up for: reads unless it's paused or closing, and
+            writes while it has output the socket hasn't taken yet """
+        events = 0
+        if not connection.is_reading_paused() and not connection.is_to_be_closed():
+            events |= selectors.EVENT_READ
+        if connection.has_pending_output():
+            events |= selectors.EVENT_WRITE
+        return events if events else selectors.EVENT_READ
+
+    def _update_interest(self, connection: SocketConnection):
+        if not self.selector or connection.is_closed():
+            return
+        events = self._get_interest(connection)
+        try:
+            if self.selector.get_key(connection.socket).events != events:
+                self.selector.modify(connection.socket, events, data=connection)
+        except (KeyError, ValueError):
+            # not registered (yet), the right events will be used when it is
+            pass
+
+    def _mark_dirty(self, connection: SocketConnection):
+        self.dirty_connections.add(connection)
+
+    def flush_dirty_connections(self):
+        """ Flushes only the connections that had messages queued since they were last flushed """
+        while self.dirty_connections:
+            self._flush_connection(self.dirty_connections.pop())
+
+    def _flush_connection(self, connection: SocketConnection):
+        """ Sends what the connection's socket will take without blocking and watches for writability if
+            anything is left over """
+        if connection.is_closed():
+            return
+        connection.flush_messages()
+        self._update_interest(connection)
+
+    def _unregister_connection(self, connection: SocketConnection):
+        self.dirty_connections.discard(connection)
+        if self.selector:
+            try:
+                self.selector.unregister(connection.socket)
+            except (KeyError, ValueError):
+                # never registered, or already dropped by the selector
+                pass
+
+    def _handle_connection_event(self, connection: SocketConnection, events=selectors.EVENT_READ):
+        """ Sends queued output to a connection the selector reported as writable, and reads from (then dispatches
+            what was read) a connection reported as readable """
+        if events & selectors.EVENT_WRITE:
+            self._flush_connection(connection)
+        if not events & selectors.EVENT_READ:
+            return
+        if connection.is_to_be_closed() or connection.is_closed() or connection.is_reading_paused():
+            # will be cleaned up by the next prune, don't process anything else from it
+            return
+        self.logger.debug(f"Data found @ {connection.address}:{connection.port}")
+        connection.last_activity = self.timers.clock()
+        for message in self.read_messages(connection):
+            self.on_message(connection, message)
+
+    def read_messages(self, connection: SocketConnection) -> list:
+        """ Reads from a connection with data waiting and returns the messages to dispatch. By default everything
+            read at once is a single message, subclasses can split (or hold back) messages however their protocol
+            needs to. """
+        response = self.connection_handler(connection)
+        return [response] if response else []
 
     def listen(self):
         """ Creates and binds a socket connection at `address` on `port`, then listens for incoming
             client connections, reads data from them and sends back the return value of `connection_handler`
             as a response. Business logic should be handled in `handle_message` in subclasses,
-            unless there are specialized cases for connections that need to be handled. """
+            unless there are specialized cases for connections that need to be handled.
+
+            The listening socket and every connection are registered once with a selector, so each pass of
+            the loop only touches the sockets that actually have data waiting. """
         self._create_socket()
         if not self.socket:
             self.logger.warning("Socket not successfully initialized, check logs for details. Aborting listen()")
@@ -102,27 +313,42 @@ class SocketServer:
             self._stop_server()
         else:
             self.logger.debug("Listening on socket @ {addr}:{port}".format(addr=self.address[0], port=self.address[1]))
-            self.socket.listen(100)
-
-            self.listening = True
+            self.socket.listen(self.LISTEN_BACKLOG)
+            self.socket.setblocking(False)
+            self.selector = self.selector_cls()
+            self.selector.register(self.socket, selectors.EVENT_READ)
+            for connection in self.connections.values():
+                self._register_connection(connection)
+            if self.backplane:
+                self.backplane.start()
+                self.selector.register(self.backplane, selectors.EVENT_READ)
+
+            self.listening = not self.stop_requested
             while self.listening:
                 try:
-                    self._build_peer_connections()
+                    # wake up every tick while there are timers waiting to fire
+                    events = self.selector.select(self.timers.tick if self.timers else self.SELECT_TIMEOUT)
                 except KeyboardInterrupt as err:
                     self.logger.warning("Manually interrupting server")
                     self.stop_listening()
                     break
 
-                self.prune_peer_connections()
-                for connection in self.peer_connections:
+                accept_ready = False
+                for key, mask in events:
+                    if self._worker_wakeup and key.fileobj is self._worker_wakeup[0]:
+                        self._process_worker_results()
+                        continue
+                    if self.backplane and key.fileobj is self.backplane:
+                        self._process_backplane()
+                        continue
+                    if key.data is None:
+                        # the listening socket, accept only after this pass' closed connections are pruned so a
+                        # reused file descriptor can't collide with a stale registration
+                        accept_ready = True
+                        continue
+                    connection = key.data
                     try:
-                        # self.logger.debug(f"Checking connection @ {connection.socket.getpeername()}")
-                        avail_data, _, _ = select.select([connection.socket], [], [], .1)
-                        if avail_data:
-                            self.logger.debug(f"Data found @ {avail_data[0].getpeername()}")
-                            response = self.connection_handler(connection)
-                            if response:
-                                self.on_message(connection, response)
+                        self._handle_connection_event(connection, mask)
                     except OSError as err:
                         self.logger.warning("Socket error '{err}'".format(err=err))
                         self._close_connection(connection)
@@ -134,21 +360,108 @@ class SocketServer:
                         self.logger.error(f"General error encountered, attempting graceful shutdown. Error: {err}")
                         self.stop_listening()
                         break
+
+                fired = self.timers.advance()
+                if events or fired:
+                    self.flush_dirty_connections()
+                    self.prune_peer_connections()
+                if accept_ready and self.listening:
+                    self._accept_connections()
             self._stop_server()
 
     def on_message(self, connection, response):
-        self.logger.debug("Handling bytes {r}".format(
-            r=response.encode() if hasattr(response, "encode") else response)
-        )
+        # frames are logged by their repr, encoding them again just for the log would copy the whole payload
+        self.logger.debug("Handling message {r}".format(r=response))
         self.message_manager.dispatch_message(
             response,
             message_type=self.get_message_type(response),
             connection=connection,
             server=self
         )
-        # each message the server receives could queue messages in any given connection, so flush them all
-        for conn in self.peer_connections:
-            conn.flush_messages()
+        # each message the server receives could queue messages in any given connection, flush the ones that did
+        self.flush_dirty_connections()
+
+    def offload_message(self, listener: Listener, message, *args, **kwargs):
+        """ Hands a message to the worker pool for a listener that doesn't run inline """
+        self._create_worker_wakeup()
+        self.worker_pool.submit(listener, message, *args, **kwargs)
+
+    def _create_worker_wakeup(self):
+        if self._worker_wakeup or not self.selector:
+            return
+        self._worker_wakeup = socket.socketpair()
+        for sck in self._worker_wakeup:
+            sck.setblocking(False)
+        self.selector.register(self._worker_wakeup[0], selectors.EVENT_READ)
+
+    def _wake_for_worker_results(self):
+        """ Called from the worker side whenever a result is ready """
+        wakeup = self._worker_wakeup
+        if wakeup:
+            try:
+                wakeup[1].send(b"\0")
+            except OSError:
+                # the socket's buffer is full (the loop is already due to wake up) or the server has stopped
+                pass
+
+    def _process_worker_results(self):
+        """ Delivers every finished worker result to its listener on the loop """
+        try:
+            while self._worker_wakeup[0].recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+        self.worker_pool.process_results()
+
+    def _close_worker_wakeup(self):
+        if not self._worker_wakeup:
+            return
+        if self.selector:
+            try:
+                self.selector.unregister(self._worker_wakeup[0])
+            except (KeyError, ValueError):
+                pass
+        for sck in self._worker_wakeup:
+            sck.close()
+        self._worker_wakeup = None
+
+    def broadcast(self, message, exclude=None, predicate=None, connections=None, relay=True,
+                  encoder=None) -> BroadcastResult:
+        """ Queues the same `message` object for every peer connection (or just `connections` if given), except
+            `exclude` (a connection or a collection of them) and any connection `predicate` returns False for.
+            `encoder`, if given, is called with each of those connections and returns what to queue for it in
+            place of `message`. A broadcast to every connection is also relayed through the backplane (unless
+            `relay` is False), the returned counts only cover this process' connections. """
+        if isinstance(exclude, SocketConnection):
+            exclude = (exclude,)
+        excluded = set(exclude) if exclude else ()
+        reached = dropped = 0
+        for connection in (self.connections.values() if connections is None else connections):
+            if connection in excluded or (predicate and not predicate(connection)):
+                continue
+            if connection.is_to_be_closed() or connection.is_closed():
+                dropped += 1
+            elif connection.try_queue_message(encoder(connection) if encoder else message):
+                reached += 1
+            else:
+                dropped += 1
+        if relay and predicate is None and connections is None:
+            self.relay(None, message)
+        return BroadcastResult(reached, dropped)
+
+    def relay(self, channel, data):
+        """ Publishes already encoded `data` to the other processes on the backplane, if there is one """
+        if self.backplane and self.listening:
+            self.backplane.publish(channel, data)
+
+    def _process_backplane(self):
+        for channel, data in self.backplane.receive():
+            self.deliver_relayed(channel, data)
+        self.flush_dirty_connections()
+
+    def deliver_relayed(self, channel, data):
+        """ Delivers a message another process relayed through the backplane to this process' connections """
+        self.broadcast(data, relay=False)
 
     def get_message_type(self, message):
         # TODO: Use some logic or configuration to determine message types
@@ -165,30 +478,22 @@ class SocketServer:
         return send_message_closure
 
     def connection_handler(self, connection: SocketConnection):
-        bytes_reader = SocketBytesReader(connection)
-
         self.logger.debug("Server handling incoming data")
         try:
-            readable_data, _, _ = select.select([connection.socket], [], [], 0)
-            bit = bytes_reader.get_next_bytes(1) if readable_data else b''
-            chunk = bit
-            while readable_data and bit:
-                bit = bytes_reader.get_next_bytes(1)
-                chunk += bit
-                readable_data, _, _ = select.select([connection.socket], [], [], 0)
-            data_in = chunk
+            data_in = connection.bytes_reader.read_available()
         except ConnectionResetError:
             self.logger.warning("Connection closed prematurely, marking for closing")
             connection.mark_for_closing()
             return None
 
+        if data_in is None:
+            return None
         if not data_in:
             self.logger.warning("Read no data from socket, marking for closing")
             connection.mark_for_closing()
+            return None
         return data_in
 
-
-
     def handle_message(self, connection, data):
         """ Should be overridden by subclasses. Responsible for taking raw bytes and
             returning the business logic response in bytes """
@@ -201,18 +506,35 @@ class SocketServer:
 
     def _close_connection(self, connection: SocketConnection):
         """ Can be overridden to allow custom behavior around closing SocketConnections """
+        self._unregister_connection(connection)
         connection.close()
         self.logger.debug("Connection @ {addr}:{port} closed".format(addr=connection.address, port=connection.port))
 
     def _stop_server(self):
-        self.logger.debug("Closing {n} connections".format(n=len(self.peer_connections)))
-        [self._close_connection(c) for c in self.peer_connections]
-        self.peer_connections = []
+        self.logger.debug("Closing {n} connections".format(n=len(self.connections)))
+        for connection in list(self.connections.values()):
+            self._connection_removed(connection)
+            self._close_connection(connection)
+        self.connections = {}
+        self.closing_connections = set()
+        self.worker_pool.shutdown()
+        self._close_worker_wakeup()
+        if self.backplane:
+            if self.selector:
+                try:
+                    self.selector.unregister(self.backplane)
+                except (KeyError, ValueError):
+                    pass
+            self.backplane.close()
+        if self.selector:
+            self.selector.close()
+            self.selector = None
         if self.socket:
             self.logger.debug("Closing server socket")
             self.socket.close()
         else:
             self.logger.debug("Socket not initialized, no need to close")
+        self.stop_requested = False
         self.logger.debug("Server done listening")
 
     def stop_listening(self):
@@ -220,3 +542,4 @@ class SocketServer:
             connections after finishing processing the current pool. """
         self.logger.debug("Stopping listening")
         self.listening = False
+        self.stop_requested = True
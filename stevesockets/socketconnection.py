@@ -1,14 +1,135 @@
 from __future__ import annotations
 import socket
 import collections
+import enum
+import itertools
 import logging
+import os
+import threading
+
+
+class SlowConsumerPolicy(enum.Enum):
+    """ What a connection does once more than its high watermark of outgoing bytes is waiting to be sent """
+    DROP = "drop"  # discard any new messages until the buffer drains
+    DISCONNECT = "disconnect"  # give up on the client, dropping everything queued for it
+    PAUSE = "pause"  # stop reading from the client until the buffer drains below the low watermark
+
+
+class SocketBytesReader:
+    """ Buffers incoming data for a connection, filling the buffer with large `recv_into` calls and serving
+        `get_next_bytes` out of memory so parsers can ask for a byte at a time without a syscall per byte """
+
+    __slots__ = ("connection", "recv_size", "buffer")
+
+    RECV_SIZE = 65536
+
+    # scratch space every reader on a thread receives into before copying only the bytes actually read, so idle
+    # connections don't each hold on to a full RECV_SIZE buffer
+    _scratch = threading.local()
+
+    def __init__(self, connection, recv_size=None):
+        self.connection = connection
+        self.recv_size = recv_size if recv_size else self.RECV_SIZE
+        self.buffer = bytearray()
+
+    def _get_scratch(self) -> memoryview:
+        scratch = getattr(self._scratch, "view", None)
+        if scratch is None or len(scratch) < self.recv_size:
+            scratch = memoryview(bytearray(self.recv_size))
+            self._scratch.view = scratch
+        return scratch
+
+    def fill(self) -> int | None:
+        """ Reads whatever the socket has available (up to `recv_size` bytes) onto the end of the buffer and
+            returns the number of bytes read, 0 meaning the peer closed the connection and None that a
+            non-blocking socket had nothing to read yet """
+        scratch = self._get_scratch()
+        try:
+            n = self.connection.socket.recv_into(scratch, self.recv_size)
+        except (BlockingIOError, InterruptedError):
+            return None
+        if n:
+            self.buffer += scratch[:n]
+        return n
+
+    def buffered(self) -> int:
+        return len(self.buffer)
+
+    def get_next_bytes(self, n) -> bytes:
+        """ Returns the next `n` bytes, reading from the socket until enough have arrived. Fewer than `n` bytes
+            are only returned if the connection is closed first. """
+        while len(self.buffer) < n:
+            if not self.fill():
+                break
+        chunk = bytes(self.buffer[:n])
+        del self.buffer[:n]
+        return chunk
+
+    def read_available(self) -> bytes | None:
+        """ Returns everything buffered, reading from the socket once first if the buffer is empty. Returns b'' if
+            the peer closed the connection and None if there was nothing to read yet. """
+        if not self.buffer:
+            if self.fill() is None:
+                return None
+        chunk = bytes(self.buffer)
+        self.buffer.clear()
+        return chunk
+
+
+class FileRegion:
+    """ `count` bytes of an open file from `offset`, queued on a connection to be sent straight from the page cache
+        with sendfile rather than read into memory first. `file` is anything with a `fileno()` that stays open while
+        the region is queued. """
+
+    __slots__ = ("file", "offset", "count")
+
+    # most bytes read at once where sendfile isn't available
+    READ_SIZE = 2 ** 16
+
+    def __init__(self, file, offset, count):
+        self.file = file
+        self.offset = offset
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def send_to(self, sck) -> int:
+        """ Sends as much of the region as the socket takes without blocking, returning how much was sent """
+        if hasattr(os, "sendfile"):
+            sent = os.sendfile(sck.fileno(), self.file.fileno(), self.offset, self.count)
+        else:
+            sent = sck.send(self.read(min(self.count, self.READ_SIZE)))
+        self.offset += sent
+        self.count -= sent
+        return sent
+
+    def read(self, size=None) -> bytes:
+        """ Reads the (next `size` bytes of the) region without consuming it, for transports that can't sendfile """
+        size = self.count if size is None else size
+        return os.pread(self.file.fileno(), size, self.offset)
 
 
 class SocketConnection:
 
+    # connections are slotted (and create their message queue on first use) to keep tens of thousands of mostly
+    # idle clients cheap, subclasses need their own __slots__ to keep that
+    __slots__ = ("socket", "address", "port", "handshook", "to_be_closed", "closed", "logger", "messages",
+                 "bytes_reader", "write_buffer_high", "write_buffer_low", "slow_consumer_policy", "pending_bytes",
+                 "dropped_messages", "reading_paused", "last_activity", "on_dirty", "fd", "producer",
+                 "on_closing")
+
     socket: socket.socket
 
-    def __init__(self, sck, address, port, logger=None):
+    # defaults for how many bytes can be waiting to be sent before the slow consumer policy kicks in, and how far
+    # the buffer has to drain before a paused connection is read from again
+    WRITE_BUFFER_HIGH = 2 ** 20
+    WRITE_BUFFER_LOW = 2 ** 18
+    # most buffers handed to a single sendmsg call, kept under the usual IOV_MAX
+    MAX_SEND_BUFFERS = 512
+
+    def __init__(self, sck, address, port, logger=None, write_buffer_high=None, write_buffer_low=None,
+                 slow_consumer_policy=SlowConsumerPolicy.PAUSE):
         self.socket = sck
         self.address = address
         self.port = port
@@ -16,12 +137,33 @@ class SocketConnection:
         self.to_be_closed = False
         self.closed = False
         self.logger = logger if logger else logging.getLogger()
-        self.messages = collections.deque()
+        # deque of queued messages, None until something's queued
+        self.messages = None
+        self.bytes_reader = SocketBytesReader(self)
+        self.write_buffer_high = write_buffer_high if write_buffer_high else self.WRITE_BUFFER_HIGH
+        self.write_buffer_low = write_buffer_low if write_buffer_low else min(self.WRITE_BUFFER_LOW,
+                                                                              self.write_buffer_high)
+        self.slow_consumer_policy = slow_consumer_policy
+        self.pending_bytes = 0
+        self.dropped_messages = 0
+        self.reading_paused = False
+        # when the connection last received anything, kept up to date by the server if it has an idle timeout
+        self.last_activity = 0
+        # called with the connection whenever a message is queued, so the server knows it needs flushing
+        self.on_dirty = None
+        # the socket's file descriptor when the connection was added to a server, its key in the server's registry
+        self.fd = None
+        # iterator of bytes streamed once what's queued drains, see set_producer
+        self.producer = None
+        # called with the connection when it's marked for closing or closed, so the server knows it needs pruning
+        self.on_closing = None
 
     def close(self):
         self.logger.debug("Closing connection at {addr}:{port}".format(addr=self.address, port=self.port))
         self.socket.close()
         self.closed = True
+        if self.on_closing:
+            self.on_closing(self)
 
     def read_data(self, size=4096):
         return self.socket.recv(size)
@@ -30,21 +172,175 @@ class SocketConnection:
         self.socket.sendall(data)
 
     def queue_message(self, message) -> SocketConnection:
-        self.messages.append(message)
+        """ Queues bytes (or any bytes-like object) to be sent the next time the connection is flushed, applying
+            the slow consumer policy if too much is already waiting """
+        self.try_queue_message(message)
         return self
 
+    def try_queue_message(self, message) -> bool:
+        """ Same as `queue_message`, but returns whether the message was queued or dropped """
+        return self._queue(message, len(message))
+
+    def queue_file(self, file, offset, count) -> bool:
+        """ Queues `count` bytes of an open file from `offset`, see FileRegion. They aren't held in memory so don't
+            count towards the write buffer, but are dropped like any message by the slow consumer policy. Returns
+            whether the region was queued. """
+        return self._queue(FileRegion(file, offset, count), 0)
+
+    def _queue(self, message, size) -> bool:
+        if not self.accepts_messages():
+            if self.slow_consumer_policy == SlowConsumerPolicy.DROP:
+                self.dropped_messages += 1
+                self.logger.warning("Write buffer full @ {addr}:{port}, dropping message".format(
+                    addr=self.address, port=self.port))
+                return False
+            elif self.slow_consumer_policy == SlowConsumerPolicy.DISCONNECT:
+                if not self.to_be_closed:
+                    self.logger.warning("Write buffer full @ {addr}:{port}, disconnecting slow client".format(
+                        addr=self.address, port=self.port))
+                self.dropped_messages += 1
+                self.clear_messages()
+                self.mark_for_closing()
+                return False
+        if self.messages is None:
+            self.messages = collections.deque()
+        self.messages.append(message)
+        self.pending_bytes += size
+        self._update_reading_paused()
+        if self.on_dirty:
+            self.on_dirty(self)
+        return True
+
+    def accepts_messages(self) -> bool:
+        """ Whether a message queued now would be queued rather than dropped by the slow consumer policy """
+        return self.pending_bytes < self.write_buffer_high or self.slow_consumer_policy == SlowConsumerPolicy.PAUSE
+
+    def set_producer(self, producer):
+        """ Streams the chunks of an iterator of bytes after what's already queued. Chunks are only taken from it
+            while fewer than `write_buffer_low` bytes are waiting, so it's consumed as fast as the client reads and
+            never buffered much past `write_buffer_high`. Messages queued before it's done are sent between its
+            chunks, so callers that need them after it have to hold them back until `producer` is None again. """
+        self.producer = iter(producer)
+        if self.on_dirty:
+            self.on_dirty(self)
+
     def clear_messages(self):
-        self.messages.clear()
+        if self.messages:
+            self.messages.clear()
+        self.producer = None
+        self.pending_bytes = 0
+        self._update_reading_paused()
 
     def flush_messages(self):
-        for x in range(len(self.messages)):
-            msg = self.messages.popleft()
+        """ Sends as much of the queue as the socket will take without blocking, keeping the rest (including what's
+            left of a partially sent message) for when the socket is writable again. Queued messages are sent
+            together with one scatter/gather `sendmsg` call where the platform supports it. The producer, if there is
+            one, is asked for more whenever the queue drains. """
+        while True:
+            self._send_queued()
+            if self.producer is None or self.pending_bytes > self.write_buffer_low or not self._produce():
+                break
+        self._update_reading_paused()
+        return self
+
+    def _send_queued(self):
+        while self.messages:
+            if type(self.messages[0]) is FileRegion:
+                if not self._send_file_region(self.messages[0]):
+                    break
+                continue
+            buffers = list(itertools.takewhile(lambda message: type(message) is not FileRegion,
+                                               itertools.islice(self.messages, self.MAX_SEND_BUFFERS)))
             try:
-                self.logger.debug(f"Flushing message {msg}")
-                self.socket.sendall(msg)
+                sent = self._send_buffers(buffers)
+            except (BlockingIOError, InterruptedError):
+                break
             except socket.error as err:
-                self.logger.error("Socket error while sending message: {err}".format(err=err))
-        return self
+                self._send_failed(err)
+                break
+            self.pending_bytes -= sent
+            if not self._consume_sent(sent, len(buffers)):
+                # the socket didn't take everything, wait until it's writable again
+                break
+
+    def _produce(self) -> bool:
+        """ Queues chunks from the producer until the write buffer is full or it runs out, returning whether anything
+            was queued """
+        queued = False
+        try:
+            while self.pending_bytes < self.write_buffer_high:
+                chunk = next(self.producer, None)
+                if chunk is None:
+                    self.producer = None
+                    break
+                if chunk:
+                    if self.messages is None:
+                        self.messages = collections.deque()
+                    self.messages.append(chunk)
+                    self.pending_bytes += len(chunk)
+                    queued = True
+        except Exception as err:
+            # what was already sent can't be taken back, closing is the only way to tell the client it's incomplete
+            self.logger.error("Error producing message: {err}".format(err=err))
+            self.clear_messages()
+            self.mark_for_closing()
+            return False
+        return queued
+
+    def _send_file_region(self, region: FileRegion) -> bool:
+        """ Sends what the socket takes of a queued file region, returning whether all of it was sent """
+        try:
+            sent = region.send_to(self.socket)
+        except (BlockingIOError, InterruptedError):
+            return False
+        except OSError as err:
+            self._send_failed(err)
+            return False
+        if not sent and region.count:
+            # the file was truncated after the response promised its length, which can't be kept now
+            self._send_failed("file ended {count} bytes early".format(count=region.count))
+            return False
+        if region.count:
+            return False
+        self.messages.popleft()
+        return True
+
+    def _send_failed(self, err):
+        self.logger.error("Socket error while sending message: {err}".format(err=err))
+        self.clear_messages()
+        self.mark_for_closing()
+
+    def _send_buffers(self, buffers) -> int:
+        if hasattr(self.socket, "sendmsg"):
+            return self.socket.sendmsg(buffers)
+        return self.socket.send(buffers[0])
+
+    def _consume_sent(self, sent, count) -> bool:
+        """ Removes `sent` bytes' worth of messages from the front of the queue, returning whether all of the first
+            `count` messages were sent """
+        for _ in range(count):
+            length = len(self.messages[0])
+            if sent < length:
+                if sent:
+                    self.messages[0] = memoryview(self.messages[0])[sent:]
+                return False
+            sent -= length
+            self.messages.popleft()
+        return True
+
+    def has_pending_output(self):
+        return bool(self.messages) or self.producer is not None
+
+    def _update_reading_paused(self):
+        if self.slow_consumer_policy != SlowConsumerPolicy.PAUSE:
+            return
+        if self.pending_bytes >= self.write_buffer_high:
+            self.reading_paused = True
+        elif self.pending_bytes <= self.write_buffer_low:
+            self.reading_paused = False
+
+    def is_reading_paused(self):
+        return self.reading_paused
 
     def is_closed(self):
         return self.closed
@@ -57,6 +353,8 @@ class SocketConnection:
 
     def mark_for_closing(self):
         self.to_be_closed = True
+        if self.on_closing:
+            self.on_closing(self)
 
     def is_to_be_closed(self):
         return self.to_be_closed
@@ -0,0 +1,81 @@
+from __future__ import annotations
+
+import math
+import time
+
+
+class Timer:
+    """ A callback scheduled on a TimerWheel, cancelling it is O(1): it's only dropped from the wheel once its slot
+        comes around """
+
+    __slots__ = ("tick", "callback", "args", "cancelled")
+
+    def __init__(self, tick, callback, args):
+        self.tick = tick
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class TimerWheel:
+    """ Hashed timer wheel: time is cut into ticks of `tick` seconds and a timer goes in the slot for the tick it's
+        due in (modulo the number of slots). Scheduling and cancelling are O(1) and each tick only looks at the
+        timers in one slot, so the cost doesn't grow with how many timers are waiting further away. Timers fire on
+        the first `advance` after their tick has passed, so they're late by up to a tick. """
+
+    TICK = .1
+    SLOTS = 512
+
+    def __init__(self, tick=None, slots=None, clock=time.monotonic):
+        self.tick = tick if tick else self.TICK
+        self.slots = [[] for _ in range(slots if slots else self.SLOTS)]
+        self.clock = clock
+        # the last tick whose slot has been processed
+        self.current_tick = int(clock() // self.tick)
+        self.count = 0
+
+    def __len__(self):
+        """ How many timers are scheduled, cancelled timers included until they're dropped """
+        return self.count
+
+    def schedule(self, delay, callback, *args) -> Timer:
+        """ Calls `callback(*args)` once `delay` seconds have passed """
+        tick = max(math.ceil((self.clock() + delay) / self.tick), self.current_tick + 1)
+        timer = Timer(tick, callback, args)
+        self.slots[tick % len(self.slots)].append(timer)
+        self.count += 1
+        return timer
+
+    def advance(self) -> int:
+        """ Fires every timer that's due, returns how many were fired """
+        target = int(self.clock() // self.tick)
+        if target <= self.current_tick:
+            return 0
+        due = []
+        # after a long stall every slot is looked at once rather than once per missed tick
+        for tick in range(self.current_tick + 1, min(target, self.current_tick + len(self.slots)) + 1):
+            index = tick % len(self.slots)
+            slot = self.slots[index]
+            if not slot:
+                continue
+            waiting = []
+            for timer in slot:
+                if timer.cancelled:
+                    self.count -= 1
+                elif timer.tick <= target:
+                    self.count -= 1
+                    due.append(timer)
+                else:
+                    waiting.append(timer)
+            self.slots[index] = waiting
+        self.current_tick = target
+        fired = 0
+        for timer in due:
+            # a timer fired earlier in this pass can cancel ones after it
+            if not timer.cancelled:
+                timer.callback(*timer.args)
+                fired += 1
+        return fired
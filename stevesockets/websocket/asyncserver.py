@@ -0,0 +1,39 @@
+import asyncio
+from stevesockets.asyncserver import AsyncConnectionMixin, AsyncSocketServer
+from stevesockets.websocket.server import WebSocketConnection, WebSocketServer
+
+
+class AsyncWebSocketConnection(AsyncConnectionMixin, WebSocketConnection):
+    __slots__ = ("reader", "writer")
+
+
+class AsyncWebSocketServer(AsyncSocketServer, WebSocketServer):
+    """ WebSocketServer on an asyncio event loop, see AsyncSocketServer """
+
+    connection_cls = AsyncWebSocketConnection
+
+    async def setup_connection(self, reader, writer):
+        conn = await super(AsyncWebSocketServer, self).setup_connection(reader, writer)
+        self.logger.debug("Executing handshake with new connection")
+        try:
+            handshake_input = await asyncio.wait_for(reader.readuntil(self.HANDSHAKE_END), self.HANDSHAKE_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.logger.warning("Handshake timed out @ {addr}:{port}".format(addr=conn.address, port=conn.port))
+            self._connection_removed(conn)
+            conn.close()
+            return None
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError) as err:
+            self.logger.warning("Couldn't read handshake @ {addr}:{port}: '{err}'".format(addr=conn.address,
+                                                                                          port=conn.port, err=err))
+            self._connection_removed(conn)
+            conn.close()
+            return None
+        self.handle_websocket_handshake(conn, handshake_input)
+        if conn.is_handshook():
+            self._connection_established(conn)
+        return conn
+
+    def messages_from_data(self, conn, data) -> list:
+        if not self.feed_data(conn, data):
+            return []
+        return self.reassemble_pending_frames(conn)
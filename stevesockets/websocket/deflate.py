@@ -0,0 +1,157 @@
+from __future__ import annotations
+import zlib
+
+from stevesockets.websocket.websocket import WebSocketFrame, WebSocketFrameHeaders, SocketException
+
+EXTENSION_NAME = "permessage-deflate"
+# every compressed message ends with an empty stored block, which is left off on the wire
+DEFLATE_TAIL = b"\x00\x00\xff\xff"
+# the RSV1 bit marks the first frame of a compressed message
+RSV1 = 4
+
+MIN_WINDOW_BITS = 8
+MAX_WINDOW_BITS = 15
+PARAMETERS = ("server_no_context_takeover", "client_no_context_takeover", "server_max_window_bits",
+              "client_max_window_bits")
+
+
+class PerMessageDeflate:
+    """ Server settings for the permessage-deflate extension (RFC 7692), passed to WebSocketServer as `compression`.
+        Messages with payloads under `threshold` bytes are sent as they are. Without `context_takeover` every message
+        is compressed on its own and no zlib state is kept between messages; with it each connection keeps its own
+        compressor and decompressor (a few hundred KB) in exchange for better ratios on small, similar messages. """
+
+    THRESHOLD = 128
+    # zlib can't compress raw deflate streams with an 8 bit window, so a client asking for one is turned down
+    MIN_COMPRESS_WINDOW_BITS = 9
+
+    def __init__(self, threshold=None, context_takeover=False, server_max_window_bits=MAX_WINDOW_BITS,
+                 client_max_window_bits=MAX_WINDOW_BITS, level=zlib.Z_DEFAULT_COMPRESSION):
+        self.threshold = threshold if threshold is not None else self.THRESHOLD
+        self.context_takeover = context_takeover
+        self.server_max_window_bits = server_max_window_bits
+        self.client_max_window_bits = client_max_window_bits
+        self.level = level
+
+    def negotiate(self, header) -> tuple[str, DeflateContext] | None:
+        """ Picks the first acceptable permessage-deflate offer in a `Sec-WebSocket-Extensions` request header.
+            Returns the value of the response header and the connection's DeflateContext, or None if no offer
+            could be accepted. """
+        for offer in header.split(","):
+            name, *params = [part.strip() for part in offer.split(";")]
+            if name != EXTENSION_NAME:
+                continue
+            try:
+                accepted = self.accept(self.parse_params(params))
+            except ValueError:
+                continue
+            if accepted:
+                return accepted
+        return None
+
+    @staticmethod
+    def parse_params(params) -> dict:
+        """ Maps each parameter of an offer to its value (None if it has none), raising ValueError if the offer is
+            malformed """
+        parsed = {}
+        for param in params:
+            name, _, value = param.partition("=")
+            name, value = name.strip(), value.strip().strip('"')
+            if name not in PARAMETERS or name in parsed:
+                raise ValueError(f"Unexpected parameter '{name}'")
+            if name.endswith("_no_context_takeover"):
+                if value:
+                    raise ValueError(f"'{name}' doesn't take a value")
+                parsed[name] = None
+            elif value or name == "server_max_window_bits":
+                if not value.isdigit() or not MIN_WINDOW_BITS <= int(value) <= MAX_WINDOW_BITS:
+                    raise ValueError(f"Invalid window bits for '{name}'")
+                parsed[name] = int(value)
+            else:
+                parsed[name] = None
+        return parsed
+
+    def accept(self, params) -> tuple[str, DeflateContext] | None:
+        server_bits = self.server_max_window_bits
+        if "server_max_window_bits" in params:
+            server_bits = min(server_bits, params["server_max_window_bits"])
+        if server_bits < self.MIN_COMPRESS_WINDOW_BITS:
+            return None
+        # the client can only be held to a smaller window if it said it supports the parameter
+        client_bits = MAX_WINDOW_BITS
+        if "client_max_window_bits" in params:
+            client_bits = min(self.client_max_window_bits, params["client_max_window_bits"] or MAX_WINDOW_BITS)
+        server_takeover = self.context_takeover and "server_no_context_takeover" not in params
+        client_takeover = self.context_takeover and "client_no_context_takeover" not in params
+
+        response = [EXTENSION_NAME]
+        if not server_takeover:
+            response.append("server_no_context_takeover")
+        if not client_takeover:
+            response.append("client_no_context_takeover")
+        if server_bits < MAX_WINDOW_BITS or "server_max_window_bits" in params:
+            response.append(f"server_max_window_bits={server_bits}")
+        if client_bits < MAX_WINDOW_BITS:
+            response.append(f"client_max_window_bits={client_bits}")
+        context = DeflateContext(server_bits, client_bits, server_takeover, client_takeover, self.level,
+                                 self.threshold)
+        return "; ".join(response), context
+
+
+class DeflateContext:
+    """ The permessage-deflate parameters negotiated with one connection, and its zlib state if contexts are taken
+        over between messages """
+
+    __slots__ = ("server_window_bits", "client_window_bits", "server_context_takeover", "client_context_takeover",
+                 "level", "threshold", "compressor", "decompressor")
+
+    def __init__(self, server_window_bits=MAX_WINDOW_BITS, client_window_bits=MAX_WINDOW_BITS,
+                 server_context_takeover=False, client_context_takeover=False, level=zlib.Z_DEFAULT_COMPRESSION,
+                 threshold=PerMessageDeflate.THRESHOLD):
+        self.server_window_bits = server_window_bits
+        self.client_window_bits = client_window_bits
+        self.server_context_takeover = server_context_takeover
+        self.client_context_takeover = client_context_takeover
+        self.level = level
+        self.threshold = threshold
+        # only kept when the context is taken over, otherwise a new one is made for each message
+        self.compressor = None
+        self.decompressor = None
+
+    def should_compress(self, frame: WebSocketFrame) -> bool:
+        return (frame.headers.opcode in (WebSocketFrame.OPCODE_TEXT, WebSocketFrame.OPCODE_BINARY)
+                and bool(frame.headers.fin) and len(frame.payload) >= self.threshold)
+
+    def compress(self, payload) -> bytes:
+        compressor = self.compressor
+        if compressor is None:
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, -self.server_window_bits)
+            if self.server_context_takeover:
+                self.compressor = compressor
+        data = compressor.compress(payload) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        return data[:-len(DEFLATE_TAIL)] if data.endswith(DEFLATE_TAIL) else data
+
+    def decompress(self, payload, max_size) -> bytes | None:
+        """ Returns the decompressed payload, or None if it's larger than `max_size` """
+        decompressor = self.decompressor
+        if decompressor is None:
+            decompressor = zlib.decompressobj(-self.client_window_bits)
+            if self.client_context_takeover:
+                self.decompressor = decompressor
+        try:
+            # stop one byte past the limit rather than inflating all of an oversized message
+            data = decompressor.decompress(b''.join((payload, DEFLATE_TAIL)), max_size + 1)
+        except zlib.error as err:
+            raise SocketException(f'Invalid compressed payload: {err}')
+        return data if len(data) <= max_size else None
+
+    def compress_frame(self, frame: WebSocketFrame) -> WebSocketFrame:
+        headers = WebSocketFrameHeaders(fin=1, opcode=frame.headers.opcode, rsv=RSV1)
+        return WebSocketFrame(headers=headers, payload=self.compress(frame.payload))
+
+    def decompress_frame(self, frame: WebSocketFrame, max_size) -> WebSocketFrame | None:
+        payload = self.decompress(frame.payload, max_size)
+        if payload is None:
+            return None
+        headers = WebSocketFrameHeaders(fin=frame.headers.fin, opcode=frame.headers.opcode)
+        return WebSocketFrame(headers=headers, payload=payload)
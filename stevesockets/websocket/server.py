@@ -1,21 +1,51 @@
 import base64
+import collections
 import hashlib
-from stevesockets.websocket.websocket import WebSocketFrame, SocketException
+from stevesockets.websocket.websocket import WebSocketFrame, WebSocketFrameParser, FragmentedMessage, SocketException
+from stevesockets.websocket.websocket import FrameTooBig
+from stevesockets.websocket.deflate import RSV1
 from stevesockets.socketconnection import SocketConnection
 from stevesockets.listeners import CloseListener, TextListener, PingListener, Listener
-from stevesockets.server import SocketServer, SocketBytesReader
+from stevesockets.server import SocketServer, BroadcastResult
 from stevesockets.messages import MessageManager, MessageTypes
+from stevesockets.http.response import HttpResponse
 
 
 class WebSocketConnection(SocketConnection):
 
+    __slots__ = ("status", "frame_parser", "pending_frames", "fragmented_message", "ping_sent_at", "channels",
+                 "deflate")
+
     CLOSED = "closed"
     CONNECTING = "connecting"
     CONNECTED = "connected"
 
-    def __init__(self, sck, address="127.0.0.1", port=9000, logger=None):
-        super(WebSocketConnection, self).__init__(sck, address=address, port=port, logger=logger)
+    def __init__(self, sck, address="127.0.0.1", port=9000, logger=None, **kwargs):
+        super(WebSocketConnection, self).__init__(sck, address=address, port=port, logger=logger, **kwargs)
         self.status = WebSocketConnection.CLOSED
+        self.frame_parser = WebSocketFrameParser()
+        # deque of frames already parsed from the socket but not yet handed out by the server, None until needed
+        self.pending_frames = None
+        self.fragmented_message = None
+        # when the server last pinged the connection, see WebSocketServer.ping_interval
+        self.ping_sent_at = None
+        # names of the channels the connection is subscribed to (None until it subscribes to one), see
+        # WebSocketServer.subscribe
+        self.channels = None
+        # the DeflateContext if permessage-deflate was negotiated during the handshake
+        self.deflate = None
+
+    def send_frame(self, frame: WebSocketFrame) -> bool:
+        """ Queues `frame`, compressed if permessage-deflate was negotiated and it's big enough to be worth it.
+            Returns whether it was queued, see `try_queue_message`. """
+        # a compressor that's kept between messages must never see a message the client won't receive
+        if self.deflate is not None and self.deflate.should_compress(frame) and self.accepts_messages():
+            return self.try_queue_message(self.deflate.compress_frame(frame).to_bytes())
+        queued = False
+        for buffer in frame.to_buffers():
+            if buffer:
+                queued = self.try_queue_message(buffer)
+        return queued
 
     def mark_handshook(self):
         self.set_status(WebSocketConnection.CONNECTED)
@@ -40,10 +70,35 @@ class WebSocketServer(SocketServer):
     connection_cls = WebSocketConnection
     WEBSOCKET_MAGIC = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
     MAX_BUFFER_SIZE = 4096
+    MAX_MESSAGE_SIZE = 2 ** 24
+    MAX_FRAGMENTS = 1024
+    # largest handshake request accepted, and how many seconds a new client has to finish sending it
+    MAX_HANDSHAKE_SIZE = 2 ** 14
+    HANDSHAKE_TIMEOUT = 10
+    HANDSHAKE_END = b"\r\n\r\n"
+    # seconds a client has to answer (or send anything at all) after being pinged
+    PONG_TIMEOUT = 10
 
-    def __init__(self, address=('127.0.0.1', 9000), logger=None):
-        super(WebSocketServer, self).__init__(address=address, logger=logger)
-        self.fragmented_messages = {}
+    def __init__(self, address=('127.0.0.1', 9000), logger=None, max_message_size=None, max_fragments=None,
+                 ping_interval=None, pong_timeout=None, compression=None, max_frame_size=None, spool_threshold=None,
+                 **kwargs):
+        super(WebSocketServer, self).__init__(address=address, logger=logger, **kwargs)
+        # limits on messages reassembled from fragments, exceeding either closes the connection
+        self.max_message_size = max_message_size if max_message_size else self.MAX_MESSAGE_SIZE
+        self.max_fragments = max_fragments if max_fragments else self.MAX_FRAGMENTS
+        # frames declaring a larger payload are refused before any of it is read, a single frame can't be a bigger
+        # message than max_message_size anyway
+        self.max_frame_size = max_frame_size if max_frame_size else self.max_message_size
+        # payloads (and fragmented messages) of at least this many bytes are spooled to a temporary file as they
+        # arrive and handed to listeners memory mapped, None to keep every payload in memory
+        self.spool_threshold = spool_threshold
+        # channel name -> connections subscribed to it
+        self.channels = {}
+        # seconds between the server's pings to each client, None to only answer pings clients send
+        self.ping_interval = ping_interval
+        self.pong_timeout = pong_timeout if pong_timeout else self.PONG_TIMEOUT
+        # a PerMessageDeflate offered to clients that ask for compression, None to never compress
+        self.compression = compression
         self.setup_control_listeners()
         self.setup_message_listeners()
 
@@ -55,24 +110,290 @@ class WebSocketServer(SocketServer):
         self.register_listener(TextListener, message_type=MessageTypes.TEXT)
 
     def _get_client_connection(self):
+        """ Accepts a new client, its handshake is read as it arrives by `read_messages` """
         conn = super(WebSocketServer, self)._get_client_connection()
-        self.logger.debug("Executing handshake with new connection")
-        handshake_input = conn.socket.recv(4096)
-        self.handle_websocket_handshake(conn, handshake_input)
+        conn.set_status(WebSocketConnection.CONNECTING)
+        self.schedule_connection_timer(conn, "handshake", self.HANDSHAKE_TIMEOUT, self._handshake_timed_out)
         return conn
 
+    def read_handshake(self, conn) -> bool:
+        """ Buffers what's arrived of the client's handshake request, handling it once it's complete. Returns whether
+            the handshake is done (successfully or not). """
+        reader = conn.bytes_reader
+        scanned = reader.buffered()
+        try:
+            read = reader.fill()
+        except ConnectionResetError:
+            read = 0
+        if read == 0:
+            self.logger.warning("Connection closed during handshake, marking for closing")
+            conn.mark_for_closing()
+            return True
+        end = reader.buffer.find(self.HANDSHAKE_END, max(scanned - len(self.HANDSHAKE_END) + 1, 0))
+        if end == -1:
+            if reader.buffered() > self.MAX_HANDSHAKE_SIZE:
+                self.logger.warning("Handshake request too large, closing connection")
+                self.send_http_response(conn, 431)
+                conn.mark_for_closing()
+                return True
+            return False
+        self.logger.debug("Executing handshake with new connection")
+        self.cancel_connection_timer(conn, "handshake")
+        self.handle_websocket_handshake(conn, reader.get_next_bytes(end + len(self.HANDSHAKE_END)))
+        if conn.is_handshook():
+            self._connection_established(conn)
+        return True
+
+    def _handshake_timed_out(self, conn):
+        if not conn.is_handshook() and not conn.is_to_be_closed() and not conn.is_closed():
+            self.close_timed_out(conn, "Handshake timed out")
+
+    def _connection_established(self, conn):
+        """ Called once a client's handshake succeeded """
+        conn.frame_parser.max_frame_size = self.max_frame_size
+        conn.frame_parser.spool_threshold = self.spool_threshold
+        if self.ping_interval:
+            self.schedule_connection_timer(conn, "ping", self.ping_interval, self._send_ping)
+
+    def _send_ping(self, conn):
+        if conn.is_to_be_closed() or conn.is_closed():
+            return
+        conn.ping_sent_at = self.timers.clock()
+        for buffer in WebSocketFrame.get_ping_frame().to_buffers():
+            if buffer:
+                conn.queue_message(buffer)
+        self.schedule_connection_timer(conn, "ping", self.pong_timeout, self._check_pong)
+
+    def _check_pong(self, conn):
+        """ Anything received since the ping (normally its PONG) shows the client is still there """
+        if conn.is_to_be_closed() or conn.is_closed():
+            return
+        if conn.last_activity < conn.ping_sent_at:
+            self.close_timed_out(conn, "No response to ping")
+        else:
+            self.schedule_connection_timer(conn, "ping", self.ping_interval, self._send_ping)
+
+    def close_timed_out(self, conn, reason):
+        if conn.is_handshook():
+            self.fail_connection(conn, WebSocketFrame.CLOSE_GOING_AWAY, reason)
+        else:
+            self.send_http_response(conn, 408)
+        super(WebSocketServer, self).close_timed_out(conn, reason)
+
     def connection_handler(self, conn):
-        bytes_reader = SocketBytesReader(conn)
+        """ Returns the next complete frame from the connection, or None if one hasn't fully arrived yet. Reads from
+            the socket at most once so a client that stalls partway through a frame never blocks the server. """
+        if conn.pending_frames:
+            return conn.pending_frames.popleft()
 
         self.logger.debug("Websocket server handling incoming data")
         try:
-            frame = WebSocketFrame.from_bytes_reader(bytes_reader)
-        except (SocketException, ConnectionResetError):
+            data_in = conn.bytes_reader.read_available()
+        except ConnectionResetError:
             self.logger.warning("Connection closed prematurely, marking for closing")
             conn.mark_for_closing()
             return None
 
-        return frame
+        if data_in is None:
+            return None
+        if not data_in:
+            self.logger.warning("Read no data from socket, marking for closing")
+            conn.mark_for_closing()
+            return None
+
+        if not self.feed_data(conn, data_in):
+            return None
+        return conn.pending_frames.popleft() if conn.pending_frames else None
+
+    def feed_data(self, conn, data_in) -> bool:
+        """ Parses newly received bytes into the connection's pending frames. Returns False, after failing the
+            connection, if the bytes aren't valid frames. """
+        try:
+            frames = conn.frame_parser.feed(data_in)
+        except FrameTooBig as err:
+            self.logger.warning(f"Oversized frame received, closing connection: {err}")
+            self.fail_connection(conn, WebSocketFrame.CLOSE_MESSAGE_TOO_BIG, "Message too big")
+            return False
+        except SocketException as err:
+            self.logger.warning(f"Malformed frame received, closing connection: {err}")
+            self.fail_connection(conn, WebSocketFrame.CLOSE_PROTOCOL_ERROR, str(err))
+            return False
+        if frames:
+            if conn.pending_frames is None:
+                conn.pending_frames = collections.deque(frames)
+            else:
+                conn.pending_frames.extend(frames)
+        return True
+
+    def read_messages(self, conn) -> list:
+        """ Returns every frame completed by the data waiting on the connection, so many small frames arriving
+            together are all handled in one pass """
+        if not conn.is_handshook():
+            if not self.read_handshake(conn) or not conn.is_handshook() or not conn.bytes_reader.buffered():
+                return []
+            # frames sent right behind the handshake request are already buffered
+        frame = self.connection_handler(conn)
+        if frame is None:
+            return []
+        conn.pending_frames.appendleft(frame)
+        return self.reassemble_pending_frames(conn)
+
+    def reassemble_pending_frames(self, conn) -> list:
+        """ Takes every parsed frame off the connection and returns the messages ready to be dispatched """
+        frames = []
+        while conn.pending_frames and not conn.is_to_be_closed():
+            message = self.reassemble_frame(conn, conn.pending_frames.popleft())
+            if message and message.headers.rsv:
+                message = self.decompress_message(conn, message)
+            if message:
+                frames.append(message)
+        return frames
+
+    def reassemble_frame(self, conn, frame):
+        """ Returns the frame if it can be dispatched right away, or collects it as part of a fragmented message and
+            returns the whole message once its final frame arrives. Control frames can arrive between fragments
+            and are always returned immediately. """
+        opcode = frame.headers.opcode
+        rsv = frame.headers.rsv
+        # RSV1 is only allowed on the first frame of a data message, and only once compression was negotiated
+        if rsv and (rsv != RSV1 or conn.deflate is None or opcode not in (WebSocketFrame.OPCODE_TEXT,
+                                                                          WebSocketFrame.OPCODE_BINARY)):
+            self.fail_connection(conn, WebSocketFrame.CLOSE_PROTOCOL_ERROR, "Unexpected reserved bits")
+            return None
+        if opcode in WebSocketFrameParser.CONTROL_OPCODES:
+            return frame
+
+        if opcode == WebSocketFrame.OPCODE_CONTINUATION:
+            if conn.fragmented_message is None:
+                self.fail_connection(conn, WebSocketFrame.CLOSE_PROTOCOL_ERROR, "Unexpected continuation frame")
+                return None
+        elif conn.fragmented_message is not None:
+            self.fail_connection(conn, WebSocketFrame.CLOSE_PROTOCOL_ERROR, "Expected a continuation frame")
+            return None
+        elif frame.headers.fin:
+            if len(frame.payload) > self.max_message_size:
+                self.fail_connection(conn, WebSocketFrame.CLOSE_MESSAGE_TOO_BIG, "Message too big")
+                return None
+            return frame
+        else:
+            conn.fragmented_message = FragmentedMessage(frame.headers, spool_threshold=self.spool_threshold,
+                                                        max_size=self.max_message_size)
+
+        message = conn.fragmented_message
+        if message.size() + len(frame.payload) > self.max_message_size or message.fragments >= self.max_fragments:
+            conn.fragmented_message = None
+            self.fail_connection(conn, WebSocketFrame.CLOSE_MESSAGE_TOO_BIG, "Message too big")
+            return None
+        message.add(frame)
+        if not frame.headers.fin:
+            return None
+        conn.fragmented_message = None
+        return message.to_frame()
+
+    def decompress_message(self, conn, frame):
+        """ Returns the decompressed message, or None after failing the connection if it can't be decompressed or
+            decompresses to more than `max_message_size` """
+        try:
+            message = conn.deflate.decompress_frame(frame, self.max_message_size)
+        except SocketException as err:
+            self.logger.warning(f"Couldn't decompress message, closing connection: {err}")
+            self.fail_connection(conn, WebSocketFrame.CLOSE_PROTOCOL_ERROR, str(err))
+            return None
+        if message is None:
+            self.fail_connection(conn, WebSocketFrame.CLOSE_MESSAGE_TOO_BIG, "Message too big")
+        return message
+
+    def fail_connection(self, conn, status, reason=''):
+        """ Drops anything queued for the connection, sends a CLOSE frame with the status and marks it for closing """
+        conn.clear_messages()
+        for buffer in WebSocketFrame.get_close_status_frame(status, reason).to_buffers():
+            if buffer:
+                conn.queue_message(buffer)
+        conn.flush_messages()
+        conn.mark_for_closing()
+
+    def broadcast(self, frame, exclude=None, predicate=None, connections=None, relay=True) -> BroadcastResult:
+        """ Encodes `frame` once and queues the same bytes for every connected (handshook) client, see
+            `SocketServer.broadcast`. Already encoded frame bytes are queued as they are. Clients that negotiated
+            compression get a compressed copy, also made once unless their compression context is kept between
+            messages. """
+        data = frame.to_bytes() if isinstance(frame, WebSocketFrame) else frame
+
+        def is_target(connection):
+            return connection.is_handshook() and (predicate is None or predicate(connection))
+
+        encoder = None
+        if self.compression is not None and isinstance(frame, WebSocketFrame):
+            encoder = self._get_compressing_encoder(frame, data)
+        result = super(WebSocketServer, self).broadcast(data, exclude=exclude, predicate=is_target,
+                                                        connections=connections, relay=False, encoder=encoder)
+        if relay and predicate is None and connections is None:
+            self.relay(None, data)
+        return result
+
+    @staticmethod
+    def _get_compressing_encoder(frame, data):
+        # window size -> compressed frame, without context takeover that's all the compressed bytes depend on
+        compressed = {}
+
+        def encoder(connection):
+            deflate = connection.deflate
+            if deflate is None or not deflate.should_compress(frame) or not connection.accepts_messages():
+                return data
+            if deflate.server_context_takeover:
+                return deflate.compress_frame(frame).to_bytes()
+            if deflate.server_window_bits not in compressed:
+                compressed[deflate.server_window_bits] = deflate.compress_frame(frame).to_bytes()
+            return compressed[deflate.server_window_bits]
+
+        return encoder
+
+    def subscribe(self, conn: WebSocketConnection, channel):
+        self.channels.setdefault(channel, set()).add(conn)
+        if conn.channels is None:
+            conn.channels = set()
+        conn.channels.add(channel)
+
+    def unsubscribe(self, conn: WebSocketConnection, channel):
+        subscribers = self.channels.get(channel)
+        if subscribers is not None:
+            subscribers.discard(conn)
+            if not subscribers:
+                del self.channels[channel]
+        if conn.channels:
+            conn.channels.discard(channel)
+
+    def unsubscribe_all(self, conn: WebSocketConnection):
+        for channel in list(conn.channels or ()):
+            self.unsubscribe(conn, channel)
+
+    def get_subscribers(self, channel) -> set:
+        return self.channels.get(channel, set())
+
+    def publish(self, channel, frame, exclude=None, relay=True) -> BroadcastResult:
+        """ Broadcasts `frame` (encoded once) to only the connections subscribed to `channel`, and relays it to the
+            other processes on the backplane (where channels have to be strings) unless `relay` is False """
+        if relay and self.backplane:
+            self.relay(channel, frame.to_bytes() if isinstance(frame, WebSocketFrame) else frame)
+        subscribers = self.channels.get(channel)
+        if not subscribers:
+            return BroadcastResult(0, 0)
+        return self.broadcast(frame, exclude=exclude, connections=subscribers, relay=False)
+
+    def deliver_relayed(self, channel, data):
+        if self.compression is not None:
+            # relayed frames arrive encoded, parse them again so they can be compressed for the clients that want it
+            frames = WebSocketFrameParser().feed(data)
+            if len(frames) == 1:
+                data = frames[0]
+        if channel is None:
+            self.broadcast(data, relay=False)
+        else:
+            self.publish(channel, data, relay=False)
+
+    def _connection_removed(self, connection):
+        self.unsubscribe_all(connection)
+        super(WebSocketServer, self)._connection_removed(connection)
 
     def get_message_type(self, message) -> MessageTypes:
         return MessageTypes(message.headers.opcode)
@@ -87,43 +408,34 @@ class WebSocketServer(SocketServer):
 
     @staticmethod
     def send_http_response(conn, status, headers=None):
-        descriptions = {
-            101: "Switching Protocols",
-
-            200: "OK",
-
-            400: "Bad Request",
-            401: "Unauthorized",
-            403: "Forbidden",
-            404: "Not Found",
-            429: "Too Many Requests",
-
-            500: "Internal Server Error",
-            501: "Not Implemented",
-            502: "Bad Gateway",
-            503: "Service Unavailable",
-            504: "Gateway Timeout"
-        }
-        msg = "HTTP/1.1 {status} {status_description}\r\n".format(status=status,
-                                                                  status_description=descriptions.get(status, ""))
-        if headers:
-            for header, value in headers.items():
-                msg += "{header}: {value}\r\n".format(header=header, value=value)
-        msg += "\r\n"
-        conn.socket.sendall(msg.encode())
+        conn.queue_message(HttpResponse(status=status, headers=headers).to_bytes())
+        conn.flush_messages()
+
+    def negotiate_extensions(self, conn: WebSocketConnection, requested) -> str | None:
+        """ Accepts permessage-deflate if the client asked for it and the server has compression set up, returning
+            the `Sec-WebSocket-Extensions` response header's value """
+        if not requested or self.compression is None:
+            return None
+        negotiated = self.compression.negotiate(requested)
+        if negotiated is None:
+            return None
+        response, conn.deflate = negotiated
+        return response
 
     def handle_websocket_handshake(self, conn: WebSocketConnection, data):
         self.logger.debug("Starting handshake")
         conn.set_status(WebSocketConnection.CONNECTING)
-        split_data = data.decode().split("\r\n")
         try:
+            # a UnicodeDecodeError is a ValueError, so a handshake that isn't UTF-8 is answered like other malformed ones
+            split_data = data.decode().split("\r\n")
             method, path, http = split_data[0].split(" ")
             headers = {}
             for header in split_data[1:]:
                 if ": " in header:
-                    key, value = header.split(": ")
+                    key, value = header.split(": ", 1)
                     headers[key] = value
             accept = self._get_websocket_accept(headers.get("Sec-WebSocket-Key"))
+            extensions = self.negotiate_extensions(conn, headers.get("Sec-WebSocket-Extensions"))
         except (TypeError, ValueError) as err:
             self.logger.error("Malformed headers in client handshake, closing connection")
             self.send_http_response(conn, 400)
@@ -133,10 +445,13 @@ class WebSocketServer(SocketServer):
             self.send_http_response(conn, 500)
             conn.mark_for_closing()
         else:
-            self.send_http_response(conn, 101, headers={
+            response_headers = {
                 "Upgrade": "websocket",
                 "Connection": "Upgrade",
                 "Sec-WebSocket-Accept": accept
-            })
+            }
+            if extensions:
+                response_headers["Sec-WebSocket-Extensions"] = extensions
+            self.send_http_response(conn, 101, headers=response_headers)
             conn.mark_handshook()
             self.logger.debug("Handshake successful @ {addr}:{port}".format(addr=conn.address, port=conn.port))
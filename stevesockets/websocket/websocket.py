@@ -1,12 +1,23 @@
 from __future__ import annotations
 from logging import getLogger
+import io
+import mmap
 import random
 import math
+import tempfile
 
-import stevesockets.server
+import stevesockets.socketconnection
+
+try:
+    import numpy
+except ImportError:  # optional, only used to speed up masking large payloads
+    numpy = None
 
 logger = getLogger(__name__)
 
+# payloads at least this big are masked with numpy when it's installed, below it the int XOR is as fast or faster
+NUMPY_MASK_THRESHOLD = 2 ** 12
+
 
 def bytes_to_int(bytes_in):
     return int.from_bytes(bytes_in, 'little')
@@ -18,6 +29,37 @@ def int_to_bytes(int_in, num_bytes=None):
     return int.to_bytes(int_in, num_bytes, 'little')
 
 
+def apply_mask(data, mask: int) -> bytes:
+    """ XORs `data` (any bytes-like object) with the repeating 4 byte `mask`, which both masks and unmasks a
+        payload. The whole payload is handled as one big integer (or a numpy array when available) rather than
+        byte by byte. """
+    length = len(data)
+    if not length:
+        return b''
+    mask_bytes = int_to_bytes(mask, 4)
+    if numpy is not None and length >= NUMPY_MASK_THRESHOLD:
+        return _apply_mask_numpy(data, mask_bytes)
+    repeated_mask = mask_bytes * (length // 4) + mask_bytes[:length % 4]
+    return (bytes_to_int(data) ^ bytes_to_int(repeated_mask)).to_bytes(length, 'little')
+
+
+def rotate_mask(mask: int, offset: int) -> int:
+    """ Returns the mask to apply to the part of a payload that starts `offset` bytes in """
+    mask_bytes = int_to_bytes(mask, 4)
+    offset %= 4
+    return bytes_to_int(mask_bytes[offset:] + mask_bytes[:offset])
+
+
+def _apply_mask_numpy(data, mask_bytes: bytes) -> bytes:
+    masked = numpy.frombuffer(data, dtype=numpy.uint8).copy()
+    aligned = len(masked) - len(masked) % 4
+    # XOR four bytes at a time, then whatever is left over at the end
+    masked[:aligned].view(numpy.uint32)[:] ^= numpy.frombuffer(mask_bytes, dtype=numpy.uint32)[0]
+    for x in range(aligned, len(masked)):
+        masked[x] ^= mask_bytes[x % 4]
+    return masked.tobytes()
+
+
 class WebSocketFrame:
     OPCODE_CONTINUATION = 0
     OPCODE_TEXT = 1
@@ -28,19 +70,56 @@ class WebSocketFrame:
     OPCODE_PONG = 10
     MAX_BUFFER_SIZE = 4096
 
+    CLOSE_NORMAL = 1000
+    CLOSE_GOING_AWAY = 1001
+    CLOSE_PROTOCOL_ERROR = 1002
+    CLOSE_MESSAGE_TOO_BIG = 1009
+
     header: WebSocketFrameHeaders
-    message: str
+    payload: bytes | memoryview
 
-    def __init__(self, headers: WebSocketFrameHeaders = None, message: str = ''):
+    def __init__(self, headers: WebSocketFrameHeaders = None, message: str | bytes = '', payload=None):
         self.headers = headers if headers else WebSocketFrameHeaders()
-        self.message = ''
+        self.payload = b''
+        self._text = None
+        if payload is not None:
+            self.set_payload(payload)
+        else:
+            self.set_message(message)
+
+    def __repr__(self):
+        return f"<WebSocketFrame opcode={self.headers.opcode} fin={self.headers.fin} length={len(self.payload)}>"
+
+    @property
+    def message(self) -> str:
+        """ The payload as text, only decoded (as UTF-8) the first time it's asked for """
+        if self._text is None:
+            self._text = str(self.payload, 'utf-8', 'replace')
+        return self._text
+
+    @message.setter
+    def message(self, message):
         self.set_message(message)
 
     def set_message(self, message):
-        self.message = message
-        self.headers.payload_length = len(self.message) if self.message else 0
-
-    def to_bytes(self):
+        """ Sets the payload from text, or from bytes if `message` is already encoded """
+        if isinstance(message, str):
+            self.set_payload(message.encode('utf-8'))
+            self._text = message
+        else:
+            self.set_payload(message)
+
+    def set_payload(self, payload):
+        """ Sets the raw payload; any bytes-like object is kept as-is, without copying it """
+        if not payload:
+            payload = b''
+        elif isinstance(payload, memoryview) and payload.format != 'B':
+            payload = payload.cast('B')
+        self.payload = payload
+        self._text = None
+        self.headers.payload_length = len(payload)
+
+    def header_bytes(self) -> bytes:
         byte_1 = 0
         byte_1 += self.headers.fin << 7
         byte_1 += self.headers.rsv << 4
@@ -62,23 +141,32 @@ class WebSocketFrame:
             payload_length_bytes += self.headers.payload_length
 
         compiled_bytes += int_to_bytes(byte_2, 1)
-        compiled_bytes += int_to_bytes(payload_length_bytes, payload_length_byte_count)
-
+        # extended payload lengths are in network (big-endian) byte order
+        compiled_bytes += int.to_bytes(payload_length_bytes, payload_length_byte_count, 'big')
         if bool(self.headers.mask_flag):
-            mask = self.headers.mask
-            compiled_bytes += int_to_bytes(mask, 4)
-            for x, char in enumerate(self.message):
-                mask_index = x % 4
-                shift_distance = 8 * mask_index
-                mask_byte = mask & (255 << shift_distance)  # shift 11111111 and bitwise-AND to get the right mask byte
-                mask_byte >>= shift_distance  # shift the mask byte back so its value is the correct magnitude
-                masked_char = ord(char) ^ mask_byte
-                compiled_bytes += int_to_bytes(masked_char, 1)
-        elif self.message:
-            for char in self.message:
-                compiled_bytes += int_to_bytes(ord(char), 1)
+            compiled_bytes += int_to_bytes(self.headers.mask, 4)
         return compiled_bytes
 
+    def payload_file(self):
+        """ Returns the payload as a read-only file-like object, a spooled payload is already one """
+        if isinstance(self.payload, mmap.mmap):
+            self.payload.seek(0)
+            return self.payload
+        return io.BytesIO(self.payload)
+
+    def is_spooled(self) -> bool:
+        return isinstance(self.payload, mmap.mmap)
+
+    def to_buffers(self) -> tuple:
+        """ Returns the encoded frame as (header bytes, payload) so it can be queued without joining the two;
+            an unmasked payload is returned as the same object the frame holds """
+        if bool(self.headers.mask_flag):
+            return self.header_bytes(), apply_mask(self.payload, self.headers.mask)
+        return self.header_bytes(), self.payload
+
+    def to_bytes(self):
+        return b''.join(self.to_buffers())
+
     def encode(self):
         # alias for to_bytes
         return self.to_bytes()
@@ -93,42 +181,51 @@ class WebSocketFrame:
         frame = WebSocketFrame(headers=headers, message=message)
         return frame
 
+    @classmethod
+    def get_binary_frame(cls, payload):
+        headers = WebSocketFrameHeaders(opcode=cls.OPCODE_BINARY)
+        return WebSocketFrame(headers=headers, payload=payload)
+
     @classmethod
     def get_close_frame(cls, message=None):
         headers = WebSocketFrameHeaders(opcode=cls.OPCODE_CLOSE, payload_length=len(message) if message else 0)
         return WebSocketFrame(headers=headers, message=message)
 
+    @classmethod
+    def get_close_status_frame(cls, status, reason=''):
+        """ Builds a CLOSE frame whose payload is a status code followed by an optional (text) reason """
+        # control frame payloads are limited to 125 bytes, two of which are the status
+        return cls.get_close_frame(int.to_bytes(status, 2, 'big') + reason.encode('utf-8')[:123])
+
+    @classmethod
+    def get_ping_frame(cls, message=None):
+        headers = WebSocketFrameHeaders(opcode=cls.OPCODE_PING, payload_length=len(message) if message else 0)
+        return WebSocketFrame(headers=headers, message=message)
+
     @classmethod
     def get_pong_frame(cls, message=None):
         headers = WebSocketFrameHeaders(opcode=cls.OPCODE_PONG, payload_length=len(message) if message else 0)
         return WebSocketFrame(headers=headers, message=message)
 
     @classmethod
-    def from_bytes_reader(cls, bytes_reader: stevesockets.server.SocketBytesReader) -> WebSocketFrame:
+    def from_bytes_reader(cls, bytes_reader: stevesockets.socketconnection.SocketBytesReader,
+                          max_frame_size=None) -> WebSocketFrame:
         headers = WebSocketFrameHeaders.from_bytes(bytes_reader)
+        if max_frame_size is not None and headers.payload_length > max_frame_size:
+            raise FrameTooBig(f'Frame payload of {headers.payload_length} bytes is over the {max_frame_size} limit')
+
+        payload = bytes_reader.get_next_bytes(headers.payload_length)
+        if len(payload) != headers.payload_length:
+            raise SocketException('Connection closed before the full payload was received')
 
-        message = ""
-        mask = headers.mask
-        for x in range(headers.payload_length):
-            char_data = bytes_to_int(bytes_reader.get_next_bytes(1))
-            if bool(headers.mask_flag):
-                # unmasking cycles through each of the four bytes of the mask, bitwise-XOR'ing with the masked character
-                # byte to get the unmasked character
-                mask_index = x % 4
-                shift_distance = 8 * mask_index
-                mask_byte = mask & (255 << shift_distance)  # shift 11111111 and bitwise-AND to get the right mask byte
-                mask_byte >>= shift_distance  # shift the mask byte back so its value is the correct magnitude
-                char = chr(char_data ^ mask_byte)
-            else:
-                char = chr(char_data)
-            message += char
-
-        return cls(headers=headers, message=message)
+        if bool(headers.mask_flag):
+            payload = apply_mask(payload, headers.mask)
+
+        return cls(headers=headers, payload=payload)
 
     @classmethod
     def read_from_connection(cls, connection):
-        reader = stevesockets.server.SocketBytesReader(connection)
-        return cls.from_bytes_reader(reader)
+        return cls.from_bytes_reader(connection.bytes_reader)
 
 
 class WebSocketFrameHeaders:
@@ -149,7 +246,7 @@ class WebSocketFrameHeaders:
 
         byte_1, byte_2 = message_bytes
         fin = byte_1 >> 7
-        rsv = byte_1 & 112  # 01110000
+        rsv = (byte_1 >> 4) & 7  # 01110000
         opcode = byte_1 & 15  # 00001111
         mask_flag = byte_2 >> 7
         bits_9_15_val = byte_2 & 127  # 01111111
@@ -160,11 +257,15 @@ class WebSocketFrameHeaders:
         elif bits_9_15_val == 126:
             # next two bytes as a single value
             next_2 = bytes_reader.get_next_bytes(2)
-            payload_length = bytes_to_int(next_2)
+            if len(next_2) != 2:
+                raise SocketException('Bytes reader yielded insufficient bytes to build headers')
+            payload_length = int.from_bytes(next_2, 'big')
         elif bits_9_15_val == 127:
             # next eight bytes as a single value
             next_8 = bytes_reader.get_next_bytes(8)
-            payload_length = bytes_to_int(next_8)
+            if len(next_8) != 8:
+                raise SocketException('Bytes reader yielded insufficient bytes to build headers')
+            payload_length = int.from_bytes(next_8, 'big')
 
         mask = None
         if bool(mask_flag):
@@ -179,7 +280,223 @@ class WebSocketFrameHeaders:
                    payload_length=payload_length)
 
 
+class PayloadSpool:
+    """ Writes a payload to an anonymous temporary file as it arrives instead of keeping it in memory. The finished
+        payload is a read-only memory map of the file, which works both as a bytes-like payload (paged in from the
+        file as it's read) and as a file; the file's space is given back once the map is garbage collected. """
+
+    __slots__ = ("file", "size")
+
+    def __init__(self):
+        self.file = tempfile.TemporaryFile()
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def write(self, data):
+        self.file.write(data)
+        self.size += len(data)
+
+    def map(self) -> mmap.mmap | bytes:
+        """ Closes the spool and returns the memory mapped payload """
+        self.file.flush()
+        try:
+            return mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if self.size else b''
+        finally:
+            # the map doesn't need the file descriptor kept open
+            self.file.close()
+
+
+class FragmentedMessage:
+    """ Collects the payloads of a message sent as several frames until its final frame arrives, moving it to a
+        PayloadSpool once it reaches `spool_threshold` bytes.
+
+        Payloads are copied into a buffer allocated up front from the first fragment's size, which doubles (up to
+        `max_size`) when a fragment doesn't fit, so a message of n bytes is reallocated O(log n) times at most. """
+
+    # smallest buffer allocated for a message, so small first fragments don't lead to many early reallocations
+    INITIAL_CAPACITY = 4096
+
+    def __init__(self, headers: WebSocketFrameHeaders, spool_threshold=None, max_size=None):
+        self.opcode = headers.opcode
+        self.rsv = headers.rsv
+        # preallocated buffer, of which the first `length` bytes hold the message so far
+        self.payload = bytearray()
+        self.length = 0
+        self.fragments = 0
+        self.spool_threshold = spool_threshold
+        self.max_size = max_size
+        self.spool = None
+
+    def add(self, frame: WebSocketFrame):
+        if self.spool is None and self.spool_threshold and self.length + len(frame.payload) >= self.spool_threshold:
+            self.spool = PayloadSpool()
+            self.spool.write(memoryview(self.payload)[:self.length])
+            self.payload = bytearray()
+            self.length = 0
+        if self.spool is not None:
+            self.spool.write(frame.payload)
+        else:
+            end = self.length + len(frame.payload)
+            if end > len(self.payload):
+                self._grow(end)
+            self.payload[self.length:end] = frame.payload
+            self.length = end
+        self.fragments += 1
+
+    def _grow(self, needed):
+        """ Makes room for at least `needed` bytes: room for two fragments like the first one to start with, then twice
+            the capacity each time """
+        capacity = max(2 * (len(self.payload) if self.payload else needed), self.INITIAL_CAPACITY)
+        for limit in (self.max_size, self.spool_threshold):
+            if limit:
+                # never allocated past what the message can be before it's failed or spooled
+                capacity = min(capacity, limit)
+        self.payload.extend(bytes(max(capacity, needed) - len(self.payload)))
+
+    def size(self) -> int:
+        return len(self.spool) if self.spool is not None else self.length
+
+    def to_frame(self) -> WebSocketFrame:
+        # the buffer is handed over as the payload, the message isn't copied again once complete
+        headers = WebSocketFrameHeaders(fin=1, opcode=self.opcode, rsv=self.rsv)
+        if self.spool is not None:
+            return WebSocketFrame(headers=headers, payload=self.spool.map())
+        # trimming the unused capacity off the end doesn't copy the message
+        del self.payload[self.length:]
+        return WebSocketFrame(headers=headers, payload=self.payload)
+
+
+class WebSocketFrameParser:
+    """ Incrementally parses frames out of whatever bytes have arrived on a connection. `feed` never blocks; it
+        returns every frame completed by the new data and keeps any partial frame until more bytes are fed.
+
+        A frame whose header declares more than `max_frame_size` bytes of payload is rejected before any of it is
+        buffered. Payloads of at least `spool_threshold` bytes are written to a PayloadSpool as they arrive rather
+        than held in memory until the whole frame has been received. """
+
+    __slots__ = ("buffer", "state", "headers", "needed", "max_frame_size", "spool_threshold", "spool")
+
+    READING_HEADER = "header"
+    READING_LENGTH = "length"
+    READING_MASK = "mask"
+    READING_PAYLOAD = "payload"
+
+    CONTROL_OPCODES = (WebSocketFrame.OPCODE_CLOSE, WebSocketFrame.OPCODE_PING, WebSocketFrame.OPCODE_PONG)
+    DATA_OPCODES = (WebSocketFrame.OPCODE_CONTINUATION, WebSocketFrame.OPCODE_TEXT, WebSocketFrame.OPCODE_BINARY)
+
+    def __init__(self, max_frame_size=None, spool_threshold=None):
+        self.buffer = bytearray()
+        self.max_frame_size = max_frame_size
+        self.spool_threshold = spool_threshold
+        self.spool = None
+        self.reset()
+
+    def reset(self):
+        """ Gets ready to read the header of the next frame """
+        self.state = WebSocketFrameParser.READING_HEADER
+        self.headers = None
+        self.needed = 2
+
+    def feed(self, data) -> list[WebSocketFrame]:
+        self.buffer += data
+        frames = []
+        position = 0
+        with memoryview(self.buffer) as view:
+            while True:
+                available = len(view) - position
+                if self.spool is not None and available:
+                    # a spooled payload is written out as it arrives
+                    count = min(available, self.needed)
+                    with view[position:position + count] as chunk:
+                        position += count
+                        frame = self._spool_payload(chunk)
+                elif self.spool is None and available >= self.needed:
+                    with view[position:position + self.needed] as chunk:
+                        position += self.needed
+                        frame = self._consume(chunk)
+                else:
+                    break
+                if frame:
+                    frames.append(frame)
+        del self.buffer[:position]
+        return frames
+
+    def _consume(self, chunk: memoryview) -> WebSocketFrame | None:
+        """ Handles exactly `needed` bytes for the current state and moves on to the next one, returning the frame
+            once its payload has been read """
+        if self.state == WebSocketFrameParser.READING_HEADER:
+            self._read_header(chunk[0], chunk[1])
+        elif self.state == WebSocketFrameParser.READING_LENGTH:
+            self.headers.payload_length = int.from_bytes(chunk, 'big')
+            self._after_length()
+        elif self.state == WebSocketFrameParser.READING_MASK:
+            self.headers.mask = bytes_to_int(chunk)
+            self._start_payload()
+        else:
+            return self._build_frame(chunk)
+        return None
+
+    def _read_header(self, byte_1, byte_2):
+        self.headers = WebSocketFrameHeaders(fin=byte_1 >> 7,
+                                             rsv=(byte_1 >> 4) & 7,  # 01110000
+                                             opcode=byte_1 & 15,  # 00001111
+                                             mask_flag=byte_2 >> 7,
+                                             payload_length=byte_2 & 127)  # 01111111
+        if self.headers.opcode not in self.CONTROL_OPCODES + self.DATA_OPCODES:
+            raise SocketException(f'Unknown opcode {self.headers.opcode}')
+        if self.headers.opcode in self.CONTROL_OPCODES and (not self.headers.fin or self.headers.payload_length > 125):
+            raise SocketException('Control frames must not be fragmented or have payloads over 125 bytes')
+
+        if self.headers.payload_length == 126:
+            self.state, self.needed = WebSocketFrameParser.READING_LENGTH, 2
+        elif self.headers.payload_length == 127:
+            self.state, self.needed = WebSocketFrameParser.READING_LENGTH, 8
+        else:
+            self._after_length()
+
+    def _after_length(self):
+        if self.max_frame_size is not None and self.headers.payload_length > self.max_frame_size:
+            raise FrameTooBig(f'Frame payload of {self.headers.payload_length} bytes is over the '
+                              f'{self.max_frame_size} limit')
+        if bool(self.headers.mask_flag):
+            self.state, self.needed = WebSocketFrameParser.READING_MASK, 4
+        else:
+            self._start_payload()
+
+    def _start_payload(self):
+        self.state, self.needed = WebSocketFrameParser.READING_PAYLOAD, self.headers.payload_length
+        if (self.spool_threshold and self.needed >= self.spool_threshold
+                and self.headers.opcode not in WebSocketFrameParser.CONTROL_OPCODES):
+            # control frames (at most 125 bytes) are always kept in memory, pongs echo their payload straight back
+            self.spool = PayloadSpool()
+
+    def _spool_payload(self, chunk) -> WebSocketFrame | None:
+        if bool(self.headers.mask_flag):
+            # each chunk is unmasked on its own, so the mask is lined up with where the chunk starts
+            chunk = apply_mask(chunk, rotate_mask(self.headers.mask, len(self.spool)))
+        self.spool.write(chunk)
+        self.needed -= len(chunk)
+        if self.needed:
+            return None
+        headers, spool = self.headers, self.spool
+        self.spool = None
+        self.reset()
+        return WebSocketFrame(headers=headers, payload=spool.map())
+
+    def _build_frame(self, payload) -> WebSocketFrame:
+        headers = self.headers
+        payload = apply_mask(payload, headers.mask) if bool(headers.mask_flag) else bytes(payload)
+        self.reset()
+        return WebSocketFrame(headers=headers, payload=payload)
+
+
 class SocketException(Exception):
     pass
 
 
+class FrameTooBig(SocketException):
+    pass
+
+
@@ -0,0 +1,117 @@
+from __future__ import annotations
+
+import collections
+import concurrent.futures
+import logging
+import threading
+from stevesockets.messages import ListenerExecutor
+
+
+class OrderedExecutor:
+    """ Wraps a concurrent.futures executor so work submitted under the same key runs one item at a time, in the
+        order it was submitted, while work under different keys still runs in parallel """
+
+    def __init__(self, executor: concurrent.futures.Executor):
+        self.executor = executor
+        # key -> work waiting for the key's running item to finish, a key is only present while it has work running
+        self.waiting = {}
+        self._lock = threading.Lock()
+
+    def submit(self, key, fn, *args, callback=None):
+        """ Runs `fn(*args)` once everything submitted before it under `key` is done, then calls `callback` with its
+            future (from whichever thread completed it) """
+        work = (fn, args, callback)
+        with self._lock:
+            if key in self.waiting:
+                self.waiting[key].append(work)
+                return
+            self.waiting[key] = collections.deque()
+        self._run(key, work)
+
+    def _run(self, key, work):
+        fn, args, callback = work
+        try:
+            future = self.executor.submit(fn, *args)
+        except RuntimeError as err:
+            # the executor was shut down, fail the work rather than leaving the key blocked
+            future = concurrent.futures.Future()
+            future.set_exception(err)
+        future.add_done_callback(lambda done: self._done(key, callback, done))
+
+    def _done(self, key, callback, future):
+        if callback:
+            callback(future)
+        with self._lock:
+            waiting = self.waiting.get(key)
+            if not waiting:
+                # nothing else to run for the key, or the executor was shut down
+                self.waiting.pop(key, None)
+                return
+            work = waiting.popleft()
+        self._run(key, work)
+
+    def shutdown(self):
+        with self._lock:
+            self.waiting.clear()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class WorkerPool:
+    """ Runs the `handle` step of listeners that don't run inline (see Listener.executor) on thread or process
+        pools, created the first time they're needed. Each listener handles one message per connection at a time,
+        so results come back in the order the messages arrived. Finished work is collected in a thread-safe queue
+        and `notify` is called from the worker side, so the I/O loop knows to deliver it with `process_results`. """
+
+    def __init__(self, notify=None, logger=None, max_threads=None, max_processes=None):
+        self.notify = notify
+        self.logger = logger if logger else logging.getLogger()
+        self.max_threads = max_threads
+        self.max_processes = max_processes
+        self.results = collections.deque()
+        self.executors = {}
+
+    def _get_executor(self, mode: ListenerExecutor) -> OrderedExecutor:
+        if mode not in self.executors:
+            if mode == ListenerExecutor.PROCESS:
+                executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.max_processes)
+            else:
+                executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_threads,
+                                                                 thread_name_prefix="stevesockets-worker")
+            self.executors[mode] = OrderedExecutor(executor)
+        return self.executors[mode]
+
+    def submit(self, listener, message, *args, connection=None, **kwargs):
+        """ Runs `listener.handle(message)` on the listener's executor, the result is passed to `listener.respond`
+            along with the rest of the arguments once it's delivered """
+        def collect(future):
+            self.results.append((future, listener, message, args, connection, kwargs))
+            if self.notify:
+                self.notify()
+
+        self._get_executor(listener.executor).submit((listener, connection), listener.handle, message,
+                                                     callback=collect)
+
+    def process_results(self) -> int:
+        """ Hands every finished result to its listener's `respond`, must be called on the I/O loop. Returns how
+            many results were taken off the queue. """
+        count = 0
+        while self.results:
+            future, listener, message, args, connection, kwargs = self.results.popleft()
+            count += 1
+            if connection is not None and (connection.is_closed() or connection.is_to_be_closed()):
+                continue
+            if future.cancelled():
+                continue
+            try:
+                result = future.result()
+            except Exception as err:
+                self.logger.error(f"Listener {listener.__class__.__name__} failed handling a message: {err!r}")
+                continue
+            listener.respond(result, message, *args, connection=connection, **kwargs)
+        return count
+
+    def shutdown(self):
+        for executor in self.executors.values():
+            executor.shutdown()
+        self.executors = {}
+        self.results.clear()
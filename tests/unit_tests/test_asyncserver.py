@@ -0,0 +1,124 @@
+import asyncio
+import unittest
+from stevesockets.asyncserver import AsyncSocketServer
+from stevesockets.listeners import WebFrameListener
+from stevesockets.messages import Listener, MessageTypes
+from stevesockets.websocket.asyncserver import AsyncWebSocketServer
+from stevesockets.websocket.websocket import WebSocketFrame, WebSocketFrameParser
+
+HANDSHAKE = b"GET / HTTP/1.1\r\nHost: 127.0.0.1\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n" \
+            b"Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\nSec-WebSocket-Version: 13\r\n\r\n"
+
+
+def get_client_frame(message):
+    frame = WebSocketFrame.get_text_frame(message)
+    frame.headers.mask_flag = 1
+    frame.headers.mask = WebSocketFrame.generate_mask()
+    return frame.to_bytes()
+
+
+class AsyncEchoListener(Listener):
+
+    async def observe(self, message, *args, connection=None, **kwargs):
+        await asyncio.sleep(0)
+        connection.queue_message(b"echo:" + message)
+
+
+class AsyncWebSocketEchoListener(WebFrameListener):
+
+    async def observe(self, message, *args, connection=None, **kwargs):
+        await asyncio.sleep(0)
+        self.send_frame(connection, WebSocketFrame.get_text_frame(message.message))
+
+
+class TestAsyncSocketServer(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.server = AsyncSocketServer(address=("127.0.0.1", 0))
+        self.server.register_listener(AsyncEchoListener)
+        self.assertTrue(await self.server.start())
+        self.serve_task = asyncio.create_task(self.server.serve())
+
+    async def asyncTearDown(self):
+        self.server.stop_listening()
+        await asyncio.wait_for(self.serve_task, 5)
+
+    async def test_async_listener_response(self):
+        reader, writer = await asyncio.open_connection(*self.server.address)
+        writer.write(b"hello")
+        self.assertEqual(await asyncio.wait_for(reader.read(100), 5), b"echo:hello")
+        writer.close()
+
+    async def test_clients_served_concurrently(self):
+        first_reader, first_writer = await asyncio.open_connection(*self.server.address)
+        second_reader, second_writer = await asyncio.open_connection(*self.server.address)
+        second_writer.write(b"second")
+        first_writer.write(b"first")
+        self.assertEqual(await asyncio.wait_for(second_reader.read(100), 5), b"echo:second")
+        self.assertEqual(await asyncio.wait_for(first_reader.read(100), 5), b"echo:first")
+        self.assertEqual(len(self.server.peer_connections), 2)
+        first_writer.close()
+        second_writer.close()
+
+    async def test_stop_listening_closes_connections(self):
+        reader, writer = await asyncio.open_connection(*self.server.address)
+        writer.write(b"hello")
+        await asyncio.wait_for(reader.read(100), 5)
+        self.server.stop_listening()
+        await asyncio.wait_for(self.serve_task, 5)
+        self.assertEqual(self.server.peer_connections, [])
+        self.assertEqual(await asyncio.wait_for(reader.read(100), 5), b"")
+        writer.close()
+
+
+class TestAsyncWebSocketServer(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.server = AsyncWebSocketServer(address=("127.0.0.1", 0))
+        self.server.register_listener(AsyncWebSocketEchoListener, message_type=MessageTypes.TEXT)
+        self.assertTrue(await self.server.start())
+        self.serve_task = asyncio.create_task(self.server.serve())
+
+    async def asyncTearDown(self):
+        self.server.stop_listening()
+        await asyncio.wait_for(self.serve_task, 5)
+
+    async def _connect(self):
+        reader, writer = await asyncio.open_connection(*self.server.address)
+        writer.write(HANDSHAKE)
+        response = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 5)
+        self.assertTrue(response.startswith(b"HTTP/1.1 101"))
+        self.assertIn(b"Sec-WebSocket-Accept: s3pPLMBiTxaQ9kYGzzhZRbK+xOo=", response)
+        return reader, writer
+
+    async def _read_frames(self, reader, count):
+        parser = WebSocketFrameParser()
+        frames = []
+        while len(frames) < count:
+            frames += parser.feed(await asyncio.wait_for(reader.read(4096), 5))
+        return frames
+
+    async def test_echo(self):
+        reader, writer = await self._connect()
+        writer.write(get_client_frame("one") + get_client_frame("two"))
+        frames = await self._read_frames(reader, 2)
+        self.assertEqual([frame.message for frame in frames], ["one", "two"])
+        writer.close()
+
+    async def test_close_frame(self):
+        reader, writer = await self._connect()
+        close = WebSocketFrame.get_close_status_frame(WebSocketFrame.CLOSE_NORMAL)
+        close.headers.mask_flag = 1
+        close.headers.mask = WebSocketFrame.generate_mask()
+        writer.write(close.to_bytes())
+        frames = await self._read_frames(reader, 1)
+        self.assertEqual(frames[0].headers.opcode, WebSocketFrame.OPCODE_CLOSE)
+        self.assertEqual(await asyncio.wait_for(reader.read(100), 5), b"")
+        writer.close()
+
+    async def test_malformed_handshake(self):
+        reader, writer = await asyncio.open_connection(*self.server.address)
+        writer.write(b"nonsense\r\n\r\n")
+        response = await asyncio.wait_for(reader.read(4096), 5)
+        self.assertTrue(response.startswith(b"HTTP/1.1 400"))
+        writer.close()
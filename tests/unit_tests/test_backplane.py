@@ -0,0 +1,56 @@
+import os
+import tempfile
+import unittest
+from stevesockets.backplane import UnixDatagramBackplane
+
+
+class TestUnixDatagramBackplane(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.backplanes = [UnixDatagramBackplane(self.directory.name, name=name) for name in ("a", "b", "c")]
+        for backplane in self.backplanes:
+            backplane.start()
+
+    def tearDown(self):
+        for backplane in self.backplanes:
+            backplane.close()
+        self.directory.cleanup()
+
+    def test_encode_decode(self):
+        for channel in (None, "room", "ünïcode"):
+            message = b''.join(UnixDatagramBackplane.encode(channel, b'\x81\x04DATA'))
+            self.assertEqual(UnixDatagramBackplane.decode(message), (channel, b'\x81\x04DATA'))
+
+    def test_publish_reaches_other_processes(self):
+        publisher, first, second = self.backplanes
+        publisher.publish(None, b'\x81\x03ALL')
+        publisher.publish("room", memoryview(b'\x81\x04ROOM'))
+        expected = [(None, b'\x81\x03ALL'), ("room", b'\x81\x04ROOM')]
+        self.assertEqual(first.receive(), expected)
+        self.assertEqual(second.receive(), expected)
+        self.assertEqual(publisher.receive(), [])
+
+    def test_closed_peer_dropped(self):
+        publisher, first, second = self.backplanes
+        publisher.publish(None, b'first')
+        second.close()
+        self.assertFalse(os.path.exists(second.path))
+        # the peer list from before still has the closed socket, sending to it drops it
+        publisher.publish(None, b'second')
+        self.assertEqual(len(publisher.peers), 1)
+        self.assertEqual([data for _, data in first.receive()], [b'first', b'second'])
+
+    def test_killed_peer_socket_removed(self):
+        publisher, first, second = self.backplanes
+        publisher.publish(None, b'first')
+        # a killed process leaves its socket file behind with nothing bound to it
+        first.socket.close()
+        first.socket = None
+        self.assertTrue(os.path.exists(first.path))
+        publisher.peers.sort()
+        publisher.publish(None, b'second')
+        self.assertFalse(os.path.exists(first.path))
+        self.assertEqual(publisher.peers, [second.path])
+        # the dead peer coming first in the list didn't stop the message reaching the next one
+        self.assertEqual([data for _, data in second.receive()], [b'first', b'second'])
@@ -0,0 +1,88 @@
+import unittest
+import zlib
+from stevesockets.websocket.deflate import PerMessageDeflate, DeflateContext, RSV1
+from stevesockets.websocket.websocket import WebSocketFrame, WebSocketFrameParser, SocketException
+
+
+class TestPerMessageDeflate(unittest.TestCase):
+
+    def test_negotiate_defaults_to_no_context_takeover(self):
+        response, context = PerMessageDeflate().negotiate("permessage-deflate; client_max_window_bits")
+        self.assertEqual(response, "permessage-deflate; server_no_context_takeover; client_no_context_takeover")
+        self.assertFalse(context.server_context_takeover)
+        self.assertFalse(context.client_context_takeover)
+        self.assertEqual(context.client_window_bits, 15)
+
+    def test_negotiate_context_takeover(self):
+        deflate = PerMessageDeflate(context_takeover=True)
+        response, context = deflate.negotiate("permessage-deflate")
+        self.assertEqual(response, "permessage-deflate")
+        self.assertTrue(context.server_context_takeover)
+        response, context = deflate.negotiate("permessage-deflate; server_no_context_takeover")
+        self.assertEqual(response, "permessage-deflate; server_no_context_takeover")
+        self.assertFalse(context.server_context_takeover)
+        self.assertTrue(context.client_context_takeover)
+
+    def test_negotiate_window_bits(self):
+        deflate = PerMessageDeflate(server_max_window_bits=12, client_max_window_bits=11)
+        response, context = deflate.negotiate('permessage-deflate; server_max_window_bits=10; '
+                                              'client_max_window_bits="13"')
+        self.assertEqual(response, "permessage-deflate; server_no_context_takeover; client_no_context_takeover; "
+                                   "server_max_window_bits=10; client_max_window_bits=11")
+        self.assertEqual((context.server_window_bits, context.client_window_bits), (10, 11))
+        # the client's window can't be limited unless it offered to be
+        response, context = deflate.negotiate("permessage-deflate")
+        self.assertEqual(context.client_window_bits, 15)
+        self.assertNotIn("client_max_window_bits", response)
+
+    def test_negotiate_skips_unacceptable_offers(self):
+        deflate = PerMessageDeflate()
+        offers = ("x-webkit-deflate-frame, permessage-deflate; server_max_window_bits=8, "
+                  "permessage-deflate; unknown_param, permessage-deflate; server_max_window_bits")
+        self.assertIsNone(deflate.negotiate(offers))
+        response, _ = deflate.negotiate(offers + ", permessage-deflate")
+        self.assertTrue(response.startswith("permessage-deflate"))
+
+
+class TestDeflateContext(unittest.TestCase):
+
+    def test_round_trip(self):
+        context = DeflateContext(threshold=0)
+        frame = context.compress_frame(WebSocketFrame.get_text_frame('{"key": "value"}' * 50))
+        self.assertEqual(frame.headers.rsv, RSV1)
+        self.assertLess(len(frame.payload), 100)
+        self.assertFalse(frame.payload.endswith(b'\x00\x00\xff\xff'))
+        # RSV1 survives the trip through the frame parser
+        parsed, = WebSocketFrameParser().feed(frame.to_bytes())
+        self.assertEqual(parsed.headers.rsv, RSV1)
+        self.assertEqual(context.decompress_frame(parsed, 2 ** 20).message, '{"key": "value"}' * 50)
+
+    def test_threshold(self):
+        context = DeflateContext(threshold=100)
+        self.assertFalse(context.should_compress(WebSocketFrame.get_text_frame("x" * 99)))
+        self.assertTrue(context.should_compress(WebSocketFrame.get_text_frame("x" * 100)))
+        self.assertFalse(context.should_compress(WebSocketFrame.get_ping_frame("x" * 100)))
+
+    def test_context_takeover_keeps_state(self):
+        shared, independent = DeflateContext(server_context_takeover=True), DeflateContext()
+        message = b'{"event": "price", "symbol": "ABC"}'
+        self.assertEqual(shared.compress(message), independent.compress(message))
+        self.assertLess(len(shared.compress(message)), len(independent.compress(message)))
+        self.assertIsNotNone(shared.compressor)
+        self.assertIsNone(independent.compressor)
+
+    def test_decompress_limit(self):
+        context = DeflateContext()
+        payload = context.compress(b"x" * 10000)
+        self.assertEqual(len(context.decompress(payload, 10000)), 10000)
+        self.assertIsNone(context.decompress(payload, 9999))
+        with self.assertRaises(SocketException):
+            context.decompress(b"not deflate data", 100)
+
+    def test_client_context_takeover(self):
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+        context = DeflateContext(client_context_takeover=True)
+        for message in (b"TEST DATA", b"TEST DATA"):
+            # the second message refers back to the first
+            payload = compressor.compress(message) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            self.assertEqual(context.decompress(payload[:-4], 100), message)
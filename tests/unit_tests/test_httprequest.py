@@ -0,0 +1,119 @@
+import unittest
+from stevesockets.http.request import Headers, HttpRequest, HttpRequestParser, HttpParseError
+
+
+class TestHeaders(unittest.TestCase):
+
+    def test_case_insensitive_multidict(self):
+        headers = Headers([("Accept", "text/html"), ("X-Forwarded-For", "10.0.0.1"), ("x-forwarded-for", "10.0.0.2")])
+        self.assertEqual(headers["accept"], "text/html")
+        self.assertEqual(headers.get("X-FORWARDED-FOR"), "10.0.0.1")
+        self.assertEqual(headers.get_all("x-forwarded-for"), ["10.0.0.1", "10.0.0.2"])
+        self.assertIn("ACCEPT", headers)
+        self.assertIsNone(headers.get("Host"))
+        with self.assertRaises(KeyError):
+            headers["Host"]
+        self.assertEqual(len(headers), 3)
+
+    def test_tokens(self):
+        headers = Headers([("Connection", "keep-alive, Upgrade"), ("connection", " TE ")])
+        self.assertEqual(headers.get_tokens("Connection"), ["keep-alive", "upgrade", "te"])
+
+
+class TestHttpRequest(unittest.TestCase):
+
+    def test_target(self):
+        request = HttpRequest("GET", "/rooms/a%20b?page=2&tag=x&tag=y&empty=")
+        self.assertEqual(request.path, "/rooms/a b")
+        self.assertEqual(request.query, "page=2&tag=x&tag=y&empty=")
+        self.assertEqual(request.args, {"page": ["2"], "tag": ["x", "y"], "empty": [""]})
+        request = HttpRequest("GET", "http://example.com/status?verbose")
+        self.assertEqual((request.path, request.query), ("/status", "verbose"))
+
+    def test_keep_alive(self):
+        self.assertTrue(HttpRequest(version="HTTP/1.1").keep_alive)
+        self.assertFalse(HttpRequest(version="HTTP/1.1", headers=Headers([("Connection", "Close")])).keep_alive)
+        self.assertFalse(HttpRequest(version="HTTP/1.0").keep_alive)
+        self.assertTrue(HttpRequest(version="HTTP/1.0", headers=Headers([("Connection", "Keep-Alive")])).keep_alive)
+
+
+class TestHttpRequestParser(unittest.TestCase):
+
+    def test_byte_at_a_time(self):
+        data = (b"\r\nPOST /submit?x=1 HTTP/1.1\r\nHost: localhost\r\nContent-Type: text/plain\r\n"
+                b"Content-Length: 11\r\n\r\nhello worldGET / HTTP/1.0\r\n\r\n")
+        parser = HttpRequestParser()
+        requests = []
+        for i in range(len(data)):
+            requests += parser.feed(data[i:i + 1])
+        self.assertEqual([(r.method, r.path, r.query, r.body) for r in requests],
+                         [("POST", "/submit", "x=1", b"hello world"), ("GET", "/", "", b"")])
+        self.assertEqual(requests[0].headers["content-type"], "text/plain")
+        self.assertEqual(requests[1].version, "HTTP/1.0")
+        self.assertEqual(parser.buffer, b"")
+
+    def test_chunked(self):
+        data = (b"POST /upload HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n"
+                b"5;name=value\r\nhello\r\n6\r\n world\r\n0\r\nX-Checksum: abc\r\n\r\nGET /next HTTP/1.1\r\n\r\n")
+        for split in (len(data), 7):
+            parser = HttpRequestParser()
+            requests = []
+            for i in range(0, len(data), split):
+                requests += parser.feed(data[i:i + split])
+            self.assertEqual([(r.path, r.body) for r in requests], [("/upload", b"hello world"), ("/next", b"")])
+
+    def test_limits(self):
+        parser = HttpRequestParser(max_header_size=64, max_body_size=10)
+        with self.assertRaises(HttpParseError) as context:
+            parser.feed(b"GET / HTTP/1.1\r\n" + b"X-Header: value\r\n" * 4)
+        self.assertEqual(context.exception.status, 431)
+        with self.assertRaises(HttpParseError) as context:
+            HttpRequestParser(max_body_size=10).feed(b"POST / HTTP/1.1\r\nContent-Length: 11\r\n\r\n")
+        self.assertEqual(context.exception.status, 413)
+        with self.assertRaises(HttpParseError) as context:
+            HttpRequestParser(max_body_size=10).feed(b"POST / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n"
+                                                     b"6\r\nhello \r\n6\r\n")
+        self.assertEqual(context.exception.status, 413)
+
+    def test_malformed(self):
+        for data, status in ((b"GET /\r\n\r\n", 400),
+                             (b"GET / HTTP/2.0\r\n\r\n", 505),
+                             (b"GET / HTTP/1.1\r\nBad Header: x\r\n\r\n", 400),
+                             (b"GET / HTTP/1.1\r\nX-Folded: a\r\n b\r\n\r\n", 400),
+                             (b"POST / HTTP/1.1\r\nContent-Length: -1\r\n\r\n", 400),
+                             # digits to str.isdigit but not to int()
+                             (b"POST / HTTP/1.1\r\nContent-Length: \xb2\r\n\r\n", 400),
+                             (b"GET http://[::1 HTTP/1.1\r\n\r\n", 400),
+                             (b"POST / HTTP/1.1\r\nContent-Length: 1\r\nTransfer-Encoding: chunked\r\n\r\n", 400),
+                             (b"POST / HTTP/1.1\r\nTransfer-Encoding: gzip, chunked\r\n\r\n", 501),
+                             (b"POST / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n0x5\r\n", 400),
+                             (b"POST / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n1\r\nab\r\n", 400)):
+            with self.assertRaises(HttpParseError) as context:
+                HttpRequestParser().feed(data)
+            self.assertEqual(context.exception.status, status, data)
+
+    def test_expecting_continue(self):
+        parser = HttpRequestParser()
+        parser.feed(b"PUT / HTTP/1.1\r\nContent-Length: 4\r\nExpect: 100-continue\r\n\r\n")
+        self.assertTrue(parser.expecting_continue)
+        parser.feed(b"DA")
+        self.assertFalse(parser.expecting_continue)
+        request, = parser.feed(b"TA")
+        self.assertEqual(request.body, b"DATA")
+        self.assertFalse(parser.expecting_continue)
+
+    def test_expecting_continue_once_and_only_for_http_1_1(self):
+        parser = HttpRequestParser()
+        parser.feed(b"PUT / HTTP/1.0\r\nContent-Length: 4\r\nExpect: 100-continue\r\n\r\n")
+        self.assertFalse(parser.expecting_continue)
+        parser = HttpRequestParser()
+        parser.feed(b"PUT / HTTP/1.1\r\nTransfer-Encoding: chunked\r\nExpect: 100-continue\r\n\r\n")
+        self.assertTrue(parser.expecting_continue)
+        parser.continue_sent = True
+        # half a chunk size line adds nothing to the body, but the client has already been told to go on
+        parser.feed(b"4")
+        self.assertFalse(parser.expecting_continue)
+        request, = parser.feed(b"\r\nDATA\r\n0\r\n\r\n")
+        self.assertEqual(request.body, b"DATA")
+        parser.feed(b"PUT / HTTP/1.1\r\nContent-Length: 4\r\nExpect: 100-continue\r\n\r\n")
+        self.assertTrue(parser.expecting_continue)
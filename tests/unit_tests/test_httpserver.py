@@ -0,0 +1,152 @@
+import unittest
+from unittest.mock import Mock
+from stevesockets.http.server import HttpServer, HttpConnection
+from stevesockets.messages import Listener
+from stevesockets.timers import TimerWheel
+
+
+class RecordingListener(Listener):
+
+    def __init__(self):
+        super(RecordingListener, self).__init__()
+        self.requests = []
+
+    def observe(self, message, *args, connection=None, **kwargs):
+        self.requests.append(message)
+        body = message.path.encode()
+        connection.queue_message(f"HTTP/1.1 200 OK\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body)
+
+
+class TestHttpServer(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        self.server = HttpServer(keep_alive_timeout=5)
+        self.server.timers = TimerWheel(clock=lambda: self.now)
+        self.listener = RecordingListener()
+        self.server.message_manager.listen_for_message(self.listener)
+
+    def _get_connection(self, *chunks):
+        conn = HttpConnection(Mock(), "127.0.0.1", 5555)
+        remaining = list(chunks)
+
+        def recv_into(buffer, nbytes=0):
+            if not remaining:
+                raise BlockingIOError()
+            chunk = remaining.pop(0)
+            buffer[:len(chunk)] = chunk
+            return len(chunk)
+
+        conn.socket.recv_into = Mock(side_effect=recv_into)
+        conn.socket.sendmsg = Mock(side_effect=lambda buffers: sum(len(b) for b in buffers))
+        conn.on_dirty = self.server._mark_dirty
+        return conn
+
+    def _handle(self, conn):
+        self.server._handle_connection_event(conn)
+
+    def _sent(self, conn):
+        return b''.join(b''.join(c.args[0]) for c in conn.socket.sendmsg.call_args_list)
+
+    def test_pipelined_requests_answered_in_order(self):
+        pipelined = b"GET /a HTTP/1.1\r\n\r\nGET /b HTTP/1.1\r\n\r\nGET /c HTTP/1.1\r\n\r\nGET /d HT"
+        conn = self._get_connection(pipelined, b"TP/1.1\r\n\r\n")
+        self._handle(conn)
+        self.assertEqual([request.path for request in self.listener.requests], ["/a", "/b", "/c"])
+        self._handle(conn)
+        self.assertEqual(self.listener.requests[-1].path, "/d")
+        self.assertEqual(self._sent(conn), b"".join(b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\n" + path
+                                                    for path in (b"/a", b"/b", b"/c", b"/d")))
+        self.assertFalse(conn.to_be_closed)
+
+    def test_connection_close(self):
+        conn = self._get_connection(b"GET /a HTTP/1.1\r\nConnection: close\r\n\r\nGET /b HTTP/1.1\r\n\r\n")
+        self._handle(conn)
+        self.assertEqual(len(self.listener.requests), 1)
+        self.assertTrue(conn.to_be_closed)
+        self.assertTrue(self._sent(conn).endswith(b"/a"))
+
+    def test_http_1_0_closes_by_default(self):
+        conn = self._get_connection(b"GET /a HTTP/1.0\r\n\r\n")
+        self._handle(conn)
+        self.assertTrue(conn.to_be_closed)
+        conn = self._get_connection(b"GET /a HTTP/1.0\r\nConnection: keep-alive\r\n\r\n")
+        self._handle(conn)
+        self.assertFalse(conn.to_be_closed)
+
+    def test_keep_alive_timeout(self):
+        idle = self._get_connection(b"GET /a HTTP/1.1\r\n\r\n")
+        busy = self._get_connection(b"GET /b HTTP/1.1\r\n\r\n")
+        self._handle(idle)
+        self._handle(busy)
+        self.now += 4
+        # a new request restarts the timer
+        busy.socket.recv_into.side_effect = [BlockingIOError()]
+        busy.request_parser.buffer += b"GET /c HTTP/1.1\r\n"
+        busy.bytes_reader.buffer += b"\r\n"
+        self._handle(busy)
+        self.now += 1.5
+        self.server.timers.advance()
+        self.assertTrue(idle.to_be_closed)
+        self.assertFalse(busy.to_be_closed)
+        self.now += 4
+        self.server.timers.advance()
+        self.assertTrue(busy.to_be_closed)
+
+    def test_request_body_isnt_read_as_a_request(self):
+        conn = self._get_connection(b"POST /a HTTP/1.1\r\nContent-Length: 19\r\n\r\nGET /x HTTP",
+                                    b"/1.1\r\n\r\nGET /b HTTP/1.1\r\n\r\n")
+        self._handle(conn)
+        self.assertEqual(self.listener.requests, [])
+        self._handle(conn)
+        self.assertEqual([(request.path, request.body) for request in self.listener.requests],
+                         [("/a", b"GET /x HTTP/1.1\r\n\r\n"), ("/b", b"")])
+
+    def test_malformed_request(self):
+        conn = self._get_connection(b"GET /a HTTP/1.1\r\nContent-Length: 1\r\nContent-Length: 2\r\n\r\n")
+        self._handle(conn)
+        self.assertEqual(self.listener.requests, [])
+        self.server.flush_dirty_connections()
+        self.assertTrue(self._sent(conn).startswith(b"HTTP/1.1 400 Bad Request\r\n"))
+        self.assertTrue(conn.to_be_closed)
+
+    def test_invalid_content_length_and_target_answered_with_400(self):
+        for data in (b"POST /a HTTP/1.1\r\nContent-Length: \xb2\r\n\r\n", b"GET http://[::1 HTTP/1.1\r\n\r\n"):
+            conn = self._get_connection(data)
+            self._handle(conn)
+            self.server.flush_dirty_connections()
+            self.assertTrue(self._sent(conn).startswith(b"HTTP/1.1 400 Bad Request\r\n"), data)
+            self.assertTrue(conn.to_be_closed)
+
+    def test_expect_continue(self):
+        conn = self._get_connection(b"PUT /a HTTP/1.1\r\nContent-Length: 4\r\nExpect: 100-continue\r\n\r\n", b"DATA")
+        self._handle(conn)
+        self.server.flush_dirty_connections()
+        self.assertEqual(self._sent(conn), b"HTTP/1.1 100 Continue\r\n\r\n")
+        self._handle(conn)
+        self.assertEqual(self.listener.requests[0].body, b"DATA")
+        self.assertTrue(self._sent(conn).endswith(b"\r\n\r\n/a"))
+
+    def test_expect_continue_after_pipelined_request(self):
+        conn = self._get_connection(b"GET /a HTTP/1.1\r\n\r\nPUT /b HTTP/1.1\r\nContent-Length: 4\r\n"
+                                    b"Expect: 100-continue\r\n\r\n", b"DATA")
+        self._handle(conn)
+        self.server.flush_dirty_connections()
+        # the answer to the earlier request first, then the go-ahead for the body
+        self.assertEqual(self._sent(conn), b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\n/a"
+                                           b"HTTP/1.1 100 Continue\r\n\r\n")
+        self._handle(conn)
+        self.assertEqual([request.body for request in self.listener.requests], [b"", b"DATA"])
+
+    def test_expect_continue_sent_once(self):
+        conn = self._get_connection(b"PUT /a HTTP/1.1\r\nTransfer-Encoding: chunked\r\nExpect: 100-continue\r\n\r\n",
+                                    b"4", b"\r\nDATA\r\n0\r\n\r\n")
+        for _ in range(3):
+            self._handle(conn)
+        self.server.flush_dirty_connections()
+        self.assertEqual(self._sent(conn).count(b"100 Continue"), 1)
+        self.assertEqual(self.listener.requests[0].body, b"DATA")
+        conn = self._get_connection(b"PUT /a HTTP/1.0\r\nContent-Length: 4\r\nExpect: 100-continue\r\n\r\n")
+        self._handle(conn)
+        self.server.flush_dirty_connections()
+        self.assertEqual(self._sent(conn), b"")
@@ -0,0 +1,71 @@
+import os
+import signal
+import socket
+import time
+import unittest
+from stevesockets.asyncserver import AsyncSocketServer
+from stevesockets.messages import Listener
+from stevesockets.prefork import PreforkSupervisor
+
+
+class PidListener(Listener):
+
+    def observe(self, message, *args, connection=None, **kwargs):
+        connection.queue_message(str(os.getpid()).encode())
+
+
+@unittest.skipUnless(hasattr(os, "fork") and hasattr(socket, "SO_REUSEPORT"), "needs fork and SO_REUSEPORT")
+class TestPreforkSupervisor(unittest.TestCase):
+
+    def setUp(self):
+        with socket.socket() as sck:
+            sck.bind(("127.0.0.1", 0))
+            self.address = sck.getsockname()
+
+        def build_server():
+            server = AsyncSocketServer(address=self.address)
+            server.register_listener(PidListener)
+            return server
+
+        self.supervisor = PreforkSupervisor(build_server, workers=2)
+        self.supervisor.start()
+
+    def tearDown(self):
+        self.supervisor.stop()
+
+    def _request_pid(self):
+        deadline = time.time() + 5
+        while True:
+            try:
+                with socket.create_connection(self.address, timeout=5) as client:
+                    client.sendall(b"pid?")
+                    return int(client.recv(100))
+            except (ConnectionRefusedError, ValueError):
+                # workers are still starting up
+                if time.time() > deadline:
+                    raise
+                time.sleep(.05)
+
+    def test_workers_serve_same_address(self):
+        self.assertEqual(len(self.supervisor.workers), 2)
+        self.assertIn(self._request_pid(), self.supervisor.workers)
+
+    def test_crashed_worker_restarted(self):
+        self.supervisor.RESTART_DELAY = 0
+        crashed = self._request_pid()
+        os.kill(crashed, signal.SIGKILL)
+        deadline = time.time() + 5
+        while crashed in self.supervisor.workers and time.time() < deadline:
+            self.supervisor.check_workers()
+            time.sleep(.05)
+        self.assertNotIn(crashed, self.supervisor.workers)
+        self.assertEqual(len(self.supervisor.workers), 2)
+        self.assertNotEqual(self._request_pid(), crashed)
+
+    def test_stop(self):
+        pids = list(self.supervisor.workers)
+        self.supervisor.stop()
+        self.assertEqual(self.supervisor.workers, {})
+        for pid in pids:
+            with self.assertRaises(ChildProcessError):
+                os.waitpid(pid, os.WNOHANG)
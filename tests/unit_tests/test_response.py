@@ -0,0 +1,173 @@
+import socket
+import unittest
+from unittest.mock import Mock
+from stevesockets.http.request import HttpRequest, HttpRequestParser
+from stevesockets.http.response import HttpResponse, STATUS_LINES, get_status_line
+from stevesockets.http.server import HttpServer, HttpConnection
+from stevesockets.socketconnection import SocketConnection
+
+
+def read_chunked(data):
+    """ The body of a chunked message and what followed it """
+    body = b""
+    while True:
+        size, data = data.split(b"\r\n", 1)
+        size = int(size, 16)
+        if not size:
+            return body, data[2:]
+        body, data = body + data[:size], data[size + 2:]
+
+
+class TestHttpResponse(unittest.TestCase):
+
+    def setUp(self):
+        self.server_socket, self.client_socket = socket.socketpair()
+        self.addCleanup(self.server_socket.close)
+        self.addCleanup(self.client_socket.close)
+        self.server_socket.setblocking(False)
+        self.client_socket.settimeout(5)
+
+    def _get_connection(self, **kwargs):
+        return SocketConnection(self.server_socket, "127.0.0.1", 5555, **kwargs)
+
+    def _drain(self, connection):
+        received = b""
+        while connection.has_pending_output():
+            connection.flush_messages()
+            received += self.client_socket.recv(2 ** 20)
+        self.client_socket.setblocking(False)
+        try:
+            received += self.client_socket.recv(2 ** 20)
+        except BlockingIOError:
+            pass
+        return received
+
+    def test_status_lines(self):
+        self.assertEqual(get_status_line(404), b"HTTP/1.1 404 Not Found\r\n")
+        self.assertIs(get_status_line(200), get_status_line(200))
+        self.assertEqual(get_status_line(599), b"HTTP/1.1 599 \r\n")
+        self.assertIn(599, STATUS_LINES)
+        with self.assertRaises(ValueError):
+            get_status_line(1000)
+
+    def test_to_bytes(self):
+        response = HttpResponse("héllo", headers={"X-Room": 42}, content_type="text/plain; charset=utf-8")
+        self.assertEqual(response.to_bytes(), b"HTTP/1.1 200 OK\r\nX-Room: 42\r\nContent-Type: text/plain; charset=utf-8"
+                                              b"\r\nContent-Length: 6\r\n\r\nh\xc3\xa9llo")
+        for status in (101, 204, 304):
+            self.assertEqual(HttpResponse(b"ignored", status=status).to_bytes(), get_status_line(status) + b"\r\n")
+        for headers in ([("Location", "/\r\nSet-Cookie: x=1")], {"X-Snowman": "\u2603"}, {"Bad Name": "x"}):
+            with self.assertRaises(ValueError):
+                HttpResponse(headers=headers).to_bytes()
+
+    def test_send_bytes(self):
+        connection = Mock()
+        HttpResponse(b"body", status=201).send(connection, HttpRequest("HEAD", "/"))
+        connection.queue_message.assert_called_once_with(b"HTTP/1.1 201 Created\r\nContent-Length: 4\r\n\r\n")
+        connection.set_producer.assert_not_called()
+
+    def test_stream_chunked(self):
+        connection = self._get_connection(write_buffer_high=2 ** 16, write_buffer_low=2 ** 14)
+        produced = []
+        pending = []
+
+        def body():
+            for i in range(200):
+                produced.append(i)
+                pending.append(connection.pending_bytes)
+                yield b"x" * 4096 if i % 2 else f"{i:04}"
+
+        HttpResponse(body(), content_type="text/plain").send(connection, HttpRequest("GET", "/"))
+        self.assertEqual(produced, [])
+        received = self._drain(connection)
+        self.assertEqual(len(produced), 200)
+        # taken from the generator only while the write buffer had room for it
+        self.assertLessEqual(max(pending), 2 ** 16)
+        head, body = received.split(b"\r\n\r\n", 1)
+        self.assertEqual(head, b"HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\nTransfer-Encoding: chunked")
+        self.assertEqual(read_chunked(body), (b"".join(b"x" * 4096 if i % 2 else f"{i:04}".encode()
+                                                       for i in range(200)), b""))
+        self.assertIsNone(connection.producer)
+        self.assertFalse(connection.is_to_be_closed())
+
+    def test_stream_head_and_known_length(self):
+        connection = self._get_connection()
+        HttpResponse(iter([b"never"])).send(connection, HttpRequest("HEAD", "/"))
+        self.assertEqual(self._drain(connection), b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n")
+
+        connection = self._get_connection()
+        HttpResponse(iter([b"ab", "cd"]), headers={"Content-Length": 4}).send(connection)
+        self.assertEqual(self._drain(connection), b"HTTP/1.1 200 OK\r\nContent-Length: 4\r\n\r\nabcd")
+        self.assertFalse(connection.is_to_be_closed())
+
+    def test_stream_to_http_1_0(self):
+        connection = self._get_connection()
+        HttpResponse(iter([b"ab", b"cd"])).send(connection, HttpRequest("GET", "/", version="HTTP/1.0"))
+        self.assertEqual(self._drain(connection), b"HTTP/1.1 200 OK\r\n\r\nabcd")
+        # the client can only tell the body ended by the connection closing
+        self.assertTrue(connection.is_to_be_closed())
+
+    def test_failing_stream_closes_connection(self):
+        def body():
+            yield b"partial"
+            raise RuntimeError("database went away")
+
+        connection = self._get_connection()
+        HttpResponse(body()).send(connection)
+        connection.flush_messages()
+        self.assertTrue(connection.is_to_be_closed())
+        self.assertFalse(connection.has_pending_output())
+
+
+class TestHttpServerStreaming(unittest.TestCase):
+
+    def test_pipelined_requests_wait_for_stream(self):
+        server = HttpServer()
+        server_socket, client_socket = socket.socketpair()
+        self.addCleanup(server_socket.close)
+        self.addCleanup(client_socket.close)
+        server_socket.setblocking(False)
+        client_socket.settimeout(5)
+        conn = HttpConnection(server_socket, "127.0.0.1", 5555, write_buffer_high=2 ** 14, write_buffer_low=2 ** 12)
+        conn.on_dirty = server._mark_dirty
+
+        @server.route("/stream")
+        def stream(request, connection=None, server=None):
+            return HttpResponse(b"s" * 1024 for _ in range(256))
+
+        @server.route("/after")
+        def after(request, connection=None, server=None):
+            return HttpResponse(b"after")
+
+        # the last request waits for 100 Continue before sending its body, which has to come after both answers
+        client_socket.sendall(b"GET /stream HTTP/1.1\r\n\r\nGET /after HTTP/1.1\r\n\r\n"
+                              b"PUT /upload HTTP/1.1\r\nContent-Length: 4\r\nExpect: 100-continue\r\n\r\n")
+        server._handle_connection_event(conn)
+        self.assertEqual(len(conn.pending_requests), 1)
+
+        received = b""
+        while server.dirty_connections or conn.has_pending_output():
+            server.flush_dirty_connections()
+            server._flush_connection(conn)
+            received += client_socket.recv(2 ** 20)
+        head, body = received.split(b"\r\n\r\n", 1)
+        self.assertIn(b"Transfer-Encoding: chunked", head)
+        body, rest = read_chunked(body)
+        self.assertEqual(body, b"s" * 2 ** 18)
+        while not rest.endswith(b"100 Continue\r\n\r\n"):
+            rest += client_socket.recv(2 ** 20)
+        self.assertEqual(rest, b"HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\nafterHTTP/1.1 100 Continue\r\n\r\n")
+        self.assertFalse(conn.pending_requests)
+
+
+class TestResponseParsesBack(unittest.TestCase):
+
+    def test_round_trip(self):
+        """ What HttpResponse frames, a parser reading the same framing takes as one message """
+        response = HttpResponse(iter([b"one", b"two"]))
+        connection = Mock()
+        response.send(connection, HttpRequest("GET", "/"))
+        head = connection.queue_message.call_args.args[0]
+        chunks = b"".join(connection.set_producer.call_args.args[0])
+        request = HttpRequestParser().feed(b"POST /echo HTTP/1.1\r\n" + head.split(b"\r\n", 1)[1] + chunks)
+        self.assertEqual([r.body for r in request], [b"onetwo"])
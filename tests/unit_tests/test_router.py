@@ -0,0 +1,97 @@
+import unittest
+from unittest.mock import Mock
+from stevesockets.http.request import HttpRequest
+from stevesockets.http.response import HttpResponse
+from stevesockets.http.router import Router
+from stevesockets.http.server import HttpServer
+from stevesockets.messages import MessageTypes
+
+
+class TestRouter(unittest.TestCase):
+
+    def setUp(self):
+        self.router = Router()
+        self.handlers = {}
+        for method, pattern in (("GET", "/"), ("GET", "/rooms"), ("POST", "/rooms"), ("GET", "/rooms/new"),
+                                ("GET", "/rooms/{id}"), ("GET", "/rooms/{room_id}/members/{member}"),
+                                ("DELETE", "/rooms/{id}"), ("GET", "/static/{path:path}"),
+                                ("GET", "/rooms/new/settings")):
+            self.handlers[method, pattern] = handler = Mock(name=f"{method} {pattern}")
+            self.router.add_route(method, pattern, handler)
+
+    def assertMatches(self, method, path, pattern, params=None):
+        self.assertEqual(self.router.match(method, path), (self.handlers[method.upper(), pattern], params or {}))
+
+    def test_literal_and_parameter_segments(self):
+        self.assertMatches("GET", "/", "/")
+        self.assertMatches("GET", "/rooms", "/rooms")
+        self.assertMatches("post", "/rooms", "/rooms")
+        self.assertMatches("GET", "/rooms/new", "/rooms/new")
+        self.assertMatches("GET", "/rooms/42", "/rooms/{id}", {"id": "42"})
+        self.assertMatches("DELETE", "/rooms/42", "/rooms/{id}", {"id": "42"})
+        self.assertMatches("GET", "/rooms/42/members/ann", "/rooms/{room_id}/members/{member}",
+                           {"room_id": "42", "member": "ann"})
+
+    def test_backtracks_from_literal_segment(self):
+        # "new" is a literal child of /rooms, but only the parameter leads on to /members
+        self.assertMatches("GET", "/rooms/new/members/ann", "/rooms/{room_id}/members/{member}",
+                           {"room_id": "new", "member": "ann"})
+        self.assertMatches("GET", "/rooms/new/settings", "/rooms/new/settings")
+
+    def test_rest_of_path(self):
+        self.assertMatches("GET", "/static/css/site.css", "/static/{path:path}", {"path": "css/site.css"})
+        self.assertIsNone(self.router.match("GET", "/static"))
+
+    def test_no_match(self):
+        self.assertIsNone(self.router.match("GET", "/missing"))
+        self.assertIsNone(self.router.match("GET", "/rooms/"))
+        self.assertIsNone(self.router.match("GET", "/rooms/42/members"))
+        self.assertIsNone(self.router.match("PUT", "/rooms/42"))
+        self.assertEqual(self.router.allowed_methods("/rooms/42"), ["DELETE", "GET"])
+        self.assertEqual(self.router.allowed_methods("/missing"), [])
+
+    def test_invalid_patterns(self):
+        for pattern in ("rooms", "/rooms/{id", "/{path:path}/members", "/rooms/x{id}"):
+            with self.assertRaises(ValueError):
+                self.router.add_route("GET", pattern, Mock())
+        with self.assertRaises(ValueError):
+            self.router.add_route("GET", "/rooms/{other}", Mock())
+
+    def test_observe(self):
+        server, connection = Mock(), Mock()
+        handler = Mock(return_value=b"response")
+        self.router.add_route("PUT", "/users/{name}", handler)
+        request = HttpRequest("PUT", "/users/ann")
+        self.router.observe(request, connection=connection, server=server)
+        handler.assert_called_once_with(request, connection=connection, server=server)
+        self.assertEqual(request.params, {"name": "ann"})
+        connection.queue_message.assert_called_once_with(b"response")
+
+        self.router.observe(HttpRequest("PATCH", "/rooms"), connection=connection, server=server)
+        server.send_response.assert_called_with(connection, 405, headers={"Allow": "GET, POST"})
+        self.router.observe(HttpRequest("GET", "/missing"), connection=connection, server=server)
+        server.send_response.assert_called_with(connection, 404)
+
+    def test_handler_error(self):
+        server, connection = Mock(), Mock()
+        self.router.add_route("GET", "/broken", Mock(side_effect=KeyError("name")))
+        self.router.observe(HttpRequest("GET", "/broken"), connection=connection, server=server)
+        server.send_error.assert_called_once_with(connection, 500)
+        connection.queue_message.assert_not_called()
+
+    def test_unsendable_response(self):
+        server, connection = Mock(), Mock()
+        self.router.add_route("GET", "/snowman", Mock(return_value=HttpResponse(b"", headers={"X": "\u2603"})))
+        self.router.observe(HttpRequest("GET", "/snowman"), connection=connection, server=server)
+        server.send_error.assert_called_once_with(connection, 500)
+        connection.queue_message.assert_not_called()
+
+    def test_server_route(self):
+        server = HttpServer()
+
+        @server.route("/health", methods=("GET", "HEAD"))
+        def health(request, connection=None, server=None):
+            return b"ok"
+
+        self.assertIn(server.router, server.message_manager.message_listeners[MessageTypes.DEFAULT])
+        self.assertEqual(server.router.match("HEAD", "/health"), (health, {}))
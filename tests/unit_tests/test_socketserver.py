@@ -1,7 +1,11 @@
+import selectors
 import unittest
 from unittest.mock import Mock
 from unittest import mock
 import stevesockets.server
+from stevesockets.socketconnection import SlowConsumerPolicy
+from stevesockets.timers import TimerWheel
+from tests import utils
 
 
 class TestSocketServer(unittest.TestCase):
@@ -11,6 +15,7 @@ class TestSocketServer(unittest.TestCase):
         stevesockets.server.select = Mock(select=Mock(return_value=([Mock()], None, None)))
         stevesockets.server.threading = Mock()
         self.server = stevesockets.server.SocketServer()
+        self.server.selector_cls = utils.MockSelector
 
     @mock.patch("stevesockets.server.socket")
     def test__create_socket(self, socket):
@@ -18,17 +23,43 @@ class TestSocketServer(unittest.TestCase):
         socket.socket.assert_called_once_with(stevesockets.server.socket.AF_INET, stevesockets.server.socket.SOCK_STREAM)
         self.server.socket.bind.assert_called_once_with(("127.0.0.1", 9000))
 
+    @mock.patch("stevesockets.server.socket")
+    def test__create_socket_reuse_port(self, socket):
+        self.server.reuse_port = True
+        self.server._create_socket()
+        self.server.socket.setsockopt.assert_any_call(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+    def test_idle_timeout(self):
+        now = [1000.0]
+        self.server.timers = TimerWheel(clock=lambda: now[0])
+        self.server.idle_timeout = 60
+        idle, active = Mock(), Mock()
+        for connection in (idle, active):
+            connection.is_to_be_closed.return_value = False
+            connection.is_closed.return_value = False
+            self.server._start_idle_timer(connection)
+        now[0] += 45
+        active.last_activity = now[0]
+        now[0] += 15.5
+        self.server.timers.advance()
+        idle.mark_for_closing.assert_called_once_with()
+        active.mark_for_closing.assert_not_called()
+        now[0] += 45
+        self.server.timers.advance()
+        active.mark_for_closing.assert_called_once_with()
+        self.server._connection_removed(active)
+        self.assertNotIn(active, self.server.connection_timers)
+
     def test_close_on_empty_message(self):
-        empty_msg = b""
-        conn = Mock()
-        conn.socket.recv.return_value = empty_msg
+        conn = utils.get_mock_connection(returns=b"")
+        conn.mark_for_closing = Mock()
         self.server.connection_handler(conn)
         conn.mark_for_closing.assert_called_once_with()
 
     def test_listen(self):
         self.server._create_socket = Mock()
         mock_conn = Mock()
-        self.server.socket = Mock(accept=Mock(return_value=(mock_conn, ["TEST ADDRESS", 5555])))
+        self.server.socket = Mock(accept=Mock(side_effect=[(mock_conn, ["TEST ADDRESS", 5555]), BlockingIOError()]))
 
         # listen just once or we'll never get out of the loop
         def fn(conn):
@@ -40,7 +71,7 @@ class TestSocketServer(unittest.TestCase):
         self.assertFalse(self.server.listening)
         self.server._create_socket.assert_called_once_with()
         self.server.socket.close.assert_called_once_with()
-        self.server.socket.accept()[0].close.assert_called_once_with()
+        mock_conn.close.assert_called_once_with()
 
     @mock.patch("stevesockets.server.threading")
     def test_dlisten(self, threading):
@@ -50,27 +81,73 @@ class TestSocketServer(unittest.TestCase):
         threading.Thread().start.assert_called_once_with()
 
     def test_connection_handler_with_resp(self):
-        def handle(request_msg, send_msg):
-            self.assertEqual(request_msg, "MOCK BYTES")
-            send_msg("TEST", close_after=False)
-            self.server.stop_listening()
-            return "TEST"
-
-        self.server.handle_message = Mock(return_value="TEST", side_effect=lambda: self.server.stop_listening())
-        self.server.handle_message = handle
-
-        self.server.on_message = Mock()
-        connection_mock = Mock(socket=Mock(recv=Mock(return_value="MOCK BYTES")))
+        self.server.on_message = Mock(side_effect=lambda *args: self.server.stop_listening())
+        connection_mock = utils.get_mock_connection(returns=b"MOCK BYTES")
         self.server.peer_connections = [connection_mock]
         self.server._build_peer_connections = Mock()
         self.server.prune_peer_connections = Mock()
         self.server.listen()
-        connection_mock.socket.recv.assert_called_once_with(4096)
-        self.server.on_message.assert_called_once_with(connection_mock, "TEST")
+        connection_mock.socket.recv_into.assert_called_once()
+        self.server.on_message.assert_called_once_with(connection_mock, b"MOCK BYTES")
+
+    def test_listen_only_handles_ready_connections(self):
+        idle_connection = Mock()
+        ready_connection = Mock()
+        for connection in (idle_connection, ready_connection):
+            connection.is_to_be_closed.return_value = False
+            connection.is_closed.return_value = False
+            connection.is_reading_paused.return_value = False
+        self.server.peer_connections = [idle_connection, ready_connection]
+        self.server._build_peer_connections = Mock()
+        handled = []
+
+        def fn(conn):
+            handled.append(conn)
+            self.server.stop_listening()
+
+        self.server.connection_handler = fn
+        self.server.selector_cls = Mock(return_value=Mock(select=Mock(
+            side_effect=lambda timeout: [(Mock(data=ready_connection), stevesockets.server.selectors.EVENT_READ)]
+        )))
+        self.server.listen()
+        self.assertEqual(handled, [ready_connection])
+        self.server._build_peer_connections.assert_not_called()
+
+    def test_prune_only_looks_at_closing_connections(self):
+        idle, leaving, closed = (utils.MockSocketConnection(Mock(), "127.0.0.1", port) for port in (1, 2, 3))
+        self.server.peer_connections = [idle, leaving, closed]
+        idle.is_to_be_closed = Mock(return_value=False)
+        leaving.mark_for_closing()
+        closed.close()
+        self.assertEqual(self.server.closing_connections, {leaving, closed})
+        self.server.prune_peer_connections()
+        self.assertEqual(self.server.peer_connections, [idle])
+        self.assertEqual(self.server.closing_connections, set())
+        idle.is_to_be_closed.assert_not_called()
+
+    def test_prune_keeps_closing_connection_until_sent(self):
+        conn = utils.get_mock_connection()
+        conn.socket.sendmsg = Mock(side_effect=BlockingIOError())
+        self.server.peer_connections = [conn]
+        conn.queue_message(b"BYE")
+        conn.is_to_be_closed.return_value = True
+        conn.mark_for_closing()
+        self.server.prune_peer_connections()
+        self.assertEqual(self.server.peer_connections, [conn])
+        conn.socket.sendmsg = Mock(side_effect=lambda buffers: sum(len(b) for b in buffers))
+        self.server.prune_peer_connections()
+        self.assertEqual(self.server.peer_connections, [])
+
+    def test_close_connection_unregisters(self):
+        self.server.selector = utils.MockSelector()
+        conn = Mock()
+        self.server.selector.register(conn.socket, stevesockets.server.selectors.EVENT_READ, data=conn)
+        self.server._close_connection(conn)
+        self.assertNotIn(conn.socket, self.server.selector.get_map())
+        conn.close.assert_called_once_with()
 
     def test_connection_handler_without_resp(self):
-        c = Mock()
-        c.socket.recv = Mock(return_value=None)
+        c = utils.get_mock_connection()
         resp = self.server.connection_handler(c)
         self.assertIsNone(resp)
 
@@ -97,3 +174,85 @@ class TestSocketServer(unittest.TestCase):
         self.server.listen()
 
         self.server.handle_connection.assert_not_called()
+
+    def test_bytes_reader_partial_reads(self):
+        chunks = [b"TEST ", b"DATA"]
+
+        def recv_into(buffer, nbytes):
+            chunk = chunks.pop(0) if chunks else b""
+            buffer[:len(chunk)] = chunk
+            return len(chunk)
+
+        conn = Mock(socket=Mock(recv_into=Mock(side_effect=recv_into)))
+        reader = stevesockets.server.SocketBytesReader(conn)
+        self.assertEqual(reader.get_next_bytes(2), b"TE")
+        self.assertEqual(reader.get_next_bytes(6), b"ST DAT")
+        self.assertEqual(reader.get_next_bytes(4), b"A")
+        self.assertEqual(conn.socket.recv_into.call_count, 3)
+
+    def _get_connection(self, **kwargs):
+        return utils.MockSocketConnection(Mock(), "TEST ADDRESS", 5555, **kwargs)
+
+    def test_flush_messages_partial_send(self):
+        conn = self._get_connection()
+        conn.socket.sendmsg = Mock(side_effect=[3, BlockingIOError()])
+        conn.queue_message(b"TEST DATA")
+        conn.flush_messages()
+        self.assertTrue(conn.has_pending_output())
+        self.assertEqual(bytes(conn.messages[0]), b"T DATA")
+        self.assertEqual(conn.pending_bytes, 6)
+        self.assertEqual(self.server._get_interest(conn), selectors.EVENT_READ | selectors.EVENT_WRITE)
+
+        conn.socket.sendmsg = Mock(side_effect=lambda buffers: sum(len(b) for b in buffers))
+        self.server._handle_connection_event(conn, selectors.EVENT_WRITE)
+        conn.socket.sendmsg.assert_called_once()
+        self.assertFalse(conn.has_pending_output())
+        self.assertEqual(conn.pending_bytes, 0)
+
+    def test_slow_consumer_drop(self):
+        conn = self._get_connection(write_buffer_high=8, slow_consumer_policy=SlowConsumerPolicy.DROP)
+        conn.queue_message(b"TEST DATA").queue_message(b"MORE DATA")
+        self.assertEqual(list(conn.messages), [b"TEST DATA"])
+        self.assertEqual(conn.dropped_messages, 1)
+        self.assertFalse(conn.is_to_be_closed())
+
+    def test_slow_consumer_disconnect(self):
+        conn = self._get_connection(write_buffer_high=8, slow_consumer_policy=SlowConsumerPolicy.DISCONNECT)
+        conn.queue_message(b"TEST DATA").queue_message(b"MORE DATA")
+        self.assertFalse(conn.has_pending_output())
+        self.assertTrue(conn.is_to_be_closed())
+
+    def test_slow_consumer_pause(self):
+        conn = self._get_connection(write_buffer_high=8, write_buffer_low=4)
+        conn.socket.sendmsg = Mock(side_effect=[3, 2])
+        conn.queue_message(b"TEST DATA")
+        self.assertTrue(conn.is_reading_paused())
+        self.assertEqual(self.server._get_interest(conn), selectors.EVENT_WRITE)
+        conn.flush_messages()
+        self.assertTrue(conn.is_reading_paused())
+        conn.flush_messages()
+        self.assertFalse(conn.is_reading_paused())
+        self.assertEqual(conn.pending_bytes, 4)
+
+    def test_flush_messages_gathers_queue(self):
+        conn = self._get_connection()
+        conn.socket.sendmsg = Mock(return_value=11)
+        conn.queue_message(b"TEST ").queue_message(b"DATA ").queue_message(b"MORE")
+        conn.flush_messages()
+        conn.socket.sendmsg.assert_called_once_with([b"TEST ", b"DATA ", b"MORE"])
+        self.assertEqual([bytes(m) for m in conn.messages], [b"ORE"])
+        self.assertEqual(conn.pending_bytes, 3)
+
+    def test_on_message_flushes_dirty_connections(self):
+        conn, other = self._get_connection(), self._get_connection()
+        for c in (conn, other):
+            c.flush_messages = Mock(return_value=c)
+            c.on_dirty = self.server._mark_dirty
+        self.server.peer_connections = [conn, other]
+        self.server.message_manager.listen_for_message(
+            stevesockets.server.Listener(lambda message, connection=None, **kwargs: connection.queue_message(message))
+        )
+        self.server.on_message(conn, b"TEST")
+        conn.flush_messages.assert_called_once_with()
+        other.flush_messages.assert_not_called()
+        self.assertEqual(self.server.dirty_connections, set())
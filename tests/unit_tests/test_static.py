@@ -0,0 +1,148 @@
+import os
+import socket
+import tempfile
+import unittest
+from unittest.mock import Mock
+from stevesockets.http.request import Headers, HttpRequest
+from stevesockets.http.static import StaticFiles
+from stevesockets.socketconnection import SocketConnection
+
+
+class TestStaticFiles(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.root = os.path.join(self.directory.name, "root")
+        os.makedirs(os.path.join(self.root, "css"))
+        self.write("css/site.css", b"body { color: red; }")
+        with open(os.path.join(self.directory.name, "secret.txt"), "wb") as secret:
+            secret.write(b"secret")
+        self.now = 100.0
+        self.static = StaticFiles(self.root, max_open_files=2, clock=lambda: self.now)
+
+    def tearDown(self):
+        self.static.cache.clear()
+        self.directory.cleanup()
+
+    def write(self, path, content):
+        with open(os.path.join(self.root, path), "wb") as file:
+            file.write(content)
+
+    def get(self, path, method="GET", **headers):
+        request = HttpRequest(method, "/static/" + path, headers=Headers(
+            (name.replace("_", "-"), value) for name, value in headers.items()))
+        request.params = {"path": path}
+        connection, server = Mock(), Mock()
+        self.static(request, connection=connection, server=server)
+        head = b"".join(c.args[0] for c in connection.queue_message.call_args_list)
+        regions = [c.args[1:] for c in connection.queue_file.call_args_list]
+        return head, regions, server
+
+    def test_get(self):
+        head, regions, _ = self.get("css/site.css")
+        self.assertTrue(head.startswith(b"HTTP/1.1 200 OK\r\n"))
+        self.assertIn(b"Content-Type: text/css\r\n", head)
+        self.assertIn(b"Content-Length: 20\r\n", head)
+        self.assertIn(b"Last-Modified: ", head)
+        self.assertEqual(regions, [(0, 20)])
+        head, regions, _ = self.get("css/site.css", method="HEAD")
+        self.assertIn(b"Content-Length: 20\r\n", head)
+        self.assertEqual(regions, [])
+
+    def test_not_found(self):
+        for path in ("missing.css", "css", "../secret.txt", "css/../../secret.txt", "/etc/passwd"):
+            head, regions, server = self.get(path)
+            server.send_response.assert_called_once_with(unittest.mock.ANY, 404)
+            self.assertEqual((head, regions), (b"", []))
+
+    def test_conditional(self):
+        etag = self.static.get_file("css/site.css").etag
+        head, regions, _ = self.get("css/site.css", If_None_Match=f'"other", W/{etag}')
+        self.assertTrue(head.startswith(b"HTTP/1.1 304 Not Modified\r\n"))
+        self.assertIn(f"ETag: {etag}".encode(), head)
+        self.assertEqual(regions, [])
+        head, _, _ = self.get("css/site.css", If_None_Match='"other"',
+                              If_Modified_Since="Fri, 01 Jan 2100 00:00:00 GMT")
+        self.assertTrue(head.startswith(b"HTTP/1.1 200 OK"))
+        head, _, _ = self.get("css/site.css", If_Modified_Since="Fri, 01 Jan 2100 00:00:00 GMT")
+        self.assertTrue(head.startswith(b"HTTP/1.1 304"))
+        head, _, _ = self.get("css/site.css", If_Modified_Since="Thu, 01 Jan 1970 00:00:00 GMT")
+        self.assertTrue(head.startswith(b"HTTP/1.1 200 OK"))
+
+    def test_ranges(self):
+        for header, expected in (("bytes=0-3", (0, 4)), ("bytes=5-", (5, 20)), ("bytes=-5", (15, 20)),
+                                 ("bytes=10-100", (10, 20)), ("bytes=-100", (0, 20))):
+            head, regions, _ = self.get("css/site.css", Range=header)
+            self.assertTrue(head.startswith(b"HTTP/1.1 206 Partial Content\r\n"), header)
+            self.assertIn(f"Content-Range: bytes {expected[0]}-{expected[1] - 1}/20\r\n".encode(), head)
+            self.assertEqual(regions, [(expected[0], expected[1] - expected[0])])
+        for header in ("bytes=20-", "bytes=-0", "bytes=5-2"):
+            head, regions, _ = self.get("css/site.css", Range=header)
+            self.assertTrue(head.startswith(b"HTTP/1.1 416 Range Not Satisfiable\r\n"), header)
+            self.assertIn(b"Content-Range: bytes */20\r\n", head)
+            self.assertEqual(regions, [])
+        for header in ("bytes=0-1,4-5", "items=0-1", "bytes=x-"):
+            head, regions, _ = self.get("css/site.css", Range=header)
+            self.assertTrue(head.startswith(b"HTTP/1.1 200 OK"), header)
+        # a stale If-Range gets the whole file
+        head, _, _ = self.get("css/site.css", Range="bytes=0-3", If_Range='"stale"')
+        self.assertTrue(head.startswith(b"HTTP/1.1 200 OK"))
+        etag = self.static.get_file("css/site.css").etag
+        head, _, _ = self.get("css/site.css", Range="bytes=0-3", If_Range=etag)
+        self.assertTrue(head.startswith(b"HTTP/1.1 206"))
+
+    def test_cache(self):
+        cached = self.static.get_file("css/site.css")
+        self.write("css/site.css", b"body { color: blue; margin: 0; }")
+        # not checked against the disk again until revalidate_after has passed
+        self.assertIs(self.static.get_file("css/site.css"), cached)
+        self.now += 1
+        changed = self.static.get_file("css/site.css")
+        self.assertIsNot(changed, cached)
+        self.assertEqual(changed.size, 32)
+        self.now += 1
+        self.assertIs(self.static.get_file("css/site.css"), changed)
+
+        self.write("a.js", b"a")
+        self.write("b.js", b"b")
+        self.static.get_file("a.js")
+        self.static.get_file("css/site.css")
+        self.static.get_file("b.js")
+        self.assertEqual(list(self.static.cache), ["css/site.css", "b.js"])
+
+    def test_evicted_file_stays_open_while_sending(self):
+        cached = self.static.get_file("css/site.css")
+        fd = cached.file.fileno()
+        file = cached.file
+        del cached
+        self.static.cache.clear()
+        os.fstat(fd)
+        del file
+        with self.assertRaises(OSError):
+            os.fstat(fd)
+
+
+class TestFileRegion(unittest.TestCase):
+
+    def test_queue_file(self):
+        server_socket, client_socket = socket.socketpair()
+        self.addCleanup(server_socket.close)
+        self.addCleanup(client_socket.close)
+        server_socket.setblocking(False)
+        with tempfile.TemporaryFile() as file:
+            file.write(b"0123456789" * 100000)
+            file.flush()
+            connection = SocketConnection(server_socket, "127.0.0.1", 5555)
+            connection.queue_message(b"HEAD")
+            connection.queue_file(file, 10, 999980)
+            connection.queue_message(b"TAIL")
+            # the region isn't held in memory, so doesn't count towards the write buffer
+            self.assertEqual(connection.pending_bytes, 8)
+            received = b""
+            while connection.has_pending_output():
+                connection.flush_messages()
+                received += client_socket.recv(2 ** 20)
+            while len(received) < 999988:
+                received += client_socket.recv(2 ** 20)
+            self.assertEqual(received, b"HEAD" + (b"0123456789" * 100000)[10:-10] + b"TAIL")
+            self.assertEqual(connection.pending_bytes, 0)
@@ -0,0 +1,64 @@
+import unittest
+from unittest.mock import Mock
+from stevesockets.timers import TimerWheel
+
+
+class TestTimerWheel(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 100.0
+        self.wheel = TimerWheel(tick=.1, slots=8, clock=lambda: self.now)
+
+    def test_fires_once_due(self):
+        callback = Mock()
+        self.wheel.schedule(.5, callback, "arg")
+        self.now += .4
+        self.assertEqual(self.wheel.advance(), 0)
+        self.now += .15
+        self.assertEqual(self.wheel.advance(), 1)
+        callback.assert_called_once_with("arg")
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_timers_beyond_one_revolution(self):
+        # 8 slots of .1s, so a 2s timer shares its slot with timers due every .8s
+        late, early = Mock(), Mock()
+        self.wheel.schedule(2, late)
+        self.wheel.schedule(.4, early)
+        for _ in range(19):
+            self.now += .1
+            self.wheel.advance()
+        early.assert_called_once_with()
+        late.assert_not_called()
+        self.now += .15
+        self.wheel.advance()
+        late.assert_called_once_with()
+
+    def test_cancel(self):
+        callback = Mock()
+        self.wheel.schedule(.2, callback).cancel()
+        self.now += 1
+        self.assertEqual(self.wheel.advance(), 0)
+        callback.assert_not_called()
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_long_stall_fires_everything_due(self):
+        callbacks = [Mock() for _ in range(20)]
+        for delay, callback in enumerate(callbacks):
+            self.wheel.schedule(delay / 2, callback)
+        self.now += 5.05
+        self.assertEqual(self.wheel.advance(), 11)
+        self.assertEqual([callback.called for callback in callbacks], [True] * 11 + [False] * 9)
+
+    def test_schedule_from_callback(self):
+        fired = []
+
+        def reschedule():
+            fired.append(self.now)
+            if len(fired) < 3:
+                self.wheel.schedule(.3, reschedule)
+
+        self.wheel.schedule(.3, reschedule)
+        for _ in range(12):
+            self.now += .1
+            self.wheel.advance()
+        self.assertEqual(len(fired), 3)
@@ -2,8 +2,9 @@ import unittest
 from unittest.mock import Mock
 from tests import utils
 from stevesockets.server import SocketBytesReader
-from stevesockets.websocket.websocket import WebSocketFrame
-from stevesockets.websocket.websocket import WebSocketFrameHeaders
+from stevesockets.websocket import websocket
+from stevesockets.websocket.websocket import WebSocketFrame, WebSocketFrameParser, SocketException, apply_mask
+from stevesockets.websocket.websocket import WebSocketFrameHeaders, FragmentedMessage, FrameTooBig
 
 
 class TestWebSocketFrame(unittest.TestCase):
@@ -54,23 +55,165 @@ class TestWebSocketFrame(unittest.TestCase):
         self.assertEqual(f.message, "TEST DATA")
 
     def test_webframe_from_bytes_fragmented_126_payload_no_mask(self):
-        bstr = b'\x81~~\x00TEST DATATEST DATATEST DATATEST DATATEST DATATEST DATATEST DATATEST DATATEST DATATEST DATATEST DATATEST DATATEST DATATEST DATA'
+        bstr = b'\x81~\x00~TEST DATATEST DATATEST DATATEST DATATEST DATATEST DATATEST DATATEST DATATEST DATATEST DATATEST DATATEST DATATEST DATATEST DATA'
         reader = self._get_mock_bytes_reader(bytes_to_return=bstr)
         f = WebSocketFrame.from_bytes_reader(reader)
         self.assertEqual(f.message, "TEST DATA" * 14)
         self.assertEqual(f.headers.payload_length, 126)
         self.assertIsNone(f.headers.mask)
 
-    # def test_webframe_from_bytes_fragmented_127_payload_no_mask(self):
-    #     bstr = b'\x81\x7f\x00\x00\x00\x00\x00\x00\x00\x87TEST DATATEST DATATEST DATATEST DATATEST DATATEST DATATEST DATATEST DATATEST DATATEST DATATEST DATATEST DATATEST DATATEST DATATEST DATA'
-    #     reader = self._get_mock_bytes_reader(bytes=bstr)
-    #     f = WebSocketFrame.from_bytes_reader(reader)
-    #     self.assertEqual(f.message, "TEST DATA" * 15)
-    #     self.assertEqual(f.headers.payload_length, 135)
-    #     self.assertIsNone(f.headers.mask)
+    def test_webframe_from_bytes_fragmented_127_payload_no_mask(self):
+        bstr = b'\x81\x7f\x00\x00\x00\x00\x00\x00\x00\x87TEST DATATEST DATATEST DATATEST DATATEST DATATEST DATATEST DATATEST DATATEST DATATEST DATATEST DATATEST DATATEST DATATEST DATATEST DATA'
+        reader = self._get_mock_bytes_reader(bytes_to_return=bstr)
+        f = WebSocketFrame.from_bytes_reader(reader)
+        self.assertEqual(f.message, "TEST DATA" * 15)
+        self.assertEqual(f.headers.payload_length, 135)
+        self.assertIsNone(f.headers.mask)
 
     def test_webframe_premature_ending(self):
         bstr = b'\x819'
         reader = self._get_mock_bytes_reader(bytes_to_return=bstr)
-        with self.assertRaises(StopIteration):
+        with self.assertRaises(SocketException):
             WebSocketFrame.from_bytes_reader(reader)
+
+    def test_webframe_from_bytes_reads_in_bulk(self):
+        bstr = b'\x81\tTEST DATA\x81\tMORE DATA'
+        reader = self._get_mock_bytes_reader(bytes_to_return=bstr)
+        self.assertEqual(WebSocketFrame.from_bytes_reader(reader).message, "TEST DATA")
+        self.assertEqual(WebSocketFrame.from_bytes_reader(reader).message, "MORE DATA")
+        # both frames were served from a single read of the socket
+        reader.connection.socket.recv_into.assert_called_once()
+
+    def test_apply_mask(self):
+        self.assertEqual(apply_mask(b'TEST DATA', 525161), b'=F[TIGIT(')
+        self.assertEqual(apply_mask(memoryview(b'=F[TIGIT('), 525161), b'TEST DATA')
+        self.assertEqual(apply_mask(b'', 525161), b'')
+
+    @unittest.skipIf(websocket.numpy is None, "numpy not installed")
+    def test_apply_mask_numpy(self):
+        data = bytes(range(256)) * 64 + b'odd'
+        numpy, websocket.numpy = websocket.numpy, None
+        try:
+            expected = apply_mask(data, 327024055)
+        finally:
+            websocket.numpy = numpy
+        self.assertEqual(apply_mask(data, 327024055), expected)
+
+    def test_webframe_binary_payload(self):
+        payload = bytes(range(256))
+        bstr = WebSocketFrame.get_binary_frame(payload).to_bytes()
+        self.assertEqual(bstr[0], 0x82)
+        f = WebSocketFrame.from_bytes_reader(self._get_mock_bytes_reader(bytes_to_return=bstr))
+        self.assertEqual(f.headers.opcode, WebSocketFrame.OPCODE_BINARY)
+        self.assertEqual(f.payload, payload)
+
+    def test_webframe_utf8_text(self):
+        f = WebSocketFrame.get_text_frame("héllo ✓")
+        self.assertEqual(f.headers.payload_length, len("héllo ✓".encode('utf-8')))
+        parsed = WebSocketFrame.from_bytes_reader(self._get_mock_bytes_reader(bytes_to_return=f.to_bytes()))
+        self.assertEqual(parsed.message, "héllo ✓")
+
+    def test_webframe_to_buffers_keeps_payload(self):
+        payload = memoryview(bytearray(b'telemetry'))
+        header, body = WebSocketFrame.get_binary_frame(payload).to_buffers()
+        self.assertEqual(header, b'\x82\x09')
+        self.assertIs(body, payload)
+
+
+class TestWebSocketFrameParser(unittest.TestCase):
+
+    def test_feed_partial_frame(self):
+        parser = WebSocketFrameParser()
+        data = b'\x81\x89I\x96k\xa8\x1d\xd38\xfci\xd2*\xfc\x08'
+        frames = []
+        for x in range(len(data)):
+            frames += parser.feed(data[x:x + 1])
+            if x < len(data) - 1:
+                self.assertEqual(frames, [])
+        self.assertEqual(len(frames), 1)
+        self.assertEqual(frames[0].message, "TEST DATA")
+
+    def test_feed_many_frames(self):
+        parser = WebSocketFrameParser()
+        frames = parser.feed(b'\x81\tTEST DATA\x89\x00\x82\x02\x00\xff\x81')
+        self.assertEqual([f.headers.opcode for f in frames], [1, 9, 2])
+        self.assertEqual(frames[2].payload, b'\x00\xff')
+        self.assertEqual(parser.state, WebSocketFrameParser.READING_HEADER)
+        self.assertEqual(parser.buffer, b'\x81')
+
+    def test_feed_extended_length(self):
+        payload = b'x' * 70000
+        parser = WebSocketFrameParser()
+        frames = parser.feed(WebSocketFrame.get_binary_frame(payload).to_bytes()[:100])
+        self.assertEqual(frames, [])
+        self.assertEqual(parser.headers.payload_length, 70000)
+        frames = parser.feed(WebSocketFrame.get_binary_frame(payload).to_bytes()[100:])
+        self.assertEqual(frames[0].payload, payload)
+
+    def test_feed_unknown_opcode(self):
+        with self.assertRaises(SocketException):
+            WebSocketFrameParser().feed(b'\x83\x00')
+
+    def test_feed_fragmented_control_frame(self):
+        with self.assertRaises(SocketException):
+            WebSocketFrameParser().feed(b'\x09\x00')
+
+    def test_feed_max_frame_size(self):
+        parser = WebSocketFrameParser(max_frame_size=1000)
+        self.assertEqual(len(parser.feed(WebSocketFrame.get_binary_frame(b'x' * 1000).to_bytes())), 1)
+        # refused as soon as the length is known, with none of the payload sent
+        with self.assertRaises(FrameTooBig):
+            parser.feed(b'\x82\x7f' + (2 ** 40).to_bytes(8, 'big'))
+
+    def test_feed_spools_large_payload(self):
+        payload = bytes(range(256)) * 40
+        frame = WebSocketFrame.get_binary_frame(payload)
+        frame.headers.mask_flag, frame.headers.mask = 1, WebSocketFrame.generate_mask()
+        data = frame.to_bytes()
+        parser = WebSocketFrameParser(spool_threshold=4096)
+        frames = []
+        # uneven chunks, so the mask has to be lined up for each of them
+        for start in range(0, len(data), 999):
+            frames += parser.feed(data[start:start + 999])
+            self.assertLess(len(parser.buffer), 999)
+        self.assertTrue(frames[0].is_spooled())
+        self.assertEqual(bytes(frames[0].payload), payload)
+        self.assertEqual(frames[0].payload_file().read(256), bytes(range(256)))
+        small, = parser.feed(WebSocketFrame.get_binary_frame(b'x' * 100).to_bytes())
+        self.assertFalse(small.is_spooled())
+
+    def test_parser_never_spools_control_frames(self):
+        parser = WebSocketFrameParser(spool_threshold=1)
+        ping, close, data = parser.feed(WebSocketFrame.get_ping_frame(b'ping').to_bytes()
+                                        + WebSocketFrame.get_close_frame(b'\x03\xe8bye').to_bytes()
+                                        + WebSocketFrame.get_binary_frame(b'data').to_bytes())
+        self.assertFalse(ping.is_spooled())
+        self.assertEqual(ping.payload, b'ping')
+        self.assertFalse(close.is_spooled())
+        self.assertTrue(data.is_spooled())
+
+    def test_fragmented_message_preallocates(self):
+        message = FragmentedMessage(WebSocketFrameHeaders(fin=0, opcode=WebSocketFrame.OPCODE_TEXT), max_size=2 ** 20)
+        capacities = set()
+        for i in range(100):
+            message.add(WebSocketFrame.get_text_frame(f"{i:03}" * 1000))
+            capacities.add(len(message.payload))
+        # grown by doubling from room for two fragments, not once per fragment
+        self.assertEqual(sorted(capacities), [6000 * 2 ** i for i in range(7)])
+        self.assertEqual(message.size(), 300000)
+        frame = message.to_frame()
+        self.assertEqual(frame.message, "".join(f"{i:03}" * 1000 for i in range(100)))
+
+        message = FragmentedMessage(WebSocketFrameHeaders(fin=0, opcode=WebSocketFrame.OPCODE_TEXT), max_size=5000)
+        message.add(WebSocketFrame.get_text_frame("x" * 3000))
+        self.assertEqual(len(message.payload), 5000)
+
+    def test_fragmented_message_spools(self):
+        message = FragmentedMessage(WebSocketFrameHeaders(fin=0, opcode=WebSocketFrame.OPCODE_TEXT),
+                                    spool_threshold=10)
+        for part in ("TEST ", "DATA ", "MORE"):
+            message.add(WebSocketFrame.get_text_frame(part))
+        self.assertEqual(message.size(), 14)
+        frame = message.to_frame()
+        self.assertTrue(frame.is_spooled())
+        self.assertEqual(frame.message, "TEST DATA MORE")
@@ -3,18 +3,28 @@ from unittest.mock import Mock, MagicMock
 from tests import utils
 import stevesockets.server
 import stevesockets.websocket.server
+from stevesockets.listeners import MessageSynchronizer
+from stevesockets.server import BroadcastResult
+from stevesockets.socketconnection import SlowConsumerPolicy
+from stevesockets.timers import TimerWheel
+from stevesockets.websocket.deflate import PerMessageDeflate, DeflateContext
+from stevesockets.websocket.websocket import WebSocketFrame, WebSocketFrameParser
 
 
 class TestWebSocketServer(unittest.TestCase):
 
     def _set_connections(self, connections):
-        self.server._get_client_connection = Mock(side_effect=(x for x in connections[:]))
+        # everything is accepted on the first pass, whose accepting then stops at a BlockingIOError like a real
+        # non-blocking accept with nothing left; the next pass' accept finds the mock used up, ending the loop with a
+        # StopIteration
+        self.server._get_client_connection = Mock(side_effect=connections[:] + [BlockingIOError()])
 
     def setUp(self):
         stevesockets.server.socket = Mock()
         stevesockets.server.select = Mock(select=Mock(return_value=([Mock()], None, None)))
         stevesockets.server.threading = Mock()
         self.server = stevesockets.websocket.server.WebSocketServer()
+        self.server.selector_cls = utils.MockSelector
         self._set_connections([])
         old_listen = self.server.listen
 
@@ -28,6 +38,96 @@ class TestWebSocketServer(unittest.TestCase):
 
         self.server.listen = listen_wrapper
 
+    def _get_connecting_connection(self, *chunks):
+        conn = utils.get_mock_connection(handshook=False)
+        remaining = list(chunks)
+
+        def recv_into(buffer, nbytes=0):
+            if not remaining:
+                raise BlockingIOError()
+            chunk = remaining.pop(0)
+            buffer[:len(chunk)] = chunk
+            return len(chunk)
+
+        conn.socket.recv_into = Mock(side_effect=recv_into)
+        return conn
+
+    def _sent(self, conn):
+        return b''.join(b''.join(c.args[0]) for c in conn.socket.sendmsg.call_args_list)
+
+    def _use_fake_clock(self):
+        self.now = 1000.0
+        self.server.timers = TimerWheel(clock=lambda: self.now)
+
+    def test_accept_doesnt_read_handshake(self):
+        sck = Mock()
+        self.server.socket = Mock(accept=Mock(return_value=(sck, ("127.0.0.1", 5555))))
+        conn = stevesockets.websocket.server.WebSocketServer._get_client_connection(self.server)
+        sck.recv.assert_not_called()
+        sck.recv_into.assert_not_called()
+        self.assertEqual(conn.get_status(), stevesockets.websocket.server.WebSocketConnection.CONNECTING)
+        self.assertIn("handshake", self.server.connection_timers[conn])
+
+    def test_handshake_split_across_reads(self):
+        handshake = b"GET / HTTP/1.1\r\nSec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n\r\n"
+        frame = b'\x81\tTEST DATA'
+        conn = self._get_connecting_connection(handshake[:20], handshake[20:-1], handshake[-1:] + frame)
+        self.server.schedule_connection_timer(conn, "handshake", 10, self.server._handshake_timed_out)
+        self.assertEqual(self.server.read_messages(conn), [])
+        self.assertEqual(self.server.read_messages(conn), [])
+        self.assertFalse(conn.is_handshook())
+        messages = self.server.read_messages(conn)
+        self.assertTrue(conn.is_handshook())
+        self.assertNotIn("handshake", self.server.connection_timers[conn])
+        self.assertIn(b"Sec-WebSocket-Accept: s3pPLMBiTxaQ9kYGzzhZRbK+xOo=", self._sent(conn))
+        self.assertEqual([message.message for message in messages], ["TEST DATA"])
+
+    def test_handshake_too_large(self):
+        self.server.MAX_HANDSHAKE_SIZE = 64
+        conn = self._get_connecting_connection(b"GET / HTTP/1.1\r\n" + b"X-Header: value\r\n" * 4)
+        self.assertEqual(self.server.read_messages(conn), [])
+        self.assertTrue(self._sent(conn).startswith(b"HTTP/1.1 431"))
+        self.assertTrue(conn.to_be_closed)
+
+    def test_handshake_not_utf8(self):
+        conn = self._get_connecting_connection(b"GET /\xff HTTP/1.1\r\n\r\n")
+        self.assertEqual(self.server.read_messages(conn), [])
+        self.assertTrue(self._sent(conn).startswith(b"HTTP/1.1 400"))
+        self.assertTrue(conn.to_be_closed)
+
+    def test_handshake_timeout(self):
+        self._use_fake_clock()
+        waiting, late = self._get_connecting_connection(), self._get_connecting_connection()
+        self.server.schedule_connection_timer(late, "handshake", 5, self.server._handshake_timed_out)
+        self.server.schedule_connection_timer(waiting, "handshake", 10, self.server._handshake_timed_out)
+        self.now += 5.5
+        self.assertEqual(self.server.timers.advance(), 1)
+        self.assertTrue(self._sent(late).startswith(b"HTTP/1.1 408"))
+        self.assertTrue(late.to_be_closed)
+        self.assertFalse(waiting.to_be_closed)
+
+    def test_ping_pong_deadline(self):
+        self._use_fake_clock()
+        self.server.ping_interval, self.server.pong_timeout = 30, 5
+        alive, dead = utils.get_mock_connection(), utils.get_mock_connection()
+        for conn in (alive, dead):
+            conn.last_activity = self.now
+            self.server._connection_established(conn)
+        self.now += 30.5
+        self.server.timers.advance()
+        for conn in (alive, dead):
+            self.assertEqual(b''.join(conn.messages), b'\x89\x00')
+            conn.clear_messages()
+        alive.last_activity = self.now
+        self.now += 5.5
+        self.server.timers.advance()
+        self.assertFalse(alive.to_be_closed)
+        self.assertTrue(dead.to_be_closed)
+        self.assertEqual(self._sent(dead), b'\x88\x15\x03\xe9No response to ping')
+        self.now += 30.5
+        self.server.timers.advance()
+        self.assertEqual(b''.join(alive.messages), b'\x89\x00')
+
     def test_handle_message_without_mask(self):
         msg = b'\x81\tTEST DATA'
         mock_connection = utils.get_mock_connection(returns=msg)
@@ -61,13 +161,13 @@ class TestWebSocketServer(unittest.TestCase):
         conn_mock = utils.get_mock_connection(returns=b'\x89\x00')
         self._set_connections([conn_mock])
         self.server.listen()
-        conn_mock.socket.sendall.assert_called_with(b'\x8a\x00')
+        conn_mock.socket.sendmsg.assert_called_once_with([b'\x8a\x00'])
 
     def test_connection_handler_pong(self):
         conn_mock = utils.get_mock_connection(returns=b'\x8a\x00')
         self._set_connections([conn_mock])
         self.server.listen()
-        conn_mock.socket.sendall.assert_not_called()
+        conn_mock.socket.sendmsg.assert_not_called()
 
     def test__close_connection(self):
         mock_connection = utils.get_mock_connection()
@@ -106,3 +206,197 @@ class TestWebSocketServer(unittest.TestCase):
         self.server.handle_message = Mock(return_value="TEST")
         r3 = self.server.connection_handler(mock_connection)
         self.assertEqual(r3.to_bytes(), msg3)
+
+    def test_read_messages_partial_frames(self):
+        conn = utils.get_mock_connection(returns=b'\x81\tTEST')
+        self.assertEqual(self.server.read_messages(conn), [])
+        conn.socket.recv_into.side_effect = utils.get_mock_recv_into(b' DATA\x81\tMORE DATA')
+        frames = self.server.read_messages(conn)
+        self.assertEqual([f.message for f in frames], ["TEST DATA", "MORE DATA"])
+
+    def test_read_messages_reassembles_fragments(self):
+        conn = utils.get_mock_connection(returns=b'\x01\x11partial message 1' + b'\x89\x00' +
+                                                 b'\x00\x11partial message 2' + b'\x80\rfinal message')
+        frames = self.server.read_messages(conn)
+        self.assertEqual([f.headers.opcode for f in frames], [9, 1])
+        self.assertEqual(frames[1].message, "partial message 1partial message 2final message")
+        self.assertEqual(frames[1].headers.fin, 1)
+        self.assertIsNone(conn.fragmented_message)
+
+    def test_read_messages_fragmented_message_too_big(self):
+        self.server.max_message_size = 20
+        conn = utils.get_mock_connection(returns=b'\x01\x11partial message 1' + b'\x00\x11partial message 2')
+        conn.mark_for_closing = Mock()
+        self.assertEqual(self.server.read_messages(conn), [])
+        conn.mark_for_closing.assert_called_once_with()
+        conn.socket.sendmsg.assert_called_once()
+        sent = b''.join(conn.socket.sendmsg.call_args.args[0])
+        self.assertEqual(sent, b'\x88\x11\x03\xf1Message too big')
+
+    def test_read_messages_unexpected_continuation(self):
+        conn = utils.get_mock_connection(returns=b'\x80\rfinal message')
+        conn.mark_for_closing = Mock()
+        self.assertEqual(self.server.read_messages(conn), [])
+        conn.mark_for_closing.assert_called_once_with()
+
+    def test_broadcast_encodes_once(self):
+        sender, first, second, connecting = [utils.get_mock_connection() for _ in range(4)]
+        connecting.handshook = False
+        self.server.peer_connections = [sender, first, second, connecting]
+        frame = WebSocketFrame.get_text_frame("TEST DATA")
+        frame.to_bytes = Mock(wraps=frame.to_bytes)
+        result = self.server.broadcast(frame, exclude=sender)
+        frame.to_bytes.assert_called_once_with()
+        self.assertEqual(result, BroadcastResult(reached=2, dropped=0))
+        self.assertIs(first.messages[0], second.messages[0])
+        self.assertEqual(first.messages[0], b'\x81\tTEST DATA')
+        self.assertFalse(sender.messages)
+        self.assertFalse(connecting.messages)
+
+    def test_broadcast_counts_dropped(self):
+        full = utils.get_mock_connection()
+        full.write_buffer_high = 1
+        full.slow_consumer_policy = SlowConsumerPolicy.DROP
+        full.queue_message(b'\x81\x00')
+        closing = utils.get_mock_connection(to_be_closed=True)
+        self.server.peer_connections = [full, closing, utils.get_mock_connection()]
+        result = self.server.broadcast(WebSocketFrame.get_text_frame("TEST DATA"),
+                                       predicate=lambda conn: True)
+        self.assertEqual(result, BroadcastResult(reached=1, dropped=2))
+
+    def test_message_synchronizer(self):
+        sender, receiver = utils.get_mock_connection(), utils.get_mock_connection()
+        self.server.peer_connections = [sender, receiver]
+        MessageSynchronizer().observe(WebSocketFrame.get_text_frame("TEST DATA"), connection=sender,
+                                      server=self.server)
+        self.assertEqual(list(receiver.messages), [b'\x81\tTEST DATA'])
+        self.assertFalse(sender.messages)
+
+    def test_publish_to_channel(self):
+        sender, member, outsider = [utils.get_mock_connection() for _ in range(3)]
+        self.server.peer_connections = [sender, member, outsider]
+        self.server.subscribe(sender, "room")
+        self.server.subscribe(member, "room")
+        self.server.subscribe(outsider, "lobby")
+        result = self.server.publish("room", WebSocketFrame.get_text_frame("TEST DATA"), exclude=sender)
+        self.assertEqual(result, BroadcastResult(reached=1, dropped=0))
+        self.assertEqual(list(member.messages), [b'\x81\tTEST DATA'])
+        self.assertFalse(sender.messages)
+        self.assertFalse(outsider.messages)
+        self.assertEqual(self.server.publish("empty", WebSocketFrame.get_text_frame("TEST")), BroadcastResult(0, 0))
+
+    def test_broadcast_relayed_to_backplane(self):
+        self.server.backplane = Mock()
+        self.server.listening = True
+        sender, receiver = utils.get_mock_connection(), utils.get_mock_connection()
+        self.server.peer_connections = [sender, receiver]
+        self.server.broadcast(WebSocketFrame.get_text_frame("TEST DATA"), exclude=sender)
+        self.server.publish("room", WebSocketFrame.get_text_frame("ROOM"))
+        self.server.broadcast(WebSocketFrame.get_text_frame("TARGETED"), connections=[receiver])
+        self.assertEqual(self.server.backplane.publish.call_args_list,
+                         [unittest.mock.call(None, b'\x81\tTEST DATA'), unittest.mock.call("room", b'\x81\x04ROOM')])
+
+    def test_relayed_messages_delivered_locally(self):
+        self.server.backplane = Mock(receive=Mock(return_value=[(None, b'\x81\x03ALL'), ("room", b'\x81\x04ROOM')]))
+        self.server.listening = True
+        member, outsider = utils.get_mock_connection(), utils.get_mock_connection()
+        self.server.peer_connections = [member, outsider]
+        self.server.subscribe(member, "room")
+        self.server._process_backplane()
+        self.assertEqual(b''.join(member.messages), b'\x81\x03ALL\x81\x04ROOM')
+        self.assertEqual(b''.join(outsider.messages), b'\x81\x03ALL')
+        self.server.backplane.publish.assert_not_called()
+
+    def test_pruned_connections_leave_channels(self):
+        staying, leaving = utils.get_mock_connection(), utils.get_mock_connection()
+        leaving.is_to_be_closed = Mock(return_value=True)
+        self.server.peer_connections = [staying, leaving]
+        self.server.subscribe(staying, "room")
+        self.server.subscribe(leaving, "room")
+        self.server.subscribe(leaving, "lobby")
+        self.server.prune_peer_connections()
+        self.assertEqual(self.server.get_subscribers("room"), {staying})
+        self.assertNotIn("lobby", self.server.channels)
+        self.assertEqual(leaving.channels, set())
+
+    def test_handshake_negotiates_compression(self):
+        client_handshake = (b"GET / HTTP/1.1\r\nSec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n"
+                            b"Sec-WebSocket-Extensions: permessage-deflate; client_max_window_bits\r\n")
+        self.server.send_http_response = Mock()
+        plain = utils.get_mock_connection()
+        self.server.handle_websocket_handshake(plain, client_handshake)
+        self.assertIsNone(plain.deflate)
+        self.assertNotIn("Sec-WebSocket-Extensions", self.server.send_http_response.call_args.kwargs["headers"])
+
+        self.server.compression = PerMessageDeflate()
+        compressed = utils.get_mock_connection()
+        self.server.handle_websocket_handshake(compressed, client_handshake)
+        self.assertIsNotNone(compressed.deflate)
+        self.assertEqual(self.server.send_http_response.call_args.kwargs["headers"]["Sec-WebSocket-Extensions"],
+                         "permessage-deflate; server_no_context_takeover; client_no_context_takeover")
+
+    def test_read_messages_decompresses(self):
+        context = DeflateContext(threshold=0)
+        frame = context.compress_frame(WebSocketFrame.get_text_frame("TEST DATA" * 20))
+        conn = utils.get_mock_connection(returns=frame.to_bytes() + b'\x81\x04TEST')
+        conn.deflate = context
+        messages = self.server.read_messages(conn)
+        self.assertEqual([m.message for m in messages], ["TEST DATA" * 20, "TEST"])
+        self.assertEqual(messages[0].headers.rsv, 0)
+
+    def test_read_messages_compressed_too_big(self):
+        self.server.max_message_size = 100
+        context = DeflateContext(threshold=0)
+        frame = context.compress_frame(WebSocketFrame.get_text_frame("x" * 101))
+        conn = utils.get_mock_connection(returns=frame.to_bytes())
+        conn.deflate = context
+        self.assertEqual(self.server.read_messages(conn), [])
+        self.assertTrue(self._sent(conn).startswith(b'\x88\x11\x03\xf1'))
+
+    def test_read_messages_rsv_without_compression(self):
+        conn = utils.get_mock_connection(returns=b'\xc1\x04TEST')
+        conn.mark_for_closing = Mock()
+        self.assertEqual(self.server.read_messages(conn), [])
+        self.assertTrue(self._sent(conn).startswith(b'\x88\x1a\x03\xeaUnexpected reserved bits'))
+        conn.mark_for_closing.assert_called_once_with()
+
+    def test_broadcast_compresses_once(self):
+        self.server.compression = PerMessageDeflate(threshold=16)
+        plain, first, second, shared = [utils.get_mock_connection() for _ in range(4)]
+        first.deflate, second.deflate = DeflateContext(threshold=16), DeflateContext(threshold=16)
+        shared.deflate = DeflateContext(threshold=16, server_context_takeover=True)
+        self.server.peer_connections = [plain, first, second, shared]
+        self.server.broadcast(WebSocketFrame.get_text_frame("TEST DATA" * 10))
+        self.server.broadcast(WebSocketFrame.get_text_frame("SHORT"))
+        self.assertEqual(plain.messages[0], WebSocketFrame.get_text_frame("TEST DATA" * 10).to_bytes())
+        self.assertIs(first.messages[0], second.messages[0])
+        self.assertEqual(first.messages[0][0], 0xc1)
+        self.assertIsNot(shared.messages[0], first.messages[0])
+        for conn in (plain, first, second, shared):
+            # under the threshold
+            self.assertEqual(conn.messages[1], b'\x81\x05SHORT')
+
+    def test_send_frame_compresses(self):
+        conn = utils.get_mock_connection()
+        conn.deflate = DeflateContext(threshold=16)
+        conn.send_frame(WebSocketFrame.get_text_frame("TEST DATA" * 10))
+        conn.send_frame(WebSocketFrame.get_text_frame("TEST"))
+        compressed, parsed = WebSocketFrameParser().feed(b''.join(conn.messages))
+        self.assertEqual(conn.deflate.decompress_frame(compressed, 1000).message, "TEST DATA" * 10)
+        self.assertEqual(parsed.message, "TEST")
+
+    def test_oversized_frame_refused_before_payload(self):
+        self.server.max_frame_size = 1000
+        conn = utils.get_mock_connection(returns=b'\x82\x7f' + (2 ** 40).to_bytes(8, 'big'))
+        self.server._connection_established(conn)
+        self.assertEqual(self.server.read_messages(conn), [])
+        self.assertTrue(self._sent(conn).startswith(b'\x88\x11\x03\xf1Message too big'))
+        self.assertTrue(conn.to_be_closed)
+
+    def test_read_messages_spools_fragments(self):
+        self.server.spool_threshold = 8
+        conn = utils.get_mock_connection(returns=b'\x01\x05TEST \x80\x04DATA')
+        self.server._connection_established(conn)
+        message, = self.server.read_messages(conn)
+        self.assertTrue(message.is_spooled())
+        self.assertEqual(message.payload_file().read(), b'TEST DATA')
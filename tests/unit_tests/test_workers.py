@@ -0,0 +1,114 @@
+import concurrent.futures
+import threading
+import time
+import unittest
+from unittest.mock import Mock
+from stevesockets.messages import Listener, ListenerExecutor, MessageManager
+from stevesockets.workers import OrderedExecutor, WorkerPool
+
+
+class UpperListener(Listener):
+    executor = ListenerExecutor.THREAD
+
+    def handle(self, message):
+        # later messages finish their work first unless they're kept in order
+        time.sleep(0.05 / len(message))
+        return message.upper()
+
+
+class ProcessUpperListener(Listener):
+    executor = ListenerExecutor.PROCESS
+
+    def handle(self, message):
+        return message.upper()
+
+
+class TestOrderedExecutor(unittest.TestCase):
+
+    def setUp(self):
+        self.executor = OrderedExecutor(concurrent.futures.ThreadPoolExecutor(max_workers=4))
+
+    def tearDown(self):
+        self.executor.shutdown()
+
+    def test_same_key_in_order(self):
+        finished = []
+        done = threading.Event()
+        for delay in (0.04, 0.02, 0):
+            self.executor.submit("key", time.sleep, delay, callback=lambda future, d=delay: finished.append(d))
+        self.executor.submit("key", done.set)
+        self.assertTrue(done.wait(5))
+        self.assertEqual(finished, [0.04, 0.02, 0])
+
+    def test_different_keys_in_parallel(self):
+        started = threading.Barrier(2, timeout=5)
+        finished = []
+        for key in ("first", "second"):
+            self.executor.submit(key, started.wait, callback=lambda future: finished.append(future.exception()))
+        deadline = time.time() + 5
+        while len(finished) < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(finished, [None, None])
+
+
+class TestWorkerPool(unittest.TestCase):
+
+    def setUp(self):
+        self.ready = threading.Semaphore(0)
+        self.pool = WorkerPool(notify=self.ready.release)
+
+    def tearDown(self):
+        self.pool.shutdown()
+
+    def _get_connection(self):
+        return Mock(is_closed=Mock(return_value=False), is_to_be_closed=Mock(return_value=False))
+
+    def _wait_for_results(self, count):
+        for _ in range(count):
+            self.assertTrue(self.ready.acquire(timeout=5))
+        return self.pool.process_results()
+
+    def test_results_in_order_per_connection(self):
+        connection = self._get_connection()
+        listener = UpperListener()
+        for message in ("a", "bb", "ccc", "dddd"):
+            self.pool.submit(listener, message, connection=connection)
+        self.assertEqual(self._wait_for_results(4), 4)
+        self.assertEqual([c.args[0] for c in connection.queue_message.call_args_list], ["A", "BB", "CCC", "DDDD"])
+
+    def test_process_executor(self):
+        connection = self._get_connection()
+        self.pool.submit(ProcessUpperListener(), "hello", connection=connection)
+        self._wait_for_results(1)
+        connection.queue_message.assert_called_once_with("HELLO")
+
+    def test_closed_connection_skipped(self):
+        connection = self._get_connection()
+        self.pool.submit(UpperListener(), "a", connection=connection)
+        connection.is_to_be_closed.return_value = True
+        self._wait_for_results(1)
+        connection.queue_message.assert_not_called()
+
+    def test_failed_handle_logged(self):
+        listener = UpperListener()
+        listener.handle = Mock(side_effect=ValueError("bad message"))
+        self.pool.logger = Mock()
+        connection = self._get_connection()
+        self.pool.submit(listener, "a", connection=connection)
+        self._wait_for_results(1)
+        self.pool.logger.error.assert_called_once()
+        connection.queue_message.assert_not_called()
+
+
+class TestMessageManagerOffload(unittest.TestCase):
+
+    def test_offloads_only_executor_listeners(self):
+        manager = MessageManager()
+        manager.offload = Mock()
+        inline = Listener(fn=Mock())
+        offloaded = UpperListener()
+        manager.listen_for_message(inline)
+        manager.listen_for_message(offloaded)
+        manager.dispatch_message("message", connection="connection")
+        inline.fn.assert_called_once_with("message", connection="connection")
+        manager.offload.assert_called_once_with(offloaded, "message", connection="connection")
@@ -1,9 +1,35 @@
+import selectors
 from unittest.mock import Mock
+from stevesockets.socketconnection import SocketConnection
 from stevesockets.websocket.server import WebSocketConnection
 
 
+def get_mock_recv_into(returns=None):
+	""" Returns a `recv_into` that hands back everything left of `returns`, the way a socket would once all the
+		data has arrived """
+	remaining = bytearray(returns if returns else b'')
+
+	def mock_recv_into(buffer, nbytes=0):
+		nbytes = min(nbytes or len(buffer), len(remaining))
+		buffer[:nbytes] = remaining[:nbytes]
+		del remaining[:nbytes]
+		return nbytes
+
+	return mock_recv_into
+
+
+class MockSocketConnection(SocketConnection):
+	""" Not slotted, so tests can swap out methods on an instance """
+	pass
+
+
+class MockWebSocketConnection(WebSocketConnection):
+	""" Not slotted, so tests can swap out methods on an instance """
+	pass
+
+
 def get_mock_connection(returns=None, handshook=True, to_be_closed=False, closed=False):
-	ws = WebSocketConnection(Mock())
+	ws = MockWebSocketConnection(Mock())
 	ws.is_to_be_closed = Mock(return_value=to_be_closed)
 	ws.is_closed = Mock(return_value=closed)
 	return_value_generator = (returns[i:i + 1] for i in range(len(returns))) if returns else (x for x in [None])
@@ -15,6 +41,37 @@ def get_mock_connection(returns=None, handshook=True, to_be_closed=False, closed
 		return bytes(bytes_value)
 
 	ws.socket.recv = mock_recv
+	ws.socket.recv_into = Mock(side_effect=get_mock_recv_into(returns))
+	ws.socket.sendmsg = Mock(side_effect=lambda buffers: sum(len(b) for b in buffers))
 	ws.handshook = handshook
 	return ws
 
+
+class MockSelector:
+	""" Stands in for a `selectors` selector, reporting every registered object as ready on each `select` call """
+
+	def __init__(self):
+		self.keys = {}
+
+	def register(self, fileobj, events, data=None):
+		key = selectors.SelectorKey(fileobj, id(fileobj), events, data)
+		self.keys[fileobj] = key
+		return key
+
+	def unregister(self, fileobj):
+		return self.keys.pop(fileobj)
+
+	def modify(self, fileobj, events, data=None):
+		return self.register(fileobj, events, data=data)
+
+	def get_key(self, fileobj):
+		return self.keys[fileobj]
+
+	def get_map(self):
+		return self.keys
+
+	def select(self, timeout=None):
+		return [(key, key.events) for key in list(self.keys.values())]
+
+	def close(self):
+		self.keys.clear()